@@ -0,0 +1,478 @@
+#!/usr/bin/python3
+'''
+hotpaths.py
+  Offline micro-benchmarks for the hot paths of the Python pipeline stages:
+  consensus_generator of both barcode consensus scripts, the streaming
+  consensus of giant MIGs, parse_igblast_block, compose_fasta_block and
+  translate of the IgBLAST harvester, and the per-cycle quality histogram of
+  quality_profile.py. The inputs are synthetic and seeded: MIG sets of a given
+  size, read length, error rate and start offset range (the read-to-read shift
+  the seed has to absorb), IgBLAST report blocks generated together with their
+  query FASTA records, so IgBLAST is not needed, and raw FASTQ reads.
+  Every benchmark reports its rate (MIGs/s or queries/s, best of the repeats)
+  and the peak of the Python memory allocations (tracemalloc, in a separate
+  untimed run). With --save the results become the baseline; otherwise they
+  are compared with the stored baseline, and a rate drop or a memory growth
+  beyond the threshold is an error (exit status 1). The rates depend on the
+  machine, so the baselines are kept per host (baseline.<host>.json next to
+  this script, not part of the repository): run with --save on a host first.
+'''
+
+import sys
+import argparse
+import gc
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+
+PIPELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pipeline')
+sys.path.insert(0, PIPELINE_DIR)
+
+import consensus_pfm
+import consensus_stream
+import quality_profile
+import translator
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),\
+                        'baseline.' + (platform.node() or 'localhost') + '.json')
+
+SENSE_CODONS = [codon for codon, aa in translator.CODON_TABLE.items()\
+                if aa not in ('*', translator.UNKNOWN_AA)]
+
+#-------------------------------------------------------------------------------
+def load_script (name):
+    '''
+    returns a pipeline script loaded as a module (the scripts are run with
+      "python3 script.py" and some names are not importable, e.g., with '-')
+    1st argument--script filename in the pipeline directory
+    '''
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_')[:-3],\
+                                                  os.path.join(PIPELINE_DIR, name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+#-------------------------------------------------------------------------------
+def mutate (rng, seq, error_rate):
+    '''
+    returns the sequence with substitutions (a fifth of them as N) at the error rate
+    '''
+    if not error_rate:
+        return seq
+    bases = list(seq)
+    for pos in range(len(bases)):
+        if rng.random() < error_rate:
+            bases[pos] = 'N' if rng.random() < 0.2 else rng.choice('ACGT')
+    return ''.join(bases)
+
+
+#-------------------------------------------------------------------------------
+def synthetic_migs (rng, mig_count, mig_size, read_length, error_rate, max_offset):
+    '''
+    returns array of (cluster ID, array of sequences) MIGs; the reads of a MIG
+      are copies of one template that start up to max_offset bases in and
+      end up to max_offset bases early, with substitutions at the error rate
+    1st argument--random.Random instance
+    2nd argument--number of MIGs
+    3rd argument--mean number of reads per MIG (sizes vary from half to 1.5 times)
+    4th argument--template length
+    5th argument--substitution rate per base
+    6th argument--maximal start (and end) offset of a read
+    '''
+    migs = []
+    for mig in range(mig_count):
+        template = ''.join(rng.choice('ACGT') for _ in range(read_length))
+        size = max(2, rng.randint(mig_size // 2, mig_size * 3 // 2))
+        seqs = []
+        for _ in range(size):
+            start = rng.randint(0, max_offset)
+            end = read_length - rng.randint(0, max_offset)
+            seqs.append(mutate(rng, template[start:end], error_rate))
+        migs.append((str(mig + 1) + ';barcode=' + ''.join(rng.choice('ACGT') for _ in range(16))\
+                     + ';size=' + str(size), seqs))
+    return migs
+
+
+#-------------------------------------------------------------------------------
+def rev_comp (seq):
+    '''
+    returns reverse-complement
+    '''
+    return seq.translate(str.maketrans('ACGTN', 'TGCAN'))[::-1]
+
+
+#-------------------------------------------------------------------------------
+def synthetic_igblast (rng, query_count, read_length, error_rate):
+    '''
+    returns (IgBLAST verbose report text, array of seq_reader.SeqRecord) for
+      queries built from random in-frame V(D)J-like sequences: a rearrangement
+      summary, junction details, the CDR3 sub-region line and the alignment
+      summary table per query, with some reverse-strand, truncated and
+      no-hit queries
+    1st argument--random.Random instance
+    2nd argument--number of queries
+    3rd argument--query length
+    4th argument--substitution rate per base
+    '''
+    import seq_reader
+
+    report = ['IGBLASTN 1.18.0+\n\n\nDatabase: synthetic_gl_V\n\n\n']
+    records = []
+    regions = ('FR1-IMGT', 'CDR1-IMGT', 'FR2-IMGT', 'CDR2-IMGT', 'FR3-IMGT')
+    for query in range(query_count):
+        codon_count = read_length // 3
+        seq = ''.join(rng.choice(SENSE_CODONS) for _ in range(codon_count))
+        seq = mutate(rng, seq, error_rate)
+        query_id = 'MIG' + str(query + 1) + ';barcode=' +\
+            ''.join(rng.choice('ACGT') for _ in range(16)) + ';retained=' + str(rng.randint(1, 50))
+        strand = '-' if rng.random() < 0.15 else '+'
+        records.append(seq_reader.SeqRecord(query_id, rev_comp(seq) if strand == '-' else seq))
+
+        report.append('Query= ' + query_id + '\n\nLength=' + str(len(seq)) + '\n')
+        if rng.random() < 0.03:
+            report.append('\n\n***** No hits found *****\n\n\nEffective search space used: 1\n\n\n')
+            continue
+
+        cdr3_start = 3 * rng.randint(codon_count * 2 // 3, codon_count - 12)
+        cdr3_end = cdr3_start + 3 * rng.randint(6, 10)
+        cdr3_nt = seq[cdr3_start:cdr3_end]
+        cdr3_aa = translator.translate(cdr3_nt)
+        junction = seq[cdr3_start - 9:cdr3_end + 6]
+        cut = rng.randint(3, len(junction) - 6)
+        report.append('V-(D)-J rearrangement summary for query sequence (Top V gene match,'\
+                      ' Top D gene match, Top J gene match, Chain type, stop codon, V-J frame,'\
+                      ' Productive, Strand, V Frame shift).\n'\
+                      'IGHV1-' + str(rng.randint(1, 80)) + '*01\tIGHD2-3*01\tIGHJ'\
+                      + str(rng.randint(1, 4)) + '*01\tVH\tNo\tIn-frame\tYes\t' + strand\
+                      + '\tNo\n\n'\
+                      'V-(D)-J junction details based on top germline gene matches (V end,'\
+                      ' V-D junction, D region, D-J junction, J start).\n'\
+                      + junction[:cut] + '\t(' + junction[cut:cut + 3] + ')\t'\
+                      + junction[cut + 3:-6] + '\tN/A\t'\
+                      + ('N/A' if rng.random() < 0.05 else junction[-6:]) + '\t\n\n'\
+                      'Sub-region sequence details (nucleotide sequence, translation,'\
+                      ' start, end)\n'\
+                      'CDR3\t' + cdr3_nt + '\t' + cdr3_aa + '\t' + str(cdr3_start + 1) + '\t'\
+                      + str(cdr3_end) + '\t\n\n'\
+                      'Alignment summary between query and top germline V gene hit (from, to,'\
+                      ' length, matches, mismatches, gaps, percent identity)\n')
+        first = 1 if rng.random() < 0.9 else 2 # truncated FR1 for some queries
+        # framework regions in codon steps up to the CDR3 (reading frame 1)
+        bounds = [3 * (cdr3_start // 3 * region // len(regions))\
+                  for region in range(len(regions) + 1)]
+        total = 0
+        for region, name in enumerate(regions[first - 1:], first - 1):
+            start, end = bounds[region] + 1, bounds[region + 1]
+            length = end - start + 1
+            total += length
+            report.append(name + '\t' + str(start) + '\t' + str(end) + '\t' + str(length) + '\t'\
+                          + str(length - 1) + '\t1\t0\t' + '%.1f' % (100 * (length - 1) / length)\
+                          + '\n')
+        report.append('Total\tN/A\tN/A\t' + str(total) + '\t' + str(total - 3) + '\t3\t0\t'\
+                      + '%.1f' % (100 * (total - 3) / total) + '\n\n'\
+                      'Effective search space used: 12345\n\n\n')
+    return ''.join(report), records
+
+
+#-------------------------------------------------------------------------------
+def synthetic_fastq (rng, read_count, read_length):
+    '''
+    returns FASTQ text (bytes) of reads whose quality scores drift down along
+      the read, with some shorter (trimmed) reads and a few empty ones
+    1st argument--random.Random instance
+    2nd argument--number of reads
+    3rd argument--read length
+    '''
+    # the quality strings are drawn from a set of profiles (generated once)
+    profiles = [''.join(chr(33 + max(2, min(41, 38 - cycle * 10 // read_length\
+                                              + rng.randint(-6, 3)))) for cycle in range(read_length))\
+                for _ in range(64)]
+    records = []
+    for read in range(read_count):
+        draw = rng.random()
+        length = read_length if draw < 0.9 else rng.randint(read_length // 2, read_length)\
+                 if draw < 0.995 else 0
+        records.append('@R' + str(read + 1) + ' 1:N:0:1\n' + ''.join(rng.choices('ACGT', k=length))\
+                       + '\n+\n' + rng.choice(profiles)[:length] + '\n')
+    return ''.join(records).encode('ascii')
+
+
+#-------------------------------------------------------------------------------
+def consensus_benchmark (consensus_generator, offset_range):
+    '''
+    returns the benchmark function for a consensus_generator over a MIG set
+    '''
+    def run (data, args):
+        for _, seqs in data['migs']:
+            consensus_generator(seqs, args.half_seed_length, offset_range,\
+                                args.max_mismatch_count, 0, args.engine)
+        return len(data['migs'])
+    return run
+
+
+#-------------------------------------------------------------------------------
+def stream_benchmark (data, args):
+    '''
+    streaming consensus (consensus_stream.py) with the seed sampled from a
+      quarter of each MIG
+    '''
+    for _, seqs in data['migs']:
+        consensus_stream.streaming_consensus(iter(seqs), args.half_seed_length,\
+            range(-args.offset_range, args.offset_range + 1), args.max_mismatch_count,\
+            max(2, len(seqs) // 4), True, args.engine)
+    return len(data['migs'])
+
+
+#-------------------------------------------------------------------------------
+def check_stream_sample (rng, args):
+    '''
+    exits with an error unless the streaming consensus of a MIG whose sampled
+      reads are all too short for a seed matches the in-memory consensus (the
+      seed has to come from the reads past the sample)
+    '''
+    mig = synthetic_migs(rng, 1, 6, args.read_length, args.error_rate, args.max_offset)[0][1]
+    short_reads = [mig[0][:args.half_seed_length], mig[1][:args.half_seed_length]]
+    seed_offsets = range(-args.offset_range, args.offset_range + 1)
+    expected = consensus_stream.streaming_consensus(short_reads + mig, args.half_seed_length,\
+        seed_offsets, args.max_mismatch_count, len(mig) + 2, True, args.engine)
+    result = consensus_stream.streaming_consensus(short_reads + mig, args.half_seed_length,\
+        seed_offsets, args.max_mismatch_count, 2, True, args.engine)
+    if result != expected:
+        sys.exit('Error: the streaming consensus differs when the sampled reads are too short.')
+    if consensus_stream.streaming_consensus(short_reads, args.half_seed_length, seed_offsets,\
+            args.max_mismatch_count, 1, True, args.engine) is not None:
+        sys.exit('Error: the streaming consensus of a MIG of short reads is not empty.')
+
+
+#-------------------------------------------------------------------------------
+def parse_benchmark (data, args):
+    '''
+    parse_igblast_block for every block of the report (via read_igblast_records)
+    '''
+    count = 0
+    for _ in data['harvester'].read_igblast_records(io.StringIO(data['report'])):
+        count += 1
+    return count
+
+
+#-------------------------------------------------------------------------------
+def compose_benchmark (data, args):
+    '''
+    compose_fasta_block for every query, with an empty translation cache
+    '''
+    harvester = data['harvester']
+    harvester.annotation_cache.cache_clear()
+    for record, igblast_data in zip(data['records'], data['parsed']):
+        igblast_data.cdr3_aa = data['cdr3_aa'][igblast_data.query]
+        harvester.compose_fasta_block(record, igblast_data)
+    return len(data['records'])
+
+
+#-------------------------------------------------------------------------------
+def translate_benchmark (data, args):
+    '''
+    translate and translate_frames for every query sequence
+    '''
+    for record in data['records']:
+        translator.translate(record.seq)
+        translator.translate_frames(record.seq)
+    return len(data['records'])
+
+
+#-------------------------------------------------------------------------------
+def quality_benchmark (data, args):
+    '''
+    QualityProfile.add_lines over the reads, in blocks as read from a file
+    '''
+    profile = quality_profile.QualityProfile('synthetic.fastq')
+    fastq = data['fastq']
+    start = 0
+    while start < len(fastq):
+        cut = fastq.rfind(b'\n', start, start + quality_profile.CHUNK_BYTES) + 1
+        profile.add_lines(fastq[start:cut])
+        start = cut
+    return profile.reads()
+
+
+# name -> (function, unit, input set)
+BENCHMARKS = {
+    'fasta_consensus'  : (None, 'MIGs/s', 'migs'),
+    'fastq_consensus'  : (None, 'MIGs/s', 'migs'),
+    'stream_consensus' : (stream_benchmark, 'MIGs/s', 'migs'),
+    'parse_igblast'    : (parse_benchmark, 'queries/s', 'igblast'),
+    'compose_fasta'    : (compose_benchmark, 'queries/s', 'igblast'),
+    'translate'        : (translate_benchmark, 'queries/s', 'igblast'),
+    'quality_profile'  : (quality_benchmark, 'reads/s', 'fastq'),
+}
+
+#-------------------------------------------------------------------------------
+def prepare_inputs (args, names):
+    '''
+    returns the dictionary of seeded inputs (and loaded scripts) for the benchmarks
+    1st argument--parsed commandline arguments
+    2nd argument--names of the benchmarks to run
+    '''
+    data = {}
+    input_sets = {BENCHMARKS[name][2] for name in names}
+    if 'migs' in input_sets:
+        data['migs'] = synthetic_migs(random.Random(args.seed), args.migs, args.mig_size,\
+                                      args.read_length, args.error_rate, args.max_offset)
+        if 'stream_consensus' in names:
+            check_stream_sample(random.Random(args.seed + 3), args)
+        fasta_script = load_script('fasta_barcode_consensus.py')
+        fastq_script = load_script('fastq_barcode_consensus.py')
+        BENCHMARKS['fasta_consensus'] = (consensus_benchmark(\
+            fasta_script.consensus_generator, args.offset_range),) + BENCHMARKS['fasta_consensus'][1:]
+        BENCHMARKS['fastq_consensus'] = (consensus_benchmark(\
+            fastq_script.consensus_generator, 2 * args.offset_range),) + BENCHMARKS['fastq_consensus'][1:]
+    if 'igblast' in input_sets:
+        data['harvester'] = load_script('igblast-out_harvester.py')
+        data['report'], data['records'] = synthetic_igblast(random.Random(args.seed + 1),\
+            args.queries, args.read_length, args.error_rate)
+        data['parsed'] = [igblast_data for igblast_data in\
+                          data['harvester'].read_igblast_records(io.StringIO(data['report']))]
+        # compose_fasta_block replaces cdr3_aa with its context; restored before each run
+        data['cdr3_aa'] = {igblast_data.query : igblast_data.cdr3_aa for igblast_data in data['parsed']}
+    if 'fastq' in input_sets: # as many reads as 10 queries
+        data['fastq'] = synthetic_fastq(random.Random(args.seed + 2), 10 * args.queries,\
+                                        args.read_length)
+    return data
+
+
+#-------------------------------------------------------------------------------
+def measure (name, data, args):
+    '''
+    returns {'items', 'rate', 'peak_kib'} for a benchmark: the best rate of the
+      timed repeats, and the peak traced memory of one more run
+    '''
+    func = BENCHMARKS[name][0]
+    best = None
+    items = 0
+    for _ in range(args.repeat):
+        gc.collect()
+        start = time.perf_counter()
+        items = func(data, args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+
+    gc.collect()
+    tracemalloc.start()
+    func(data, args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'items' : items, 'rate' : items / best, 'peak_kib' : peak // 1024}
+
+
+#-------------------------------------------------------------------------------
+def input_params (args):
+    '''
+    returns the parameters that have to match between a run and its baseline
+    '''
+    return {key : getattr(args, key) for key in ('seed', 'migs', 'mig_size', 'read_length',\
+            'error_rate', 'max_offset', 'queries', 'half_seed_length', 'offset_range',\
+            'max_mismatch_count', 'engine')}
+
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline micro-benchmarks of the pipeline'\
+                                     + ' hot paths, checked against stored baselines')
+    parser.add_argument('names', nargs='*', metavar='name',\
+                        help='Benchmarks to run (default is all: ' + ', '.join(BENCHMARKS) + ')')
+    parser.add_argument('--seed', nargs='?', type=int, default=1,\
+                        help='Random seed for the synthetic inputs (default is 1)')
+    parser.add_argument('--migs', nargs='?', type=int, default=300,\
+                        help='Number of MIGs (default is 300)')
+    parser.add_argument('--mig_size', nargs='?', type=int, default=20,\
+                        help='Mean number of reads per MIG (default is 20)')
+    parser.add_argument('--read_length', nargs='?', type=int, default=350,\
+                        help='Read and query length (default is 350)')
+    parser.add_argument('--error_rate', nargs='?', type=float, default=0.01,\
+                        help='Substitution rate per base (default is 0.01)')
+    parser.add_argument('--max_offset', nargs='?', type=int, default=4,\
+                        help='Maximal start/end offset of the reads of a MIG (default is 4)')
+    parser.add_argument('--queries', nargs='?', type=int, default=3000,\
+                        help='Number of IgBLAST queries (default is 3000)')
+    parser.add_argument('-H', '--half_seed_length', nargs='?', type=int, default=10,\
+                        help='Number of bases in the half-seed (default is 10)')
+    parser.add_argument('-O', '--offset_range', nargs='?', type=int, default=5,\
+                        help='Seed offsets checked in both directions (default is 5; the FASTQ'\
+                            + ' consensus checks twice as many from the left end)')
+    parser.add_argument('-M', '--max_mismatch_count', nargs='?', type=int, default=3,\
+                        help='Number of mismatches to tolerate (default is 3)')
+    parser.add_argument('--engine', choices=consensus_pfm.ENGINES,\
+                        default=consensus_pfm.DEFAULT_ENGINE,\
+                        help='Position frequency matrix engine (default is '\
+                            + consensus_pfm.DEFAULT_ENGINE + ')')
+    parser.add_argument('-r', '--repeat', nargs='?', type=int, default=3,\
+                        help='Timed runs per benchmark; the best one counts (default is 3)')
+    parser.add_argument('-t', '--threshold', nargs='?', type=float, default=0.25,\
+                        help='Tolerated fraction of rate loss or memory growth relative to the'\
+                            + ' baseline (default is 0.25)')
+    parser.add_argument('-b', '--baseline', nargs='?', type=str, default=BASELINE,\
+                        help='Baseline JSON file (default is baseline.<host>.json next to this'\
+                            + ' script)')
+    parser.add_argument('--save', help='store the results as the baseline instead of comparing',\
+                        action='store_true')
+    args = parser.parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit('Error: unknown benchmark(s): ' + ', '.join(unknown))
+    data = prepare_inputs(args, names)
+
+    baseline = None
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+        if baseline.get('params') != input_params(args):
+            sys.exit('Error: the baseline in ' + args.baseline + ' was measured with other'\
+                     + ' parameters: ' + json.dumps(baseline.get('params')))
+    elif not args.save:
+        print('# no baseline in ' + args.baseline + ' (store one for this host with --save)')
+
+    results = {}
+    regressions = []
+    print('# benchmark\titems\trate\tunit\tpeak_KiB\tbaseline_rate\tbaseline_KiB\tstatus')
+    for name in names:
+        result = results[name] = measure(name, data, args)
+        line = [name, str(result['items']), '%.1f' % result['rate'], BENCHMARKS[name][1],\
+                str(result['peak_kib'])]
+        reference = baseline['results'].get(name) if baseline else None
+        if reference is None:
+            line += ['-', '-', 'new' if baseline else 'measured']
+        else:
+            status = []
+            if result['rate'] < reference['rate'] * (1 - args.threshold):
+                status.append('slower by %.0f%%' % (100 - 100 * result['rate'] / reference['rate']))
+            if result['peak_kib'] > reference['peak_kib'] * (1 + args.threshold):
+                status.append('memory up by %.0f%%' %\
+                              (100 * result['peak_kib'] / reference['peak_kib'] - 100))
+            if status:
+                regressions.append(name + ' (' + ', '.join(status) + ')')
+            line += ['%.1f' % reference['rate'], str(reference['peak_kib']),\
+                     ', '.join(status) if status else 'ok']
+        print('\t'.join(line), flush=True)
+
+    if args.save:
+        stored = {'params' : input_params(args), 'results' : {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as handle:
+                previous = json.load(handle)
+            if previous.get('params') == stored['params']:
+                stored['results'] = previous['results']
+        stored['results'].update(results)
+        with open(args.baseline, 'w') as handle:
+            json.dump(stored, handle, indent=2, sort_keys=True)
+            handle.write('\n')
+        print('# baseline saved to ' + args.baseline)
+    elif regressions:
+        sys.exit('Error: regressions beyond the ' + '%g' % (100 * args.threshold) + '% threshold: '\
+                 + '; '.join(regressions))
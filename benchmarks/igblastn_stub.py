@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+'''
+igblastn_stub.py
+  Stand-in for igblastn that replays canned IgBLAST output, for testing
+  igblast_scheduler.py and the igblast step without IgBLAST and its
+  databases. The canned output (verbose report or AIRR tabular, from a real
+  run over the same sequences) is named by IGBLASTN_STUB_OUTPUT; the blocks of
+  the -query sequences are written to -out in the query order, with the
+  report header and footer. IGBLASTN_STUB_SECONDS (per query) makes the runs
+  take time, and a -query filename ending in IGBLASTN_STUB_FAIL fails after
+  writing part of the output. The other igblastn options are ignored, e.g.:
+    IGBLASTN_STUB_OUTPUT=sample.igblast_out python3 pipeline/igblast_scheduler.py \
+      input.fasta --prefix sample -- python3 benchmarks/igblastn_stub.py -organism mouse
+'''
+
+import sys
+import os
+import time
+
+
+#-------------------------------------------------------------------------------
+def canned_blocks (filename):
+    '''
+    returns the header, the query blocks by query ID and the footer of the
+      canned IgBLAST output
+    1st argument--verbose report or AIRR tabular filename
+    '''
+    with open(filename) as handle:
+        text = handle.read()
+
+    if text.startswith('sequence_id\t'):
+        header, _, rows = text.partition('\n')
+        blocks = {row.split('\t', 1)[0] : row + '\n' for row in rows.split('\n') if row.strip()}
+        return header + '\n', blocks, ''
+
+    parts = text.split('\nQuery= ')
+    header = parts[0] + '\n'
+    footer = ''
+    if len(parts) > 1:
+        last_block, separator, footer = parts[-1].partition('\n  Database: ')
+        parts[-1] = last_block + '\n'
+        footer = separator[1:] + footer if separator else ''
+    blocks = {}
+    for part in parts[1:]:
+        blocks[part.split(None, 1)[0]] = 'Query= ' + part + ('' if part.endswith('\n') else '\n')
+    return header, blocks, footer
+
+
+#-------------------------------------------------------------------------------
+def query_ids (filename):
+    '''
+    returns the array of the sequence IDs of a FASTA file (up to the first whitespace)
+    '''
+    with open(filename) as handle:
+        return [line[1:].split(None, 1)[0] for line in handle if line.startswith('>')]
+
+
+#-------------------------------------------------------------------------------
+#### main section
+if __name__ == '__main__':
+    if '-version' in sys.argv:
+        print('igblastn: stub (replays canned output)\nPackage: igblast stub')
+        sys.exit()
+
+    options = {}
+    for option, value in zip(sys.argv[1:], sys.argv[2:]):
+        if option in ('-query', '-out'):
+            options[option] = value
+    if len(options) < 2:
+        sys.exit('Error: expecting the -query and -out filenames.')
+    if 'IGBLASTN_STUB_OUTPUT' not in os.environ:
+        sys.exit('Error: IGBLASTN_STUB_OUTPUT does not name the canned IgBLAST output.')
+
+    header, blocks, footer = canned_blocks(os.environ['IGBLASTN_STUB_OUTPUT'])
+    delay = float(os.environ.get('IGBLASTN_STUB_SECONDS', 0))
+    fail = os.environ.get('IGBLASTN_STUB_FAIL')
+    with open(options['-out'], 'w') as output:
+        output.write(header)
+        for ind, query_id in enumerate(query_ids(options['-query'])):
+            if query_id not in blocks:
+                sys.exit('Error: query ' + query_id + ' is not in the canned output.')
+            if fail and options['-query'].endswith(fail) and ind:
+                sys.exit('Error: stub failure requested for ' + options['-query'] + '.')
+            output.write(blocks[query_id])
+            time.sleep(delay)
+        output.write(footer)
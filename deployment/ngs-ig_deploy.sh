@@ -24,15 +24,17 @@ virtualenv $DEPS/cutadapt
 $DEPS/cutadapt/bin/pip install cutadapt |tee -a $DEPS/cutadapt_install.log
 echo "### Done."
 
+echo "### Installing NumPy for the pipeline scripts using pip ..."
+pip3 install numpy |tee -a $DEPS/numpy_install.log
+echo "### Done."
+
 # R package setup section
 echo  "### Installing R packages ..."
 # needed packages:
-# dada2
 # optparse
 # here
 # ggplot2
 
 R -e 'install.packages(c("here","optparse","ggplot2","BiocManager","png","jpeg","reshape2","latticeExtra","matrixStats","bitops","Rcpp","RcppParallel","RCurl","hwriter"))' |tee -a $DEPS/Rpackages_install.log
-R -e 'BiocManager::install("dada2")'  |tee -a $DEPS/Rpackages_install.log
 
 R CMD INSTALL -l /usr/local/lib/R/site-library $ARCH/Rpackages/* |tee -a $DEPS/Rpackages_install.log
@@ -0,0 +1,376 @@
+'''
+annotation_table.py
+  Columnar export of the harvested IgBLAST annotations, written by
+  igblast-out_harvester.py (--table) in the same pass as the annotated FASTA:
+  one typed column per annotation field instead of the key:value fields of
+  the FASTA headers. The table is an uncompressed Arrow IPC (Feather v2) file
+  when pyarrow is available; otherwise it is an uncompressed NumPy .npz
+  archive, with each string column stored as its UTF-8 bytes and the offsets
+  of the values (as in Arrow). Either way load_table memory-maps the columns
+  instead of parsing text, and returns them as NumPy arrays and StringColumns
+  whatever the format. A Parquet table (compressed, for exchange; decoded
+  into memory when loaded) is written for a filename ending in .parquet.
+  Usage:
+    columns = annotation_table.load_table('sample.igblast.table.arrow')
+    productive = columns['category'] >= 2
+'''
+
+import sys
+import bisect
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# column name, type ('str' or a NumPy dtype); see igblast-out_harvester.py table_row
+COLUMNS = (
+    ('query_id',     'str'),     # FASTA header up to the first whitespace
+    ('mig_size',     'int32'),   # size= of a MIG consensus (0 otherwise)
+    ('retained',     'int32'),   # reads behind the record (retained=, size=, otherwise 1)
+    ('v_call',       'str'),
+    ('d_call',       'str'),
+    ('j_call',       'str'),
+    ('chain_type',   'str'),     # VH, VK, VL, ... ('' for invalid queries)
+    ('productive',   'int8'),    # 1 (Yes), 0 (No), -1 (N/A)
+    ('vj_frame',     'str'),     # In-frame, Out-of-frame, N/A
+    ('reversed',     'int8'),    # 1 if IgBLAST aligned the reverse complement
+    ('trunc_flags',  'uint8'),   # bit i set if region i is absent: FR1, CDR1, FR2, CDR2, FR3, CDR3, J
+    ('trunc_label',  'str'),     # Vintact, Vtruncated.xxxxxxx, Jtruncated.xxxxxxx
+    ('frame',        'int8'),    # reading frame (1-3, 0 if unknown)
+    ('pcov',         'float32'), # percent of the query covered by the V alignment
+    ('pid',          'float32'), # percent identity to the top V gene
+    ('junction_nt',  'str'),
+    ('junction_aa',  'str'),
+    ('cdr3_nt',      'str'),
+    ('cdr3_aa',      'str'),
+    ('cdr3_start',   'int32'),
+    ('cdr3_end',     'int32'),
+    ('translation',  'str'),
+    ('category',     'int8'),    # filter category (0 stop_cdr3 ... 4 scrub; -1 without the filter)
+)
+ROW_GROUP_ROWS = 65536 # rows buffered before they are written out
+
+
+#-------------------------------------------------------------------------------
+def table_filename (filename):
+    '''
+    returns the table filename: a name without an .arrow, .parquet or .npz
+      extension gets the extension of the memory-mapped format available
+      (Arrow IPC with pyarrow)
+    '''
+    if filename.endswith(('.arrow', '.parquet', '.npz')):
+        return filename
+    return filename + ('.arrow' if pyarrow is not None else '.npz')
+
+
+class StringColumn:
+    '''
+    Memory-mapped string column of an .npz table: the UTF-8 bytes of all the
+      values and the n+1 offsets of the values in them.
+    '''
+
+    def __init__(self, data, offsets):
+        self.data    = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        return bytes(self.data[self.offsets[index]:self.offsets[index + 1]]).decode('utf8')
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+
+class ChunkedStringColumn:
+    '''
+    String column of an Arrow table (one StringColumn per record batch, on the
+      buffers of the batch).
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.starts = [0]
+        for chunk in chunks:
+            self.starts.append(self.starts[-1] + len(chunk))
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('string column index out of range')
+        chunk = bisect.bisect_right(self.starts, index) - 1
+        return self.chunks[chunk][index - self.starts[chunk]]
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+
+class TableWriter:
+    '''
+    Write the annotation rows (tuples in the order of COLUMNS) to an Arrow IPC,
+      Parquet or .npz table (see table_filename), ROW_GROUP_ROWS at a time; the
+      Parquet row groups are written out as they come, while the columns of the
+      Arrow IPC and .npz tables are spilled to temporary files and assembled
+      when the table is closed (into one record batch for Arrow IPC, so that
+      every column loads as one memory-mapped array).
+    '''
+
+    def __init__(self, filename):
+        self.filename = table_filename(filename)
+        self.rows     = []
+        self.writer   = None
+        self.spill    = None
+        if self.filename.endswith(('.arrow', '.parquet')):
+            if pyarrow is None:
+                sys.exit('Error: writing ' + self.filename + ' requires pyarrow.')
+            # the spilled string offsets are 64-bit (large_string in Arrow)
+            string_type = pyarrow.string() if self.filename.endswith('.parquet')\
+                else pyarrow.large_string()
+            self.schema = pyarrow.schema([(name, string_type if kind == 'str' else kind)\
+                                          for name, kind in COLUMNS])
+            if self.filename.endswith('.parquet'):
+                self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+        if self.writer is None:
+            if np is None:
+                sys.exit('Error: writing ' + self.filename + ' requires NumPy.')
+            self.spill = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(self.filename)))
+            self.spill_files = {name : open(os.path.join(self.spill.name, name), 'wb')\
+                                for name, kind in COLUMNS}
+            self.offset_files = {name : open(os.path.join(self.spill.name, name + '.offsets'), 'wb')\
+                                 for name, kind in COLUMNS if kind == 'str'}
+            for handle in self.offset_files.values():
+                handle.write(np.zeros(1, dtype=np.int64).tobytes())
+            self.string_bytes = dict.fromkeys(self.offset_files, 0)
+            self.row_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= ROW_GROUP_ROWS:
+            self.flush()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def flush(self):
+        '''
+        write out the buffered rows
+        '''
+        if not self.rows:
+            return
+        values = list(zip(*self.rows))
+        if self.writer is not None:
+            self.writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column,\
+                type=self.schema.field(name).type) for (name, kind), column\
+                in zip(COLUMNS, values)], schema=self.schema))
+        else:
+            for (name, kind), column in zip(COLUMNS, values):
+                if kind != 'str':
+                    self.spill_files[name].write(np.asarray(column, dtype=kind).tobytes())
+                    continue
+                encoded = [value.encode('utf8') for value in column]
+                ends = np.cumsum([len(value) for value in encoded], dtype=np.int64)
+                self.offset_files[name].write((ends + self.string_bytes[name]).tobytes())
+                self.string_bytes[name] += int(ends[-1])
+                self.spill_files[name].write(b''.join(encoded))
+            self.row_count += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        '''
+        write out the remaining rows and complete the table
+        '''
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            return
+        for handle in list(self.spill_files.values()) + list(self.offset_files.values()):
+            handle.close()
+        if self.filename.endswith('.arrow'):
+            self.write_arrow()
+        else:
+            self.write_npz()
+        os.replace(self.filename + '.tmp', self.filename)
+        self.spill.cleanup()
+
+    def spill_buffer(self, name, maps):
+        '''
+        returns the pyarrow buffer of a spill file, memory-mapped (the map is
+          added to the array of maps)
+        '''
+        filename = os.path.join(self.spill.name, name)
+        if not os.path.getsize(filename):
+            return pyarrow.py_buffer(b'')
+        maps.append(pyarrow.memory_map(filename))
+        return maps[-1].read_buffer()
+
+    def write_arrow(self):
+        '''
+        assemble the spilled columns into one record batch of an Arrow IPC file
+        '''
+        maps = []
+        arrays = []
+        for (name, kind), field in zip(COLUMNS, self.schema):
+            if kind == 'str':
+                buffers = [None, self.spill_buffer(name + '.offsets', maps),\
+                           self.spill_buffer(name, maps)]
+            else:
+                buffers = [None, self.spill_buffer(name, maps)]
+            arrays.append(pyarrow.Array.from_buffers(field.type, self.row_count, buffers))
+        with pyarrow.ipc.new_file(self.filename + '.tmp', self.schema) as writer:
+            writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+        del arrays
+        for spill_map in maps:
+            spill_map.close()
+
+    def write_npz(self):
+        '''
+        assemble the spilled columns into the members of an uncompressed .npz archive
+        '''
+        # npz members: "<column>.npy", plus "<column>.offsets.npy" for the string columns
+        members = []
+        for name, kind in COLUMNS:
+            if kind == 'str':
+                members.append((name, np.dtype(np.uint8), self.string_bytes[name]))
+                members.append((name + '.offsets', np.dtype(np.int64), self.row_count + 1))
+            else:
+                members.append((name, np.dtype(kind), self.row_count))
+        with zipfile.ZipFile(self.filename + '.tmp', 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name, dtype, length in members:
+                with archive.open(name + '.npy', 'w', force_zip64=True) as member:
+                    np.lib.format.write_array_header_1_0(member, {'descr' :\
+                        np.lib.format.dtype_to_descr(dtype), 'fortran_order' : False,\
+                        'shape' : (length,)})
+                    with open(os.path.join(self.spill.name, name), 'rb') as spill_file:
+                        shutil.copyfileobj(spill_file, member, 1 << 20)
+
+    def discard(self):
+        '''
+        drop the table (e.g., after an error)
+        '''
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            for handle in list(self.spill_files.values()) + list(self.offset_files.values()):
+                handle.close()
+            self.spill.cleanup()
+
+
+#-------------------------------------------------------------------------------
+def load_npz_arrays (filename):
+    '''
+    returns the dictionary of the arrays of an uncompressed .npz archive, each
+      memory-mapped from the archive (compressed members are read into memory)
+    1st argument--.npz filename
+    '''
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as handle:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            # the member data follow its local file header (30 bytes, name and extra field)
+            handle.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', handle.read(4))
+            handle.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(handle)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(handle)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(handle)
+            if not np.prod(shape):
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(filename, dtype=dtype, mode='r', offset=handle.tell(),\
+                                     shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+
+#-------------------------------------------------------------------------------
+def arrow_column (column, kind):
+    '''
+    returns a column of a pyarrow table as a NumPy array (on the buffer of a
+      single record batch, otherwise concatenated) or a ChunkedStringColumn (on
+      the buffers of the record batches)
+    1st argument--pyarrow ChunkedArray
+    2nd argument--column type (see COLUMNS)
+    '''
+    if kind != 'str':
+        if column.num_chunks == 1:
+            return column.chunk(0).to_numpy(zero_copy_only=True)
+        return column.to_numpy()
+    chunks = []
+    for chunk in column.chunks:
+        validity, offsets, data = chunk.buffers()
+        offset_type = np.int64 if pyarrow.types.is_large_string(chunk.type) else np.int32
+        chunks.append(StringColumn(np.frombuffer(data, dtype=np.uint8) if data is not None\
+                                   else np.empty(0, dtype=np.uint8),\
+                                   np.frombuffer(offsets, dtype=offset_type)\
+                                   [chunk.offset:chunk.offset + len(chunk) + 1]))
+    return ChunkedStringColumn(chunks)
+
+
+#-------------------------------------------------------------------------------
+def load_table (filename):
+    '''
+    returns the dictionary of the columns of an annotation table, NumPy arrays
+      and string columns (StringColumn or ChunkedStringColumn) in every format:
+      memory-mapped for an .npz or Arrow IPC table, decoded into memory for a
+      Parquet table (its numeric columns concatenated across the row groups)
+    1st argument--table filename
+    '''
+    if np is None:
+        sys.exit('Error: reading ' + filename + ' requires NumPy.')
+    if filename.endswith(('.arrow', '.parquet')):
+        if pyarrow is None:
+            sys.exit('Error: reading ' + filename + ' requires pyarrow.')
+        if filename.endswith('.parquet'):
+            table = pyarrow.parquet.read_table(filename)
+        else:
+            table = pyarrow.ipc.open_file(pyarrow.memory_map(filename)).read_all()
+        columns = {}
+        for name, kind in COLUMNS:
+            if name not in table.column_names:
+                sys.exit('Error: column ' + name + ' is missing from ' + filename + '.')
+            columns[name] = arrow_column(table.column(name), kind)
+        return columns
+
+    arrays = load_npz_arrays(filename)
+    columns = {}
+    for name, kind in COLUMNS:
+        if name not in arrays:
+            sys.exit('Error: column ' + name + ' is missing from ' + filename + '.')
+        columns[name] = StringColumn(arrays[name], arrays[name + '.offsets'])\
+            if kind == 'str' else arrays[name]
+    return columns
@@ -0,0 +1,278 @@
+'''
+batch_runner.py
+  Batch driver for the datasets of a sequencing run (e.g., all the library
+  directories of a date directory). The stages of each dataset are run by its
+  stage_runner.py (so the stage cache applies), as a chain of jobs; the jobs of
+  all the datasets share one budget of cores and memory. The parallel stages
+  (UMI consensus, igblastn, harvesting, hinge BLAST) get a share of the cores,
+  passed on through the worker variables of ngs-ig_pipeline_alias.sh, so that
+  several datasets reaching igblast together do not oversubscribe the machine
+  (the preparation job likewise runs FLASH and the quality profiles on its share);
+  the jobs of the deepest datasets (largest input) are started first, while
+  the smaller datasets run alongside on the remaining cores. The output of
+  each dataset goes to its run.log. With --service, the consensus and
+  harvester jobs of all the datasets are run by one worker_service.py.
+  Usage:
+    python3 scripts/batch_runner.py 20200826 [--cores 32] [--memory 64] [--service]
+'''
+
+import sys
+import argparse
+import glob
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+SCRDIR = os.path.dirname(os.path.abspath(__file__))
+POLL_SECONDS = 1
+
+# stage_runner.py jobs of a dataset, in order: (stages, worker variables set to
+#   the cores of the job); jobs without worker variables get one core, and the
+#   last job (no stages listed) runs the remaining stages and finishes the run
+JOBS = (
+    (('adapters', 'quality', 'flash', 'cutadapt'), ('FLASH_numthreads', 'QUALITY_numworkers')),
+    (('fastx',), ('CONSENSUS_numworkers', 'FLASH_numthreads')),
+    (('igblast',), ('IGBLAST_numthreads',)),
+    (('harvest',), ('HARVEST_numworkers',)),
+    ((), ('BLAST_numthreads',)),
+)
+
+
+class Dataset:
+    '''
+    A dataset directory of the batch and the state of its chain of jobs.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.name      = os.path.basename(directory)
+        self.size      = sum(os.path.getsize(filename) for filename\
+                             in glob.glob(os.path.join(directory, 'input', '*.fastq.gz')))
+        self.job       = 0     # index of the next (or running) job in JOBS
+        self.process   = None
+        self.cores     = 0
+        self.failed    = False
+        self.held      = False # the next job waits for memory (reported once)
+
+    def in_progress(self):
+        return not self.failed and self.job < len(JOBS)
+
+    def job_name(self):
+        return ' '.join(JOBS[self.job][0]) or 'finish'
+
+
+#-------------------------------------------------------------------------------
+def find_datasets (paths):
+    '''
+    returns the array of the dataset directories named by the paths
+    1st argument--array of date directories, dataset directories or
+      SampleManifest.txt files
+    '''
+    directories = []
+    for path in paths:
+        if os.path.isfile(path):
+            path = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(path):
+            sys.exit('Error: ' + path + ' was not found!')
+        if os.path.isdir(os.path.join(path, 'input')):
+            directories.append(os.path.abspath(path))
+            continue
+        found = sorted(os.path.abspath(os.path.dirname(directory))\
+                       for directory in glob.glob(os.path.join(glob.escape(path), '*', 'input')))
+        if not found:
+            sys.exit('Error: no dataset directory (with an input subdirectory) in ' + path + '.')
+        directories.extend(found)
+    return list(dict.fromkeys(directories))
+
+
+#-------------------------------------------------------------------------------
+def prepare_scripts (directory):
+    '''
+    provide a dataset directory without its own scripts with a copy of this
+      pipeline (as execute.sh does in the container)
+    '''
+    scripts = os.path.join(directory, 'scripts')
+    if not os.path.isdir(scripts):
+        print('No scripts directory provided for ' + os.path.basename(directory)\
+              + '. Using the pipeline in ' + SCRDIR + '.')
+        shutil.copytree(SCRDIR, scripts, ignore=shutil.ignore_patterns('__pycache__'))
+
+
+#-------------------------------------------------------------------------------
+def available_memory ():
+    '''
+    returns the available memory in GB (None if it cannot be determined): the
+      MemAvailable of /proc/meminfo, which counts the reclaimable page cache, or
+      else the free memory
+    '''
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / (1 << 20)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / (1 << 30)
+    except (ValueError, OSError):
+        return None
+
+
+#-------------------------------------------------------------------------------
+def start_service (directory):
+    '''
+    start worker_service.py on a socket in a directory; returns the service
+      process once it listens, with the socket filename set in WORKER_SOCKET
+      (inherited by the jobs)
+    '''
+    path = os.path.join(directory, 'worker.sock')
+    service = subprocess.Popen([sys.executable, os.path.join(SCRDIR, 'worker_service.py'),\
+                                '--socket', path])
+    while not os.path.exists(path):
+        if service.poll() is not None:
+            sys.exit('Error: the worker service did not start.')
+        time.sleep(0.1)
+    os.environ['WORKER_SOCKET'] = path
+    return service
+
+
+#-------------------------------------------------------------------------------
+def start_job (dataset, cores):
+    '''
+    start the next job of a dataset, with the output appended to its run.log
+    1st argument--Dataset
+    2nd argument--number of cores of the job
+    '''
+    stages, variables = JOBS[dataset.job]
+    env = dict(os.environ)
+    for variable in variables:
+        env[variable] = str(cores)
+    command = [sys.executable, os.path.join(dataset.directory, 'scripts', 'stage_runner.py')]
+    if stages:
+        command += ['--stages'] + list(stages)
+    with open(os.path.join(dataset.directory, 'run.log'), 'a') as log:
+        dataset.process = subprocess.Popen(command, cwd=dataset.directory, env=env,\
+                                           stdout=log, stderr=subprocess.STDOUT)
+    dataset.cores = cores
+    print('[' + time.strftime('%H:%M:%S%Z') + ']...Started ' + dataset.job_name() + ' for '\
+          + dataset.name + ' on ' + str(cores) + ' core(s).', flush=True)
+
+
+#-------------------------------------------------------------------------------
+def run_batch (datasets, cores, memory, worker_memory):
+    '''
+    run the chains of jobs of the datasets within the budget; returns the array
+      of the datasets with a failed job
+    1st argument--array of Datasets
+    2nd argument--number of cores
+    3rd argument--memory in GB (None for no limit)
+    4th argument--memory per worker (core) in GB
+    '''
+    running = []
+    try:
+        while True:
+            pending = [dataset for dataset in datasets if dataset.in_progress()]
+            if not pending:
+                return [dataset for dataset in datasets if dataset.failed]
+
+            # the parallel jobs get an even share of the cores among the datasets
+            #   still in progress (rounded up: the deepest datasets come first and
+            #   the others take what is left)
+            share = -(-cores // len(pending))
+            for dataset in sorted(pending, key=lambda dataset: dataset.size, reverse=True):
+                if dataset.process is not None:
+                    continue
+                free = cores - sum(job.cores for job in running)
+                wanted = min(share if JOBS[dataset.job][1] else 1, free)
+                job_cores = wanted
+                if memory is not None:
+                    job_cores = min(job_cores, int((memory - worker_memory\
+                                    * sum(job.cores for job in running)) // worker_memory))
+                if job_cores < 1:
+                    if running:
+                        if wanted >= 1 and not dataset.held:
+                            print('[' + time.strftime('%H:%M:%S%Z') + ']...' + dataset.job_name()\
+                                  + ' for ' + dataset.name + ' waits for the memory budget.',\
+                                  flush=True)
+                            dataset.held = True
+                        break
+                    job_cores = 1 # a job beyond the budget runs on its own
+                if job_cores < wanted:
+                    print('[' + time.strftime('%H:%M:%S%Z') + ']...The memory budget limits '\
+                          + dataset.job_name() + ' for ' + dataset.name + ' to ' + str(job_cores)\
+                          + ' of ' + str(wanted) + ' core(s).', flush=True)
+                start_job(dataset, job_cores)
+                dataset.held = False
+                running.append(dataset)
+
+            time.sleep(POLL_SECONDS)
+            for dataset in list(running):
+                status = dataset.process.poll()
+                if status is None:
+                    continue
+                running.remove(dataset)
+                if status != 0:
+                    dataset.failed = True
+                    print('Error: ' + dataset.job_name() + ' did not complete for ' + dataset.name\
+                          + ' (exit status ' + str(status) + '); see its run.log.', flush=True)
+                else:
+                    print('[' + time.strftime('%H:%M:%S%Z') + ']...Completed '\
+                          + dataset.job_name() + ' for ' + dataset.name + '.', flush=True)
+                    dataset.job += 1
+                dataset.process = None
+                dataset.cores = 0
+    finally:
+        for dataset in running:
+            dataset.process.terminate()
+        for dataset in running:
+            dataset.process.wait()
+
+
+#-------------------------------------------------------------------------------
+#### main section
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline on several datasets,'\
+        + ' sharing the cores and memory among their stages.')
+    parser.add_argument('datasets', nargs='+', type=str, \
+        help='Date directories (every dataset directory in them), dataset directories'\
+            + ' or their SampleManifest.txt files')
+    parser.add_argument('--cores', nargs='?', type=int, default=os.cpu_count(), \
+        help='Number of cores for the batch (default is the number of CPUs)')
+    parser.add_argument('--memory', nargs='?', type=float, default=available_memory(), \
+        help='Memory for the batch in GB (default is the available memory)')
+    parser.add_argument('--worker_memory', nargs='?', type=float, default=1.0, \
+        help='Memory per worker process (core) in GB (default is 1)')
+    parser.add_argument('--service', action='store_true', \
+        help='Run the consensus and harvester jobs through one worker service'\
+            + ' (worker_service.py), without a new interpreter for each')
+    parser.add_argument('--dry_run', action='store_true', \
+        help='List the datasets in the order of priority, without running them')
+    args = parser.parse_args()
+
+    if args.cores < 1 or args.worker_memory <= 0:
+        sys.exit('Error: the numbers of cores and the worker memory must be positive.')
+    datasets = sorted((Dataset(directory) for directory in find_datasets(args.datasets)),\
+                      key=lambda dataset: dataset.size, reverse=True)
+    for dataset in datasets:
+        print(dataset.name + ': ' + format(dataset.size / (1 << 20), '.1f') + ' MB of input')
+    if args.dry_run:
+        sys.exit()
+
+    for dataset in datasets:
+        prepare_scripts(dataset.directory)
+    print('Running ' + str(len(datasets)) + ' dataset(s) on ' + str(args.cores) + ' core(s)'\
+          + ('' if args.memory is None else ' and ' + format(args.memory, '.1f') + ' GB')\
+          + '.', flush=True)
+    with tempfile.TemporaryDirectory() as service_dir:
+        service = start_service(service_dir) if args.service else None
+        try:
+            failed = run_batch(datasets, args.cores, args.memory, args.worker_memory)
+        finally:
+            if service is not None:
+                service.terminate()
+                service.wait()
+    if failed:
+        sys.exit('Error: the run did not complete for ' + ', '.join(dataset.name\
+                 for dataset in failed) + '.')
@@ -0,0 +1,230 @@
+'''
+clonotypes.py
+  Streaming clonotype aggregation for the IgBLAST harvester (in place of
+  clonotype_count.pl and clonotype_annotate.pl). Clonotypes are keyed on the
+  first V and J gene calls and the CDR3aa (without the two leading and the
+  trailing residue) as the records go by, with MIG-weighted counts in a hash
+  table; the FASTA headers are not parsed again. The clonotype dictionary is
+  built from these counts, and the annotated FASTA is written in one more pass
+  over the harvested records, using the clonotype recorded for each of them.
+  Clonotype identifiers come from the same random sequence as in the Perl
+  script (srand 12345), and ties in the counts are kept in the order of
+  first appearance, so the output is reproducible.
+'''
+
+import re
+import sys
+from array import array
+
+ID_CHARS    = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+ID_LENGTH   = 5
+ID_RETRIES  = 10
+RANDOM_SEED = 12345
+NULL_CDR3   = '0null0'
+
+VJ_FAMILIES = re.compile(r'V[A-Za-z]?(\d+).*;.*[jJ][A-Za-z]?(\d+)')
+MIG_WEIGHT  = re.compile(r'[-=](\d+)$')
+
+
+class PerlRandom:
+    '''
+    random numbers of Perl's rand() after srand (48-bit linear congruential
+      generator, as drand48)
+    '''
+
+    def __init__(self, seed=RANDOM_SEED):
+        self.state = ((seed & 0xFFFFFFFF) << 16) + 0x330E
+
+    def rand(self, limit=1):
+        self.state = (0x5DEECE66D * self.state + 0xB) & 0xFFFFFFFFFFFF
+        return self.state / (1 << 48) * limit
+
+    def string(self, length=ID_LENGTH, chars=ID_CHARS):
+        '''
+        returns a random string (rndStr of clonotype_count.pl)
+        '''
+        return ''.join([chars[int(self.rand(len(chars)))] for _ in range(length)])
+
+
+#-------------------------------------------------------------------------------
+def mig_weight (query_id):
+    '''
+    returns the number of reads represented by a record: the number at the end
+      of the query ID after '-' or '=' (e.g., "retained=12" or "7-12"), or None
+    1st argument--query ID
+    '''
+    match = MIG_WEIGHT.search(query_id)
+    return int(match.group(1)) if match else None
+
+
+#-------------------------------------------------------------------------------
+def vj_families (vj_assignment):
+    '''
+    returns the (V family, J family) strings of a "Vgene;Jgene" assignment
+    1st argument--V and J gene calls separated by ';'
+    '''
+    match = VJ_FAMILIES.search(vj_assignment)
+    if not match:
+        sys.exit('Error interpreting ' + vj_assignment + '.')
+    return match.group(1), match.group(2)
+
+
+#-------------------------------------------------------------------------------
+def clonotype_key (v_call, j_call, cdr3_aa):
+    '''
+    returns the (VJ assignment, rearrangement) clonotype key
+    1st argument--V gene call(s), comma-separated; the first one is used
+    2nd argument--J gene call(s), comma-separated; the first one is used
+    3rd argument--CDR3 amino acid sequence (at least 4 residues, or 0null0)
+    '''
+    if cdr3_aa != NULL_CDR3:
+        if len(cdr3_aa) < 4:
+            sys.exit('Error: CDR3aa ' + cdr3_aa + ' is too short for a clonotype.')
+        cdr3_aa = cdr3_aa[2:-1]
+    return v_call.split(',', 1)[0] + ';' + j_call.split(',', 1)[0], cdr3_aa
+
+
+class ClonotypeCounter:
+    '''
+    MIG-weighted clonotype counts, with the clonotype of every added record
+      remembered (in order) for the annotation pass
+    '''
+
+    def __init__(self):
+        self.index         = {}           # clonotype key -> clonotype number
+        self.keys          = []
+        self.counts        = []           # [records, reads] per clonotype
+        self.record_clones = array('l')   # clonotype number of each added record
+        self.labels        = None
+
+    def add(self, key, weight):
+        '''
+        count one record
+        1st argument--clonotype key (see clonotype_key)
+        2nd argument--number of reads of the record
+        '''
+        clone = self.index.get(key)
+        if clone is None:
+            clone = self.index[key] = len(self.keys)
+            self.keys.append(key)
+            self.counts.append([0, 0])
+        self.counts[clone][0] += 1
+        self.counts[clone][1] += weight
+        self.record_clones.append(clone)
+
+    def add_all(self, clones):
+        '''
+        count the records of an iterable of (clonotype key, weight) pairs
+        '''
+        for key, weight in clones:
+            self.add(key, weight)
+
+    def set_counts(self, counts):
+        '''
+        replace the counts of the added clonotypes (e.g., with those kept up to
+          date in the state store of the incremental mode, see topup_state.py)
+        1st argument--dictionary of (records, reads) by clonotype key
+        '''
+        for clone, key in enumerate(self.keys):
+            if key not in counts:
+                sys.exit('Error: no stored counts for the clonotype ' + ' '.join(key) + '.')
+            self.counts[clone] = list(counts[key])
+
+    def build_dictionary(self):
+        '''
+        returns the array of dictionary rows (same columns as clonotype_count.pl:
+          identifier, rearrangement, number of VJ pairs, reads without the
+          chimeras, V family, J family, then VJ pair and reads for each pair),
+          sorted by the read count; also prepares the annotation labels
+        '''
+        random = PerlRandom()
+        used_ids = set()
+        dictionary = {}
+        members = {}
+
+        # the most abundant VJ pair of each rearrangement comes first
+        for clone in sorted(range(len(self.keys)), key=lambda clone: -self.counts[clone][1]):
+            vj_assignment, rearr = self.keys[clone]
+            reads = self.counts[clone][1]
+            v_fam, j_fam = vj_families(vj_assignment)
+            entry = dictionary.get(rearr)
+            if entry is None:
+                clust_id = random.string()
+                retries = ID_RETRIES
+                while clust_id in used_ids:
+                    if not retries:
+                        sys.exit('# Error! failed to get a unique cluster ID.')
+                    clust_id = random.string()
+                    retries -= 1
+                used_ids.add(clust_id)
+                dictionary[rearr] = [clust_id, rearr, 1, reads, v_fam, j_fam,\
+                                     vj_assignment, reads]
+                members[rearr] = [clone]
+            else:
+                entry[2] += 1
+                entry[3] += reads
+                entry.extend((vj_assignment, reads))
+                members[rearr].append(clone)
+
+        # check the dominant clonotype and mark the ambiguous V/J assignments
+        self.labels = [None] * len(self.keys)
+        for rearr, entry in dictionary.items():
+            families = [(int(v_fam), int(j_fam)) for v_fam, j_fam in\
+                        map(vj_families, entry[6::2])]
+            dominant = (int(entry[4]), int(entry[5]))
+            ambiguous = False
+            if 2 * entry[7] <= entry[3]:
+                vj_tally = sum(reads for pair_fams, reads in zip(families, entry[7::2])\
+                               if pair_fams == dominant)
+                ambiguous = 2 * vj_tally <= entry[3]
+
+            chimeric = []
+            for pair, pair_fams in enumerate(families):
+                chimeric.append(ambiguous or pair_fams != dominant)
+                if chimeric[-1]:
+                    entry[6 + 2 * pair] += ';chimera'
+                    entry[3] -= entry[7 + 2 * pair]
+
+            if ambiguous:
+                entry[4] = entry[5] = 'ambig'
+            entry[4] = 'V' + entry[4]
+            entry[5] = 'J' + entry[5]
+
+            for clone, chimera in zip(members[rearr], chimeric):
+                self.labels[clone] = ';' + entry[0] + '-' + str(entry[3]) +\
+                    ('-chimera' if chimera else '')
+
+        return sorted(dictionary.values(), key=lambda entry: -entry[3])
+
+    def write_dictionary(self, output):
+        '''
+        write the clonotype dictionary (clonotype_count.pl format)
+        1st argument--output filehandle
+        '''
+        rows = self.build_dictionary()
+        output.write('# There were ' + str(len(self.keys)) + ' clonotypes detected.\n')
+        output.write('# These collapsed down to ' + str(len(rows)) + ' rearrangements.\n')
+        output.write('# Counts:\n')
+        for row in rows:
+            output.write('\t'.join(map(str, row)) + '\n')
+
+    def annotate(self, records, output):
+        '''
+        write the records with the clonotype identifier and population size
+          (and "-chimera" if the record's V/J families are not the dominant
+          ones) appended to the query ID (clonotype_annotate.pl format)
+        1st argument--iterable of the added records (seq_reader.SeqRecord), in order
+        2nd argument--output filehandle
+        '''
+        if self.labels is None:
+            self.build_dictionary()
+
+        count = 0
+        for count, record in enumerate(records, 1):
+            if count > len(self.record_clones):
+                break
+            query_id, _, description = record.header.partition('\t')
+            output.write('>' + query_id + self.labels[self.record_clones[count - 1]] +\
+                         '\t' + description + '\n' + record.seq + '\n')
+        if count != len(self.record_clones):
+            sys.exit('Error: the records to annotate do not match the clonotype counts.')
@@ -0,0 +1,282 @@
+'''
+consensus_pfm.py
+  Vectorized position frequency matrix (PFM) engine for the barcode consensus
+  scripts. The reads of a MIG are encoded as rows of a 2-D uint8 code matrix
+  (N=0, A=1, T=2, C=3, G=4; padding is N), so that the PFM, the consensus base
+  and its Cumulative Quality Score (CQS) are computed as whole-array operations.
+  The original pure-Python PFM loops are kept as the 'python' engine for
+  verification and for systems without NumPy; both produce identical output.
+  CountAccumulator keeps the same counts for a MIG that is streamed through
+  in blocks of reads (see consensus_stream.py).
+'''
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ENGINES = ('numpy', 'python') if np is not None else ('python',)
+DEFAULT_ENGINE = ENGINES[0]
+
+CODE_NTS = b'NATCG'
+NT_NUM = len(CODE_NTS)
+
+if np is not None:
+    # byte -> nucleotide code lookup; anything outside of NATCG is flagged as invalid
+    NT_LOOKUP = np.full(256, 255, dtype=np.uint8)
+    for _code, _nt in enumerate(CODE_NTS):
+        NT_LOOKUP[_nt] = _code
+
+
+#-------------------------------------------------------------------------------
+def encode_alignment (input_seqs, seqs_with_offsets, max_left_arm, pfm_length):
+    '''
+    returns the 2-D uint8 code matrix for the padded alignment
+    1st argument--array of sequences
+    2nd argument--array of [left_arm, right_arm, index] entries (see consensus_generator)
+    3rd argument--maximum left arm in the alignment
+    4th argument--alignment (PFM) length
+    '''
+    code_matrix = np.zeros((len(seqs_with_offsets), pfm_length), dtype=np.uint8)
+
+    for row, seq_plus_offsets in enumerate(seqs_with_offsets):
+        seq = input_seqs[seq_plus_offsets[2]].encode('ascii')
+        start = max_left_arm - seq_plus_offsets[0]
+        code_matrix[row, start:start + len(seq)] = \
+            NT_LOOKUP[np.frombuffer(seq, dtype=np.uint8)]
+
+    if code_matrix.size and code_matrix.max() >= NT_NUM:
+        raise KeyError('unexpected nucleotide in the MIG alignment')
+
+    return code_matrix
+
+
+#-------------------------------------------------------------------------------
+def count_matrix (code_matrix):
+    '''
+    returns the position frequency matrix (positions x [N, A, T, C, G] counts)
+    computed with a single bincount over (position, code) pairs
+    1st argument--2-D uint8 code matrix
+    '''
+    pfm_length = code_matrix.shape[1]
+    cells = code_matrix + np.arange(pfm_length, dtype=np.intp) * NT_NUM
+    return np.bincount(cells.ravel(), minlength=pfm_length * NT_NUM)\
+        .reshape(pfm_length, NT_NUM)
+
+
+#-------------------------------------------------------------------------------
+def consensus_from_counts (position_freq_matrix, seq_count):
+    '''
+    returns the consensus sequence/quality string pair for the PFM
+    1st argument--position frequency matrix (see count_matrix)
+    2nd argument--number of sequences in the alignment
+    '''
+    # redistribute the N counts evenly between the four bases
+    base_counts = position_freq_matrix[:, 1:] + \
+        (position_freq_matrix[:, :1] / 4)
+    best_code = np.argmax(base_counts, axis=1)
+    max_count = base_counts[np.arange(len(best_code)), best_code]
+
+    # cumulative quality score (CQS) from MIGEC, with the chr(35) floor
+    best_base_qual = np.trunc((max_count / seq_count - 0.25) / 0.75 * 40 + 33)
+    best_base_qual = np.maximum(best_base_qual, 35).astype(np.uint8)
+
+    consensus_seq = np.frombuffer(CODE_NTS[1:], dtype=np.uint8)[best_code]
+    return consensus_seq.tobytes().decode('ascii'), \
+        best_base_qual.tobytes().decode('ascii')
+
+
+#-------------------------------------------------------------------------------
+def pfm_consensus (input_seqs, seqs_with_offsets, max_left_arm, max_right_arm,\
+        debug_flag = 0):
+    '''
+    generate consensus sequence/quality score pair from the seed-anchored reads
+    1st argument--array of sequences
+    2nd argument--array of [left_arm, right_arm, index] entries
+    3rd argument--maximum left arm in the alignment
+    4th argument--maximum right arm in the alignment
+    5th argument--DEBUG flag
+    returns array of consensus sequence, quality
+    '''
+    pfm_length = max_left_arm + max_right_arm
+    code_matrix = encode_alignment(input_seqs, seqs_with_offsets,\
+                                   max_left_arm, pfm_length)
+    position_freq_matrix = count_matrix(code_matrix)
+
+    if debug_flag:
+        print("#### Alignment for the current MIG. ####")
+        for row, seq_plus_offsets in enumerate(seqs_with_offsets):
+            print(">element" + str(len(input_seqs)-seq_plus_offsets[2]),\
+                  "leftOffset =", seq_plus_offsets[0], "rightOffset =",\
+                      seq_plus_offsets[1])
+            print(np.frombuffer(CODE_NTS, dtype=np.uint8)[code_matrix[row]]\
+                  .tobytes().decode('ascii'))
+        print("########################################")
+        print ("#### Contents of the positional frequency matrix for the current MIG.")
+        print ("######## N\tA\tT\tC\tG")
+        for row in position_freq_matrix.tolist():
+            print("# values ", end='')
+            for element in row:
+                print(element, end='\t')
+            print()
+        print('.....\n\n')
+
+    return consensus_from_counts(position_freq_matrix, len(seqs_with_offsets))
+
+
+#-------------------------------------------------------------------------------
+def pfm_consensus_python (input_seqs, seqs_with_offsets, max_left_arm, max_right_arm,\
+        debug_flag = 0):
+    '''
+    pure-Python version of pfm_consensus (same arguments and return value)
+    '''
+    nt_codes = { 'N' : 0, 'A' : 1, 'T' : 2, 'C' : 3, 'G' : 4 }
+    code_nts = ['N','A','T','C','G']
+
+    # position_freq_matrix length should be the sum of maximum arms from the
+    #  sequences in the alignment dataset
+    pfm_length = max_left_arm + max_right_arm
+    # initialize the position_freq_matrix array
+    position_freq_matrix = []
+    pfm_row = []
+    for nt_code in range(len(code_nts)):
+        pfm_row.append(0)
+    for pos in range(pfm_length):
+        position_freq_matrix.append(pfm_row.copy())
+
+    if debug_flag:
+        print("#### Alignment for the current MIG. ####")
+
+    # load the position frequency matrix
+    for ind, seq_plus_offsets in enumerate(seqs_with_offsets):
+        seq = 'N'*(max_left_arm - seq_plus_offsets[0]) +\
+            input_seqs[seq_plus_offsets[2]] + 'N'*(max_right_arm -\
+                                                      seq_plus_offsets[1])
+        for pos in range(pfm_length):
+            position_freq_matrix[pos][nt_codes[seq[pos]]] += 1
+
+        if debug_flag:
+            print(">element" + str(len(input_seqs)-seq_plus_offsets[2]),\
+                  "leftOffset =", seq_plus_offsets[0], "rightOffset =",\
+                      seq_plus_offsets[1])
+            print(seq)
+
+    if debug_flag:
+        print("########################################")
+        print ("#### Contents of the positional frequency matrix for the current MIG.")
+        print ("######## N\tA\tT\tC\tG")
+        for row in position_freq_matrix:
+            print("# values ", end='')
+            for element in row:
+                print(element, end='\t')
+            print()
+        print('.....\n\n')
+
+    return consensus_from_counts_python(position_freq_matrix, len(seqs_with_offsets))
+
+
+#-------------------------------------------------------------------------------
+def consensus_from_counts_python (position_freq_matrix, seq_count):
+    '''
+    pure-Python version of consensus_from_counts; the counts are modified in place
+    1st argument--position frequency matrix (array of [N, A, T, C, G] count arrays)
+    2nd argument--number of sequences in the alignment
+    '''
+    code_nts = ['N','A','T','C','G']
+
+    consensus_seq = '' # initialize consensus sequence
+    consensus_qual = '' # initialize consensus quality
+    for pos_counts in position_freq_matrix:
+        best_base = 0
+        max_count = 0
+        for nt_code in range(1,len(code_nts)):
+            if pos_counts[0]:
+                pos_counts[nt_code] += pos_counts[0]/4
+            if max_count <  pos_counts[nt_code]:
+                max_count = pos_counts[nt_code]
+                best_base = code_nts[nt_code]
+        consensus_seq += best_base
+
+        if best_base != 'N':
+            # cumulative quality score (CQS) from MIGEC #####
+            best_base_qual = int(((max_count/seq_count - 0.25)) / 0.75 * 40 + 33)
+            consensus_qual += chr(35 if best_base_qual < 35 else best_base_qual)
+        else:
+            consensus_qual += chr(35)
+
+    return consensus_seq, consensus_qual
+
+
+class CountAccumulator:
+    '''
+    position frequency matrix built up block by block from seed-anchored reads,
+      for MIGs too large to be aligned at once: the counts are kept relative to
+      the seed anchor and the matrix grows to either side as reads with longer
+      arms come in, so that neither the reads nor padded copies are held; the
+      padding N counts are only added when the consensus is taken
+    '''
+
+    def __init__(self, engine=DEFAULT_ENGINE):
+        self.engine    = engine
+        self.counts    = np.zeros((0, NT_NUM), dtype=np.int64) if engine == 'numpy' else []
+        self.left_arm  = 0  # positions before the anchor
+        self.right_arm = 0  # positions from the anchor on
+        self.seq_count = 0
+
+    def _grow(self, left_arm, right_arm):
+        extra_left = max(left_arm - self.left_arm, 0)
+        extra_right = max(right_arm - self.right_arm, 0)
+        if extra_left or extra_right:
+            if self.engine == 'numpy':
+                self.counts = np.pad(self.counts, ((extra_left, extra_right), (0, 0)))
+            else:
+                self.counts[:0] = [[0] * NT_NUM for _ in range(extra_left)]
+                self.counts.extend([0] * NT_NUM for _ in range(extra_right))
+            self.left_arm += extra_left
+            self.right_arm += extra_right
+
+    def add(self, input_seqs, seqs_with_offsets):
+        '''
+        add a block of reads to the counts
+        1st argument--array of sequences
+        2nd argument--array of [left_arm, right_arm, index] entries (see consensus_generator)
+        '''
+        if not seqs_with_offsets:
+            return
+        max_left_arm = max(seq_plus_offsets[0] for seq_plus_offsets in seqs_with_offsets)
+        max_right_arm = max(seq_plus_offsets[1] for seq_plus_offsets in seqs_with_offsets)
+        self._grow(max_left_arm, max_right_arm)
+        start = self.left_arm - max_left_arm
+
+        if self.engine == 'numpy':
+            # the block padding is counted as N, as the padding of the other
+            #  blocks' reads will be in consensus()
+            block_counts = count_matrix(encode_alignment(input_seqs, seqs_with_offsets,\
+                max_left_arm, max_left_arm + max_right_arm))
+            self.counts[start:start + len(block_counts)] += block_counts
+        else:
+            nt_codes = { 'N' : 0, 'A' : 1, 'T' : 2, 'C' : 3, 'G' : 4 }
+            for seq_plus_offsets in seqs_with_offsets:
+                pos = start + max_left_arm - seq_plus_offsets[0]
+                for base in input_seqs[seq_plus_offsets[2]]:
+                    self.counts[pos][nt_codes[base]] += 1
+                    pos += 1
+        self.seq_count += len(seqs_with_offsets)
+
+    def consensus(self):
+        '''
+        returns the consensus sequence/quality string pair for the reads added so
+          far, as pfm_consensus would give for all of them aligned at once
+        '''
+        if self.engine == 'numpy':
+            position_freq_matrix = self.counts.copy()
+            position_freq_matrix[:, 0] += self.seq_count - position_freq_matrix.sum(axis=1)
+            return consensus_from_counts(position_freq_matrix, self.seq_count)
+
+        position_freq_matrix = [pos_counts.copy() for pos_counts in self.counts]
+        for pos_counts in position_freq_matrix:
+            pos_counts[0] += self.seq_count - sum(pos_counts)
+        return consensus_from_counts_python(position_freq_matrix, self.seq_count)
+
+
+PFM_ENGINES = {'numpy' : pfm_consensus, 'python' : pfm_consensus_python}
@@ -0,0 +1,148 @@
+'''
+consensus_stream.py
+  Memory-bounded consensus for giant MIGs (tens of thousands of reads in
+  bottlenecked libraries). The best seed is chosen, by the rules of
+  consensus_generator, from a bounded sample of the first reads of the MIG;
+  every read is then anchored to that seed as it arrives and folded, in blocks,
+  into an anchor-relative count matrix (consensus_pfm.CountAccumulator), so that
+  only the sample, one block of reads and the counts are held, whatever the
+  MIG size. When the sample holds the whole MIG, the result is the one of
+  consensus_generator.
+'''
+
+from itertools import chain, islice
+
+import consensus_pfm
+import seed_index
+
+BLOCK_READS = 1024 # reads per block folded into the counts
+
+
+#-------------------------------------------------------------------------------
+def read_seeds (seq, half_seed_len, seed_offsets, centered):
+    '''
+    returns the array of packed seeds of a read, or None if the read is too short
+    1st argument--sequence
+    2nd argument--half-seed length (e.g., 10)
+    3rd argument--range of seed offsets
+    4th argument--True for seeds around the middle of the read (get_seed_middle
+      of fasta_barcode_consensus.py), False for seeds from its left end
+      (get_seed_left of fastq_barcode_consensus.py)
+    '''
+    if len(seq) <= half_seed_len * 2 + max(seed_offsets) + 1:
+        return None
+    seed_start = int(len(seq) / 2) - half_seed_len - 1 if centered else 0
+    return seed_index.packed_seeds(seq, [(seed_start + offset,\
+        seed_start + offset + half_seed_len * 2) for offset in seed_offsets])
+
+
+#-------------------------------------------------------------------------------
+def streaming_consensus (seqs, half_seed_len, seed_offsets, max_mismatch_cnt, sample_size,\
+        centered = False, engine = consensus_pfm.DEFAULT_ENGINE, metrics = None):
+    '''
+    generate consensus sequence/quality score pair from an iterable of sequences
+    1st argument--iterable of sequences (e.g., seq_reader.StreamedMig)
+    2nd argument--half-seed length (e.g., 10)
+    3rd argument--range of seed offsets (range(-5, 6) for the middle seeds,
+      range(12) for the left seeds)
+    4th argument--maxMismatch (e.g., 3)
+    5th argument--number of reads sampled for the choice of the best seed
+    6th argument--True for the middle seeds, False for the left seeds (see read_seeds)
+    7th argument--PFM engine ('numpy' or 'python', see consensus_pfm.py)
+    8th argument--run_metrics.RunMetrics for the phase times and read counters (optional)
+    returns array of consensus sequence, quality, number of sequences used
+      (None if no more than one read is left)
+    '''
+    clock = metrics.clock() if metrics is not None else None
+    tossed_length = tossed_mismatches = 0
+    seqs = iter(seqs)
+    sample = list(islice(seqs, sample_size))
+    if all(read_seeds(seq, half_seed_len, seed_offsets, centered) is None for seq in sample):
+        # too short for a seed: they are tossed, and the sample is the first read with seeds
+        tossed_length = len(sample)
+        sample = []
+        for seq in seqs:
+            if read_seeds(seq, half_seed_len, seed_offsets, centered) is not None:
+                sample = [seq]
+                break
+            tossed_length += 1
+        if not sample: # no read with seeds, as in consensus_generator
+            if metrics is not None:
+                metrics.add_time('seed_search', clock)
+                metrics.count('reads_tossed_length', tossed_length)
+                metrics.count('reads_tossed_mismatches', 0)
+            return None
+
+    # identify the most abundant seed sequence in the sample (same rules as consensus_generator)
+    seed_dict = {}
+    for ind, seq in enumerate(sample):
+        seeds = read_seeds(seq, half_seed_len, seed_offsets, centered)
+        if seeds is not None:
+            for offset, seed in zip(seed_offsets, seeds):
+                if seed not in seed_dict:
+                    seed_dict[seed] = [0,0]
+                seed_dict[seed][0] += 1      # increment count
+                seed_dict[seed][1] += offset # add to the cumulative offset
+    best_seed = None
+    best_seed_data = [0,0]
+    for seed_seq, seed_data in seed_dict.items():
+        if seed_data[0] > best_seed_data[0] or \
+                (seed_data[0] == best_seed_data[0] and\
+                 seed_data[1] < best_seed_data[1]):
+            best_seed = seed_seq
+            best_seed_data = seed_data
+    if metrics is not None and list(seed_dict.values()).count(best_seed_data) > 1:
+        metrics.count('seed_ties')
+    del seed_dict
+
+    # anchor every read to the best seed and fold it into the counts, a block at a time
+    accumulator = consensus_pfm.CountAccumulator(engine)
+    block = []
+    seqs_with_offsets = []
+    reads = chain(sample, seqs)
+    del sample # freed once the reads are past it
+    for seq in reads:
+        seeds = read_seeds(seq, half_seed_len, seed_offsets, centered)
+        if seeds is None:
+            tossed_length += 1
+            continue
+        best_offset = 0
+        best_mismatch_cnt = half_seed_len * 2 + 1 # max out the mismatch_cnt
+        for offset, seed in zip(seed_offsets, seeds):
+            if seed == best_seed:
+                best_offset = offset
+                best_mismatch_cnt = 0
+                break
+
+            mismatch_cnt = seed_index.seed_mismatches(seed, best_seed)
+            if mismatch_cnt < best_mismatch_cnt:
+                best_mismatch_cnt = mismatch_cnt
+                best_offset = offset
+
+        if best_mismatch_cnt <= max_mismatch_cnt:
+            left_arm = (int(len(seq) / 2) if centered else 0) + best_offset
+            seqs_with_offsets.append([left_arm, len(seq) - left_arm, len(block)])
+            block.append(seq)
+            if len(block) >= BLOCK_READS:
+                if metrics is not None:
+                    clock = metrics.add_time('seed_search', clock)
+                accumulator.add(block, seqs_with_offsets)
+                if metrics is not None:
+                    clock = metrics.add_time('pfm', clock)
+                block = []
+                seqs_with_offsets = []
+        else:
+            tossed_mismatches += 1
+    if metrics is not None:
+        clock = metrics.add_time('seed_search', clock)
+        metrics.count('reads_tossed_length', tossed_length)
+        metrics.count('reads_tossed_mismatches', tossed_mismatches)
+    accumulator.add(block, seqs_with_offsets)
+
+    if accumulator.seq_count <= 1:
+        # return a null value if dealing with a singlet (after tossing the bad sequences)
+        return None
+    consensus_seq, consensus_qual = accumulator.consensus()
+    if metrics is not None:
+        metrics.add_time('pfm', clock)
+    return [accumulator.seq_count, consensus_seq, consensus_qual]
@@ -5,6 +5,8 @@
    barcodes. Implemented using a position frequency matrix; quality scores derived as
    Cumulative Quality Score. This avoids introduction of gaps and significantly
    improves runtime (real alignment takes a long time).
+   With --state (incremental mode, see topup_state.py), the consensus of a MIG
+   whose reads are those of the previous run is taken from the state store.
 '''
 # Q-score encoding conventions, taken from Wikipedia:
 # SSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSS.....................................................
@@ -31,8 +33,27 @@
 
 import sys
 import argparse
+import collections
+import contextlib
 import re
 
+import consensus_pfm
+import consensus_stream
+import mig_pool
+import run_metrics
+import seed_index
+import seq_reader
+import stream_io
+import topup_state
+import umi_grouper
+
+# consensus of a MIG taken from the state store (seq is None if it was dropped)
+StoredConsensus = collections.namedtuple('StoredConsensus',\
+                                         'size retained seq qual tossed_length tossed_mismatches'\
+                                         + ' seed_ties')
+
+BARCODE_FIELD = re.compile(r';barcode=([^;]+)')
+
 #-------------------------------------------------------------------------------
 def get_seed_middle (seq, half_seed_len, offset):
     '''
@@ -47,7 +68,8 @@ def get_seed_middle (seq, half_seed_len, offset):
     return seq[start:end]
 
 #-------------------------------------------------------------------------------
-def consensus_generator (input_seqs, half_seed_len, offset_rng, max_mismatch_cnt, debug_flag = 0):
+def consensus_generator (input_seqs, half_seed_len, offset_rng, max_mismatch_cnt, debug_flag = 0,\
+        engine = consensus_pfm.DEFAULT_ENGINE, metrics = None):
     '''
     generate consensus sequence/quality score pair from an array of arrays of strings
     1st argument--arrays of sequences
@@ -55,34 +77,43 @@ def consensus_generator (input_seqs, half_seed_len, offset_rng, max_mismatch_cnt
     3rd argument--offset range (e.g., 5)
     4th argument--maxMismatch (e.g., 3)
     5th argument--debug-flag (e.g., 0 or 1)
+    6th argument--PFM engine ('numpy' or 'python', see consensus_pfm.py)
+    7th argument--run_metrics.RunMetrics for the phase times and read counters (optional)
     returns array of consensus sequence, quality, number of sequences used
     adapted from the MIGEC code (PMID: 24793455)
     https://github.com/mikessh/migec/blob/master/src/main/groovy/com/milaboratory/migec/Assemble.groovy
     '''
-    nt_codes = { 'N' : 0, 'A' : 1, 'T' : 2, 'C' : 3, 'G' : 4 }
-    code_nts = ['N','A','T','C','G']
     seed_dict = {}
     valid_seq_refs = []
+    valid_seq_seeds = []
     seqs_with_offsets = []
-    best_seed = ''
+    best_seed = None
     best_seed_data = [0,0]
     max_left_arm = 0
     max_right_arm = 0
     removed_elements =[]
 
+    clock = metrics.clock() if metrics is not None else None
+    seed_offsets = range(-offset_rng, offset_rng + 1)
+
     # find all possible seed sequences and their offsets, check lengths and find maximum
-    #  storing the indices for later reference from the input array
+    #  storing the indices for later reference from the input array;
+    #  the seeds of each read are packed once (see seed_index.py) and reused below
     for ind, seq in enumerate(input_seqs):
         # make sure the sequence is long enough
         if len(seq) > (half_seed_len * 2 + offset_rng + 1):
-            for offset in range(-offset_rng, offset_rng + 1):
-                seed = get_seed_middle(seq, half_seed_len, offset)
-                # initialize seed_dict entry, if necessary
+            # seed coordinates as in get_seed_middle
+            seed_start = int(len(seq) / 2) - half_seed_len - 1
+            seeds = seed_index.packed_seeds(seq, [(seed_start + offset,\
+                seed_start + offset + half_seed_len * 2) for offset in seed_offsets])
+            for offset, seed in zip(seed_offsets, seeds):
+                # initialize seed_dict entry, if necessary (keep the first occurrence)
                 if seed not in seed_dict:
-                    seed_dict[seed] = [0,0]
+                    seed_dict[seed] = [0,0,ind,offset]
                 seed_dict[seed][0] += 1      # increment count
                 seed_dict[seed][1] += offset # add to the cumulative offset
             valid_seq_refs.append(ind)
+            valid_seq_seeds.append(seeds)
         else:
             removed_elements.append(len(input_seqs)-ind)
 
@@ -99,21 +130,23 @@ def consensus_generator (input_seqs, half_seed_len, offset_rng, max_mismatch_cnt
             best_seed = seed_seq
             best_seed_data = seed_data.copy()
 
+    if debug_flag and best_seed is not None:
+        # the seed string itself is only needed for the debug output
+        best_seed_str = get_seed_middle(input_seqs[best_seed_data[2]], half_seed_len,\
+                                        best_seed_data[3])
+
     # identify the best match to seed for each sequence, load into the position frequency matrix
-    for ind in valid_seq_refs:
+    for ind, seeds in zip(valid_seq_refs, valid_seq_seeds):
         best_offset = 0
         best_mismatch_cnt = half_seed_len * 2 + 1 # max out the mismatch_cnt
 
-        for offset in range(-offset_rng, offset_rng + 1):
-            mismatch_cnt = 0
-            seed = get_seed_middle(input_seqs[ind], half_seed_len, offset)
-
+        for offset, seed in zip(seed_offsets, seeds):
             if seed == best_seed:
                 best_offset = offset
                 best_mismatch_cnt = 0
                 break
 
-            mismatch_cnt = sum(c1!=c2 for c1,c2 in zip(seed,best_seed))
+            mismatch_cnt = seed_index.seed_mismatches(seed, best_seed)
             if mismatch_cnt < best_mismatch_cnt:
                 best_mismatch_cnt = mismatch_cnt
                 best_offset = offset
@@ -128,11 +161,11 @@ def consensus_generator (input_seqs, half_seed_len, offset_rng, max_mismatch_cnt
         elif debug_flag:
             seed = get_seed_middle(input_seqs[ind], half_seed_len, best_offset)
             print ("#### Tossing element", len(input_seqs)-ind, "with", best_mismatch_cnt,\
-                   "mismatches for", seed, "with respect to", best_seed, ":")
+                   "mismatches for", seed, "with respect to", best_seed_str, ":")
             print (input_seqs[ind])
             for offset in range(-offset_rng, offset_rng + 1):
                 seed = get_seed_middle(input_seqs[ind], half_seed_len, offset)
-                mismatch_cnt = sum(c1!=c2 for c1,c2 in zip(seed,best_seed))
+                mismatch_cnt = sum(c1!=c2 for c1,c2 in zip(seed,best_seed_str))
                 print(offset, ":", seed, "--", mismatch_cnt)
 
 
@@ -142,65 +175,19 @@ def consensus_generator (input_seqs, half_seed_len, offset_rng, max_mismatch_cnt
         if removed_elements is not None:
             print('#### Removed the following elements (too short)', removed_elements)
 
+    if metrics is not None:
+        clock = metrics.add_time('seed_search', clock)
+        metrics.count('reads_tossed_length', len(removed_elements))
+        metrics.count('reads_tossed_mismatches',\
+                      len(valid_seq_refs) - len(seqs_with_offsets))
+        if sum(seed_data[:2] == best_seed_data[:2] for seed_data in seed_dict.values()) > 1:
+            metrics.count('seed_ties')
+
     if len(seqs_with_offsets) > 1:
-        # position_freq_matrix length should be the sum of maximum arms
-        #    from the sequences in the alignment dataset
-        pfm_length = max_left_arm + max_right_arm
-        # initialize the position_freq_matrix array
-        position_freq_matrix = []
-        pfm_row = []
-        for nt_code in range(len(code_nts)):
-            pfm_row.append(0)
-        for pos in range(pfm_length):
-            position_freq_matrix.append(pfm_row.copy())
-
-        if debug_flag:
-            print("#### Alignment for the current MIG. ####")
-
-        # load the position frequency matrix
-        for ind, seq_plus_offsets in enumerate(seqs_with_offsets):
-            seq = 'N'*(max_left_arm - seq_plus_offsets[0]) +\
-                input_seqs[seq_plus_offsets[2]] + 'N'*(max_right_arm -\
-                                                          seq_plus_offsets[1])
-            for pos in range(pfm_length):
-                position_freq_matrix[pos][nt_codes[seq[pos]]] += 1
-
-            if debug_flag:
-                print(">element" + str(len(input_seqs)-seq_plus_offsets[2]),\
-                      "leftOffset =", seq_plus_offsets[0], "rightOffset =",\
-                          seq_plus_offsets[1])
-                print(seq)
-
-        if debug_flag:
-            print("########################################")
-            print ("#### Contents of the positional frequency matrix for the current MIG.")
-            print ("######## N\tA\tT\tC\tG")
-            for row in position_freq_matrix:
-                print("# values ", end='')
-                for element in row:
-                    print(element, end='\t')
-                print()
-            print('.....\n\n')
-
-        consensus_seq = '' # initialize consensus sequence
-        consensus_qual = '' # initialize consensus quality
-        for pos in range(pfm_length):
-            best_base = 0
-            max_count = 0
-            for nt_code in range(1,len(nt_codes)):
-                if position_freq_matrix[pos][0]:
-                    position_freq_matrix[pos][nt_code] += position_freq_matrix[pos][0]/4
-                if max_count <  position_freq_matrix[pos][nt_code]:
-                    max_count = position_freq_matrix[pos][nt_code]
-                    best_base = code_nts[nt_code]
-            consensus_seq += best_base
-
-            if best_base != 'N':
-                # cumulative quality score (CQS) from MIGEC #####
-                best_base_qual = int(((max_count/len(seqs_with_offsets) - 0.25)) / 0.75 * 40 + 33)
-                consensus_qual += chr(35 if best_base_qual < 35 else best_base_qual)
-            else:
-                consensus_qual += chr(35)
+        consensus_seq, consensus_qual = consensus_pfm.PFM_ENGINES[engine](input_seqs,\
+            seqs_with_offsets, max_left_arm, max_right_arm, debug_flag)
+        if metrics is not None:
+            metrics.add_time('pfm', clock)
     else:
         # return a null value if dealing with a singlet (after tossing the bad sequences)
         return None
@@ -209,73 +196,253 @@ def consensus_generator (input_seqs, half_seed_len, offset_rng, max_mismatch_cnt
     consensus = [len(seqs_with_offsets), consensus_seq, consensus_qual]
     return consensus
 
+#-------------------------------------------------------------------------------
+def mig_batch_to_fastq (migs, args):
+    '''
+    returns FASTQ output for a batch of MIGs: singlets are passed through,
+      non-singlets are collapsed by consensus_generator
+    1st argument--array of (cluster ID, array of sequences) pairs
+    2nd argument--parsed commandline arguments
+    returns (FASTQ text, run_metrics.RunMetrics state) with --metrics; with
+      --state, that result is paired with the array of (cluster ID, retained,
+      consensus, quality, reads tossed for their length, reads tossed for seed
+      mismatches, seed ties) of the collapsed MIGs (no consensus for the dropped
+      ones)
+    '''
+    output = []
+    collapsed = []
+    metrics = run_metrics.RunMetrics() if args.metrics else None
+    for cluster_id, cluster_seqs in migs:
+        if isinstance(cluster_seqs, StoredConsensus):
+            if metrics is not None:
+                metrics.count('migs_in')
+                metrics.count('reads_in', cluster_seqs.size)
+                metrics.count('migs_reused')
+                metrics.count('migs_out' if cluster_seqs.seq is not None else 'migs_dropped')
+                if cluster_seqs.seq is not None:
+                    metrics.count('reads_used', cluster_seqs.retained)
+                metrics.count('reads_tossed_length', cluster_seqs.tossed_length)
+                metrics.count('reads_tossed_mismatches', cluster_seqs.tossed_mismatches)
+                if cluster_seqs.seed_ties:
+                    metrics.count('seed_ties', cluster_seqs.seed_ties)
+            if cluster_seqs.seq is not None:
+                output.append('@MIG' + cluster_id + ';retained=' + str(cluster_seqs.retained) +\
+                              '\n' + cluster_seqs.seq + '\n+\n' + cluster_seqs.qual + '\n')
+            continue
+
+        if metrics is not None:
+            metrics.count('migs_in')
+            metrics.count('reads_in', len(cluster_seqs))
+        if len(cluster_seqs) == 1:
+            output.append('@MIG' + cluster_id + ";retained=1\n" +\
+                          cluster_seqs[0] + '\n+\n' + '#' * len(cluster_seqs[0]) + '\n')
+            if metrics is not None:
+                metrics.count('singlets')
+                metrics.count('migs_out')
+            continue
+
+        if isinstance(cluster_seqs, seq_reader.StreamedMig):
+            consensus_array = consensus_stream.streaming_consensus(cluster_seqs,\
+                args.half_seed_length, range(-args.offset_range, args.offset_range + 1),\
+                args.max_mismatch_count, args.max_mig_reads, True, args.engine, metrics)
+        else:
+            # the tossed reads and seed ties of each MIG are counted apart to be stored
+            #   with its consensus
+            mig_metrics = run_metrics.RunMetrics() if args.state else metrics
+            consensus_array = consensus_generator(cluster_seqs, args.half_seed_length,\
+                                                  args.offset_range, args.max_mismatch_count,\
+                                                  args.debug, args.engine, mig_metrics)
+            if args.state:
+                collapsed.append((cluster_id,) + (tuple(consensus_array) if consensus_array\
+                                 is not None else (0, None, None))\
+                                 + (mig_metrics.counters['reads_tossed_length'],\
+                                    mig_metrics.counters['reads_tossed_mismatches'],\
+                                    mig_metrics.counters.get('seed_ties', 0)))
+                if metrics is not None:
+                    metrics.merge(mig_metrics.state())
+        if consensus_array is not None:
+            output.append('@MIG' + cluster_id + ';retained=' + str(consensus_array[0]) +\
+                          '\n' + consensus_array[1] + '\n+\n' + consensus_array[2] + '\n')
+            if metrics is not None:
+                metrics.count('migs_out')
+                metrics.count('reads_used', consensus_array[0])
+        elif metrics is not None:
+            metrics.count('migs_dropped')
+    result = (''.join(output), metrics.state()) if metrics is not None else ''.join(output)
+    return (result, collapsed) if args.state else result
+
+#-------------------------------------------------------------------------------
+def grouped_migs (filename, umi_pattern, grouped_output = None, umi_distance = 0,\
+        max_seqs = 0, metrics = None):
+    '''
+    yields (cluster ID, array of sequences) for the MIGs of reads that are not
+      grouped yet, as read_migs does for the output of fasta_barcode_count.pl;
+      the reads are grouped in memory (see umi_grouper.py)
+    1st argument--filename of the reads with the UMI at the start
+    2nd argument--(preamble, barcode, post) regular expressions
+    3rd argument--filehandle for the grouped FASTA (None to skip it)
+    4th argument--Hamming distance for merging barcodes with sequencing errors
+      into the MIGs of more abundant ones (0 for exact barcodes)
+    5th argument--MIGs of more sequences are yielded as seq_reader.StreamedMig
+      (default: 0, no limit)
+    6th argument--run_metrics.RunMetrics for the UMI counters (optional)
+    '''
+    groups = umi_grouper.group_reads(seq_reader.read_records(filename), *umi_pattern)
+    if umi_distance > 0:
+        barcode_count = len(groups.barcodes)
+        merged = groups.cluster(umi_distance)
+        sys.stderr.write('UMI clustering: ' + str(merged) + ' of ' + str(barcode_count)\
+                         + ' barcodes merged into the MIGs of more abundant ones (distance '\
+                         + str(umi_distance) + '), ' + str(len(groups.barcodes)) + ' MIGs left.\n')
+        if metrics is not None:
+            metrics.count('umi_barcodes_merged', merged)
+    if metrics is not None:
+        metrics.count('reads_grouped', len(groups))
+        for unknown, reads in groups.unknowns.items():
+            metrics.count('reads_' + unknown + '_barcode', len(reads))
+    for mig_id, barcode, cluster_seqs in groups.migs(max_seqs):
+        if grouped_output is not None:
+            grouped_output.writelines(umi_grouper.grouped_fasta(mig_id, barcode, cluster_seqs))
+        # only work with identifiable barcodes; dump the rest
+        if barcode != umi_grouper.UNKNOWN:
+            yield str(mig_id) + ';barcode=' + barcode + ';size=' + str(len(cluster_seqs)),\
+                cluster_seqs
+
+#-------------------------------------------------------------------------------
+def reuse_consensus (migs, store, pending):
+    '''
+    yields the MIGs, with those whose reads are unchanged since the previous
+      run replaced by their StoredConsensus; the others are listed in pending
+      (cluster ID: (barcode, size, reads digest)) to be stored by StateOutput.
+      Singlets and streamed MIGs are passed on as they are.
+    1st argument--iterator of (cluster ID, array of sequences) pairs
+    2nd argument--topup_state.StateStore
+    3rd argument--dictionary of the MIGs to be collapsed
+    '''
+    for cluster_id, cluster_seqs in migs:
+        match = BARCODE_FIELD.search(cluster_id)
+        if match is None or len(cluster_seqs) == 1\
+                or isinstance(cluster_seqs, seq_reader.StreamedMig):
+            yield cluster_id, cluster_seqs
+            continue
+        members = topup_state.members_digest(cluster_seqs)
+        stored = store.stored_consensus(match.group(1), len(cluster_seqs), members)
+        if stored is None:
+            pending[cluster_id] = (match.group(1), len(cluster_seqs), members)
+            yield cluster_id, cluster_seqs
+            continue
+        store.keep_mig(match.group(1), len(cluster_seqs), members, stored)
+        yield cluster_id, StoredConsensus(len(cluster_seqs), *stored)
+
+
+class StateOutput:
+    '''
+    output handle for the results of mig_batch_to_fastq with --state: writes
+      the result of each batch and stores the consensus of its collapsed MIGs
+      listed in pending (see reuse_consensus)
+    '''
+
+    def __init__(self, output, store, pending):
+        self.output  = output
+        self.store   = store
+        self.pending = pending
+
+    def write(self, batch_result):
+        result, collapsed = batch_result
+        self.output.write(result)
+        for cluster_id, *consensus in collapsed:
+            mig = self.pending.pop(cluster_id, None)
+            if mig is not None:
+                self.store.keep_mig(*mig, consensus)
+
+    def finish(self):
+        self.store.commit_migs()
+
 #-------------------------------------------------------------------------------
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('sourceName', help='Filename for the data set (e.g., "source.fasta")')
+    parser.add_argument('sourceName', help='Filename for the data set (e.g., "source.fasta";'\
+                        + ' FASTA or FASTQ, optionally gzipped)')
     parser.add_argument('-H', '--half_seed_length', nargs='?', type=int, default=10,\
                         help='Number of bases in the half-seed (default is 10 for a 21-base seed)')
     parser.add_argument('-M', '--max_mismatch_count', nargs='?', type=int, default=3,\
                         help='Number of mismatches to tolerate (default is 3)')
     parser.add_argument('-O', '--offset_range', nargs='?', type=int, default=5,\
                         help='Number of offsets to check in both directions (default is 5)')
-    parser.add_argument('--debug', help='output debug information', action='store_true')
+    parser.add_argument('--engine', choices=consensus_pfm.ENGINES,\
+                        default=consensus_pfm.DEFAULT_ENGINE,\
+                        help='Position frequency matrix engine (default is '\
+                            + consensus_pfm.DEFAULT_ENGINE + ')')
+    parser.add_argument('--max_mig_reads', nargs='?', type=int, default=0,\
+                        help='Stream the MIGs with more reads through a memory-bounded consensus,'\
+                            + ' with the seed chosen from their first MAX_MIG_READS reads'\
+                            + ' (default is 0, no limit)')
+    parser.add_argument('-W', '--workers', nargs='?', type=int, default=1,\
+                        help='Number of worker processes for MIG consensus (default is 1)')
+    parser.add_argument('-o', '--output', nargs='?', type=str, default='-',\
+                        help='Output FASTQ filename; gzipped if it ends in ".gz" (default is stdout)')
+    parser.add_argument('--umi', nargs=3, type=str, metavar=('PREAMBLE', 'BARCODE', 'POST'),\
+                        help='Group the reads by the UMI barcode at their start, found with'\
+                            + ' these regular expressions (in place of fasta_barcode_count.pl;'\
+                            + ' the input is then the ungrouped reads)')
+    parser.add_argument('--umi_distance', nargs='?', type=int, default=0,\
+                        help='With --umi: merge barcodes within this Hamming distance into'\
+                            + ' more abundant ones (directional adjacency; default is 0, off)')
+    parser.add_argument('--grouped', nargs='?', type=str,\
+                        help='With --umi: output filename for the reads grouped by barcode'\
+                            + ' (fasta_barcode_count.pl format)')
+    parser.add_argument('--state', nargs='?', type=str,\
+                        help='State store of the incremental mode (see topup_state.py): reuse the'\
+                            + ' consensus of the MIGs with the reads of the previous run')
+    parser.add_argument('--metrics', nargs='?', type=str,\
+                        help='Output JSON filename for the run metrics (time per phase, MIG and'\
+                            + ' read counters, peak memory)')
+    parser.add_argument('--debug', help='output debug information (single process)',\
+                        action='store_true')
     args = parser.parse_args()
 
-try:
-    with open(args.sourceName, encoding="utf8") as sourceFile:
-        clusterSeqAlignment = []
-        consensusArray = []
-        half_seed_length = args.half_seed_length
-        offset_range = args.offset_range
-        max_mismatch_count = args.max_mismatch_count
-
-        # sys.exit('half_seed_length:' + str(half_seed_length) + ' offset_range:' +\
-        #     str(offset_range) + ' max_mismatch_count:' + str(max_mismatch_count))
-
-        header = sourceFile.readline()
-        while header:
-            header = header.rstrip()
-
-            # only work with identifiable barcodes; dump the rest
-            if re.search('barcode=unknown', header) is None:
-                m = re.search(r'size=(\d+)[:;]element=(\d+)', header)
-                if m is not None:
-                    clusterSize = int(m.group(1))
-                    elementID = int(m.group(2))
-                    ############## FASTA harvest block ##############
-                    sequence = sourceFile.readline()
-                    if sequence is None:
-                        sys.exit('!!!Error at:\n' + header)
-                    sequence = sequence.rstrip()
-                    #################################################
-                    # start of a new cluster; initialize
-                    if clusterSize == elementID:
-                        counter = clusterSize
-                        clusterID = re.sub('^>MIG','',header)
-                        clusterID = re.sub(r'[:;]element=\d+','',clusterID)
-
-                    if clusterSize >= 2:
-                        clusterSeqAlignment.append(sequence)
-                        counter -= 1
-                    else:
-                        print('@MIG' + clusterID + ";retained=1")
-                        print(sequence + '\n' + '+')
-                        print('#' * len(sequence))
-
-                    # at the end of cluster: for non-singlets,
-                    #   store the padded sequences in the alignment
-                    if counter == 0:
-                        consensusArray = consensus_generator(clusterSeqAlignment,\
-                                                             half_seed_length, offset_range,\
-                                                                 max_mismatch_count, args.debug)
-                        clusterSeqAlignment = [] # clear the collection when done
-
-                        if consensusArray is not None:
-                            print('@MIG' + clusterID + ';retained=' + str(consensusArray[0]))
-                            print(consensusArray[1] + '\n+')
-                            print(consensusArray[2])
-            header = sourceFile.readline()
-
-except FileNotFoundError:
-    sys.exit('File ' + args.sourceName + ' was not found!')
+    if (args.grouped or args.umi_distance) and not args.umi:
+        sys.exit('Error: --grouped and --umi_distance require the UMI patterns (--umi).')
+    if args.max_mig_reads and args.max_mig_reads < 2:
+        sys.exit('Error: --max_mig_reads has to be at least 2 (or 0 for no limit).')
+
+    metrics = run_metrics.RunMetrics() if args.metrics else None
+    store = topup_state.StateStore(args.state) if args.state else None
+    if store is not None:
+        # the stored consensus depends on the consensus options and code
+        store.check_settings('consensus', topup_state.settings_key((args.half_seed_length,\
+            args.max_mismatch_count, args.offset_range, args.engine), (__file__,\
+            consensus_pfm.__file__, consensus_stream.__file__, seed_index.__file__)), 'migs')
+    pending = {}
+    try:
+        with stream_io.open_output(args.output) as output,\
+                (stream_io.open_output(args.grouped) if args.grouped\
+                 else contextlib.nullcontext()) as grouped_output,\
+                (store if store is not None else contextlib.nullcontext()):
+            results = run_metrics.MetricsOutput(output, metrics) if metrics is not None else output
+            if store is not None:
+                results = StateOutput(results, store, pending)
+            with mig_pool.OrderedMigPool(mig_batch_to_fastq, (args,),\
+                                         1 if args.debug else args.workers, results) as mig_queue:
+                if args.umi:
+                    migs = grouped_migs(args.sourceName, args.umi, grouped_output,\
+                                        args.umi_distance, args.max_mig_reads, metrics)
+                else:
+                    # only work with identifiable barcodes; dump the rest
+                    migs = seq_reader.read_migs(seq_reader.read_records(args.sourceName),\
+                        keep=lambda record: 'barcode=unknown' not in record.header,\
+                        id_prefix='MIG', max_seqs=args.max_mig_reads)
+                if store is not None:
+                    migs = reuse_consensus(migs, store, pending)
+                if metrics is not None:
+                    migs = metrics.timed('parse', migs)
+                for cluster_id, cluster_seqs in migs:
+                    mig_queue.add(cluster_id, cluster_seqs)
+            if store is not None:
+                results.finish()
+
+    except FileNotFoundError:
+        sys.exit('File ' + args.sourceName + ' was not found!')
+
+    if metrics is not None:
+        metrics.write(args.metrics, 'fasta_barcode_consensus.py', [args.sourceName], 'reads_in')
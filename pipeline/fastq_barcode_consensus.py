@@ -5,6 +5,9 @@ fastq_barcode_consensus.py
   barcodes. Implemented using a position frequency matrix; quality scores derived
   as Cumulative Quality Score. This avoids introduction of gaps and significantly
   improves runtime (real alignment takes a long time).
+  With --paired (asymmetric sequencing, UMI5RACEASYM), the fwd and rev MIGs of
+  each barcode are processed together and written as an interleaved pair for
+  FLASH; barcodes without both orientations are dropped.
 '''
 
 # Q-score encoding conventions, taken from Wikipedia:
@@ -32,8 +35,42 @@ fastq_barcode_consensus.py
 
 import sys
 import argparse
+import collections
+import itertools
 import re
 
+import consensus_pfm
+import consensus_stream
+import mig_pool
+import run_metrics
+import seed_index
+import seq_reader
+import stream_io
+
+# consensus of a MIG: number of reads used, sequence, quality
+Consensus = collections.namedtuple('Consensus', 'retained seq qual')
+
+# MIG ID of the ordered asymmetric reads (fastq_asym_barcode_order.pl): MIG
+#   number, adapters, orientation, barcode, size
+PAIR_ID = re.compile(r'^(\d+;)[^;]+;orient_(fwd|rev);(barcode=[ATCG]+);valid;size=(\d+)')
+
+
+class MigPair:
+    '''
+    the fwd and rev MIGs of a barcode, each as (MIG size, array of sequences);
+      a streamed MIG is held as its Consensus (or None), computed in place
+    '''
+    __slots__ = ('fwd', 'rev')
+
+    def __init__(self):
+        self.fwd = None
+        self.rev = None
+
+    def __len__(self):
+        return sum(len(side[1]) for side in (self.fwd, self.rev)\
+                   if side is not None and isinstance(side[1], list))
+
+
 #-------------------------------------------------------------------------------
 def get_seed_left (seq, half_seed, offset):
     '''
@@ -50,7 +87,7 @@ def get_seed_left (seq, half_seed, offset):
 
 #-------------------------------------------------------------------------------
 def consensus_generator (input_seqs, half_seed_len, offset_rng,\
-        max_mismatch_cnt, debug_flag = 0):
+        max_mismatch_cnt, debug_flag = 0, engine = consensus_pfm.DEFAULT_ENGINE, metrics = None):
     '''
     generate consensus sequence/quality score pair from an array of arrays of strings
     1st argument--arrays of sequences
@@ -58,34 +95,41 @@ def consensus_generator (input_seqs, half_seed_len, offset_rng,\
     3rd argument--offset range (e.g., 5)
     4th argument--maxMismatch (e.g., 3)
     5th argument--DEBUG flag
+    6th argument--PFM engine ('numpy' or 'python', see consensus_pfm.py)
+    7th argument--run_metrics.RunMetrics for the phase times and read counters (optional)
     returns array of consensus sequence, quality, number of sequences used
     adapted from the MIGEC code (PMID: 24793455)
     https://github.com/mikessh/migec/blob/master/src/main/groovy/com/milaboratory/migec/Assemble.groovy
     '''
 
-    nt_codes = { 'N' : 0, 'A' : 1, 'T' : 2, 'C' : 3, 'G' : 4 }
-    code_nts = ['N','A','T','C','G']
     seed_dict = {}
     valid_seq_refs = []
+    valid_seq_seeds = []
     seqs_with_offsets = []
-    best_seed = ''
+    best_seed = None
     best_seed_data = [0,0]
     max_left_arm = 0
     max_right_arm = 0
     removed_elements =[]
 
-    # find all possible seed sequences and their offsets, check lengths and find maximum
+    clock = metrics.clock() if metrics is not None else None
+    seed_offsets = range(offset_rng + 1)
+    seed_bounds = [(offset, offset + half_seed_len * 2) for offset in seed_offsets]
+
+    # find all possible seed sequences and their offsets, check lengths and find maximum;
+    #  the seeds of each read are packed once (see seed_index.py) and reused below
     for ind, seq in enumerate(input_seqs):
         # make sure the sequence is long enough
         if len(seq) > (half_seed_len * 2 + offset_rng + 1):
-            for offset in range(offset_rng + 1):
-                seed = get_seed_left(seq, half_seed_len, offset)
-                # initialize seed_dict entry, if necessary
+            seeds = seed_index.packed_seeds(seq, seed_bounds)
+            for offset, seed in zip(seed_offsets, seeds):
+                # initialize seed_dict entry, if necessary (keep the first occurrence)
                 if seed not in seed_dict:
-                    seed_dict[seed] = [0,0]
+                    seed_dict[seed] = [0,0,ind,offset]
                 seed_dict[seed][0] += 1      # increment count
                 seed_dict[seed][1] += offset # add to the cumulative offset
             valid_seq_refs.append(ind)
+            valid_seq_seeds.append(seeds)
         else:
             removed_elements.append(len(input_seqs)-ind)
 
@@ -102,21 +146,23 @@ def consensus_generator (input_seqs, half_seed_len, offset_rng,\
             best_seed = seed_seq
             best_seed_data = seed_data.copy()
 
+    if debug_flag and best_seed is not None:
+        # the seed string itself is only needed for the debug output
+        best_seed_str = get_seed_left(input_seqs[best_seed_data[2]], half_seed_len,\
+                                      best_seed_data[3])
+
     # identify the best match to seed for each sequence, load into the position frequency matrix
-    for ind in valid_seq_refs:
+    for ind, seeds in zip(valid_seq_refs, valid_seq_seeds):
         best_offset = 0
         best_mismatch_count = half_seed_len * 2 + 1 # max out the mismatch_count
 
-        for offset in range(offset_rng + 1):
-            mismatch_count = 0
-            seed = get_seed_left(input_seqs[ind], half_seed_len, offset)
-
+        for offset, seed in zip(seed_offsets, seeds):
             if seed == best_seed:
                 best_offset = offset
                 best_mismatch_count = 0
                 break
 
-            mismatch_count = sum(c1!=c2 for c1,c2 in zip(seed,best_seed))
+            mismatch_count = seed_index.seed_mismatches(seed, best_seed)
             if mismatch_count < best_mismatch_count:
                 best_mismatch_count = mismatch_count
                 best_offset = offset
@@ -131,11 +177,11 @@ def consensus_generator (input_seqs, half_seed_len, offset_rng,\
         elif debug_flag:
             seed = get_seed_left(input_seqs[ind], half_seed_len, best_offset)
             print ("#### Tossing element", len(input_seqs)-ind, "with", best_mismatch_count,\
-                   "mismatches for", seed, "with respect to", best_seed, ":")
+                   "mismatches for", seed, "with respect to", best_seed_str, ":")
             print (input_seqs[ind])
             for offset in range(offset_rng + 1):
                 seed = get_seed_left(input_seqs[ind], half_seed_len, offset)
-                mismatch_count = sum(c1!=c2 for c1,c2 in zip(seed,best_seed))
+                mismatch_count = sum(c1!=c2 for c1,c2 in zip(seed,best_seed_str))
                 print(offset, ":", seed, "--", mismatch_count)
 
 
@@ -145,65 +191,19 @@ def consensus_generator (input_seqs, half_seed_len, offset_rng,\
         if removed_elements is not None:
             print('#### Removed the following elements (too short)', removed_elements)
 
+    if metrics is not None:
+        clock = metrics.add_time('seed_search', clock)
+        metrics.count('reads_tossed_length', len(removed_elements))
+        metrics.count('reads_tossed_mismatches',\
+                      len(valid_seq_refs) - len(seqs_with_offsets))
+        if sum(seed_data[:2] == best_seed_data[:2] for seed_data in seed_dict.values()) > 1:
+            metrics.count('seed_ties')
+
     if len(seqs_with_offsets) > 1:
-        # position_freq_matrix length should be the sum of maximum arms from the
-        #  sequences in the alignment dataset
-        pfm_length = max_left_arm + max_right_arm
-        # initialize the position_freq_matrix array
-        position_freq_matrix = []
-        pfm_row = []
-        for nt_code in range(len(code_nts)):
-            pfm_row.append(0)
-        for pos in range(pfm_length):
-            position_freq_matrix.append(pfm_row.copy())
-
-        if debug_flag:
-            print("#### Alignment for the current MIG. ####")
-
-        # load the position frequency matrix
-        for ind, seq_plus_offsets in enumerate(seqs_with_offsets):
-            seq = 'N'*(max_left_arm - seq_plus_offsets[0]) +\
-                input_seqs[seq_plus_offsets[2]] + 'N'*(max_right_arm -\
-                                                          seq_plus_offsets[1])
-            for pos in range(pfm_length):
-                position_freq_matrix[pos][nt_codes[seq[pos]]] += 1
-
-            if debug_flag:
-                print(">element" + str(len(input_seqs)-seq_plus_offsets[2]),\
-                      "leftOffset =", seq_plus_offsets[0], "rightOffset =",\
-                          seq_plus_offsets[1])
-                print(seq)
-
-        if debug_flag:
-            print("########################################")
-            print ("#### Contents of the positional frequency matrix for the current MIG.")
-            print ("######## N\tA\tT\tC\tG")
-            for row in position_freq_matrix:
-                print("# values ", end='')
-                for element in row:
-                    print(element, end='\t')
-                print()
-            print('.....\n\n')
-
-        consensus_seq = '' # initialize consensus sequence
-        consensus_qual = '' # initialize consensus quality
-        for pos in range(pfm_length):
-            best_base = 0
-            max_count = 0
-            for nt_code in range(1,len(nt_codes)):
-                if position_freq_matrix[pos][0]:
-                    position_freq_matrix[pos][nt_code] += position_freq_matrix[pos][0]/4
-                if max_count <  position_freq_matrix[pos][nt_code]:
-                    max_count = position_freq_matrix[pos][nt_code]
-                    best_base = code_nts[nt_code]
-            consensus_seq += best_base
-
-            if best_base != 'N':
-                # cumulative quality score (CQS) from MIGEC #####
-                best_base_qual = int(((max_count/len(seqs_with_offsets) - 0.25)) / 0.75 * 40 + 33)
-                consensus_qual += chr(35 if best_base_qual < 35 else best_base_qual)
-            else:
-                consensus_qual += chr(35)
+        consensus_seq, consensus_qual = consensus_pfm.PFM_ENGINES[engine](input_seqs,\
+            seqs_with_offsets, max_left_arm, max_right_arm, debug_flag)
+        if metrics is not None:
+            metrics.add_time('pfm', clock)
     else:
         # return a null value if dealing with a singlet (after tossing the bad sequences)
         return None
@@ -212,10 +212,136 @@ def consensus_generator (input_seqs, half_seed_len, offset_rng,\
     consensus = [len(seqs_with_offsets), consensus_seq, consensus_qual]
     return consensus
 
+#-------------------------------------------------------------------------------
+def mig_consensus (cluster_seqs, args, metrics = None):
+    '''
+    returns the Consensus of a MIG, or None if the MIG is dropped: singlets are
+      passed through (only when min_size is 1), non-singlets are collapsed by
+      consensus_generator
+    1st argument--array of sequences (or seq_reader.StreamedMig)
+    2nd argument--parsed commandline arguments
+    3rd argument--run_metrics.RunMetrics (optional)
+    '''
+    if metrics is not None:
+        metrics.count('migs_in')
+        metrics.count('reads_in', len(cluster_seqs))
+    if len(cluster_seqs) == 1:
+        if metrics is not None:
+            metrics.count('singlets')
+        if args.min_size == 1: # take care of the singlets
+            return Consensus(1, cluster_seqs[0], '#' * len(cluster_seqs[0]))
+        return None
+
+    if isinstance(cluster_seqs, seq_reader.StreamedMig):
+        consensus_array = consensus_stream.streaming_consensus(cluster_seqs,\
+            args.half_seed_length, range(args.offset_range + 1), args.max_mismatch_count,\
+            args.max_mig_reads, False, args.engine, metrics)
+    else:
+        consensus_array = consensus_generator(cluster_seqs, args.half_seed_length,\
+                                              args.offset_range, args.max_mismatch_count,\
+                                              args.debug, args.engine, metrics)
+    if consensus_array is None:
+        if metrics is not None:
+            metrics.count('migs_dropped')
+        return None
+    if len(consensus_array) >= int(args.min_size):
+        if metrics is not None:
+            metrics.count('reads_used', consensus_array[0])
+        return Consensus(*consensus_array)
+    return None
+
+#-------------------------------------------------------------------------------
+def mig_batch_to_fastq (migs, args):
+    '''
+    returns FASTQ output for a batch of MIGs (see mig_consensus)
+    1st argument--array of (cluster ID, array of sequences) pairs
+    2nd argument--parsed commandline arguments
+    returns (FASTQ text, run_metrics.RunMetrics state) with --metrics
+    '''
+    output = []
+    metrics = run_metrics.RunMetrics() if args.metrics else None
+    for cluster_id, cluster_seqs in migs:
+        consensus = mig_consensus(cluster_seqs, args, metrics)
+        if consensus is not None:
+            output.append('@MIG' + cluster_id + ';retained=' + str(consensus.retained) +\
+                          '\n' + consensus.seq + '\n+\n' + consensus.qual + '\n')
+            if metrics is not None:
+                metrics.count('migs_out')
+    return (''.join(output), metrics.state()) if metrics is not None else ''.join(output)
+
+#-------------------------------------------------------------------------------
+def pair_migs (migs, args, metrics = None):
+    '''
+    yields (pair ID, MigPair) for the barcodes with MIGs of both orientations
+      (consecutive in the ordered reads); the MIGs of the other barcodes are
+      dropped without computing their consensus. A streamed MIG has to be read
+      before the next one, so its consensus is computed in place.
+    1st argument--iterator of (cluster ID, array of sequences) pairs (see
+      seq_reader.read_migs)
+    2nd argument--parsed commandline arguments
+    3rd argument--run_metrics.RunMetrics (optional)
+    '''
+    pair_id = None
+    pair = MigPair()
+    for cluster_id, cluster_seqs in itertools.chain(migs, [(None, None)]):
+        match = PAIR_ID.match(cluster_id) if cluster_id is not None else None
+        if cluster_id is not None and match is None:
+            sys.exit('Error: the following ID is incorrectly formatted:\n' + cluster_id)
+        if match is None or match.group(1) + match.group(3) != pair_id:
+            if pair.fwd is not None and pair.rev is not None:
+                yield pair_id, pair
+            elif pair_id is not None and metrics is not None:
+                metrics.count('migs_unpaired')
+            if match is None:
+                return
+            pair_id = match.group(1) + match.group(3)
+            pair = MigPair()
+        if isinstance(cluster_seqs, seq_reader.StreamedMig):
+            cluster_seqs = mig_consensus(cluster_seqs, args, metrics)
+        setattr(pair, match.group(2), (int(match.group(4)), cluster_seqs))
+
+#-------------------------------------------------------------------------------
+def pair_batch_to_fastq (pairs, args):
+    '''
+    returns interleaved FASTQ output for a batch of barcode pairs: the fwd and
+      rev consensus of each barcode under the same header ("@MIG<n>;barcode=...;
+      fwd:<size>:<retained>:rev:<size>:<retained>;retained=<sum>", formerly
+      fastq_barcode_consensus_interleaved_filter.pl); a pair is dropped if
+      either MIG is (see mig_consensus)
+    1st argument--array of (pair ID, MigPair) pairs
+    2nd argument--parsed commandline arguments
+    returns (FASTQ text, run_metrics.RunMetrics state) with --metrics
+    '''
+    output = []
+    metrics = run_metrics.RunMetrics() if args.metrics else None
+    for pair_id, pair in pairs:
+        sides = []
+        for size, seqs in (pair.fwd, pair.rev):
+            consensus = mig_consensus(seqs, args, metrics) if isinstance(seqs, list) else seqs
+            if consensus is None:
+                break
+            sides.append((size, consensus))
+        if len(sides) < 2:
+            if metrics is not None:
+                metrics.count('pairs_dropped')
+            continue
+
+        (fwd_size, fwd), (rev_size, rev) = sides
+        header = '@MIG' + pair_id + ';fwd:' + str(fwd_size) + ':' + str(fwd.retained)\
+            + ':rev:' + str(rev_size) + ':' + str(rev.retained)\
+            + ';retained=' + str(fwd.retained + rev.retained) + '\n'
+        output.append(header + fwd.seq + '\n+\n' + fwd.qual + '\n'\
+                      + header + rev.seq + '\n+\n' + rev.qual + '\n')
+        if metrics is not None:
+            metrics.count('migs_out', 2)
+            metrics.count('pairs_out')
+    return (''.join(output), metrics.state()) if metrics is not None else ''.join(output)
+
 #-------------------------------------------------------------------------------
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('sourceName', help='Filename for the data set (e.g., "source.fasta")')
+    parser.add_argument('sourceName', help='Filename for the data set (e.g., "source.fasta";'\
+                        + ' FASTA or FASTQ, optionally gzipped)')
     parser.add_argument('-H', '--half_seed_length', nargs='?', type=int, default=10,\
                         help='Number of bases in the half-seed (default is 10 for a 21-base seed)')
     parser.add_argument('-M', '--max_mismatch_count', nargs='?', type=int, default=3,\
@@ -224,76 +350,51 @@ if __name__ == '__main__':
                         help='Number of offsets to check in one direction (default is 11)')
     parser.add_argument('-S', '--min_size', nargs='?', type=int, default=1, \
                         help='Minimal number of retained sequences in a MIG (default is 1)')
-    parser.add_argument('--debug', help='output debug information', action='store_true')
+    parser.add_argument('--engine', choices=consensus_pfm.ENGINES,\
+                        default=consensus_pfm.DEFAULT_ENGINE,\
+                        help='Position frequency matrix engine (default is '\
+                            + consensus_pfm.DEFAULT_ENGINE + ')')
+    parser.add_argument('--max_mig_reads', nargs='?', type=int, default=0,\
+                        help='Stream the MIGs with more reads through a memory-bounded consensus,'\
+                            + ' with the seed chosen from their first MAX_MIG_READS reads'\
+                            + ' (default is 0, no limit)')
+    parser.add_argument('--paired', action='store_true',\
+                        help='Process the fwd and rev MIGs of each barcode together (asymmetric'\
+                            + ' sequencing) and write the interleaved pairs (for FLASH)')
+    parser.add_argument('-W', '--workers', nargs='?', type=int, default=1,\
+                        help='Number of worker processes for MIG consensus (default is 1)')
+    parser.add_argument('-o', '--output', nargs='?', type=str, default='-',\
+                        help='Output FASTQ filename; gzipped if it ends in ".gz" (default is stdout)')
+    parser.add_argument('--metrics', nargs='?', type=str,\
+                        help='Output JSON filename for the run metrics (time per phase, MIG and'\
+                            + ' read counters, peak memory)')
+    parser.add_argument('--debug', help='output debug information (single process)',\
+                        action='store_true')
     args = parser.parse_args()
 
-try:
-    with open(args.sourceName, encoding="utf8") as sourceFile:
-        cluster_seq_alignment = []
-        consensus_array = []
-        half_seed_length = args.half_seed_length   # default: checking 21-mers (10*2+1)
-        offset_range = args.offset_range      # default: checking 11 positions
-        max_mismatch_count = args.max_mismatch_count  # default: checking with 3-mismatch tolerance
-        min_size = args.min_size # default: 1, output all sequences
-
-        header = sourceFile.readline()
-        while header:
-            header = header.rstrip()
-
+    if args.max_mig_reads and args.max_mig_reads < 2:
+        sys.exit('Error: --max_mig_reads has to be at least 2 (or 0 for no limit).')
+
+    metrics = run_metrics.RunMetrics() if args.metrics else None
+    try:
+        with stream_io.open_output(args.output) as output,\
+                mig_pool.OrderedMigPool(pair_batch_to_fastq if args.paired else mig_batch_to_fastq,\
+                                        (args,),\
+                                        1 if args.debug else args.workers,\
+                                        run_metrics.MetricsOutput(output, metrics)\
+                                        if metrics is not None else output) as mig_queue:
             # only work with sequences labeled as valid; dump the rest
-            if re.search(';valid;', header) is not None:
-                m = re.search(r'size=(\d+)[:;]element=(\d+)', header)
-                if m is not None:
-                    clusterSize = int(m.group(1))
-                    elementID = int(m.group(2))
-                    ############## FASTQ harvest block ##############
-                    sequence = sourceFile.readline()
-                    if sequence is None:
-                        sys.exit('!!!Error at:\n' + header)
-                    sequence = sequence.rstrip()
-
-                    line = sourceFile.readline()
-                    if not line.startswith('+'):
-                        sys.exit('Error: invalid FASTQ format in ' + args.sourceName\
-                                 + ' at:\n' + header)
-
-                    qual = sourceFile.readline()
-                    if qual is None:
-                        sys.exit('!!!Error at:\n' + header)
-                    qual = qual.rstrip()
-
-                    # sanity check: each base should have a quality call
-                    if len(sequence) != len(qual):
-                        sys.exit('!!!Error: invalid FASTQ format at \n' + header) # exit on error
-                    #################################################
-                    # start of a new cluster; initialize
-                    if clusterSize == elementID:
-                        counter = clusterSize
-                        clusterID = re.sub('^@','',header)
-                        clusterID = re.sub(r'[:;]element=\d+','',clusterID)
-
-                    if clusterSize >= 2:
-                        cluster_seq_alignment.append(sequence)
-                        counter -= 1
-                    elif min_size == 1: # take care of the singlets
-                        print('@MIG' + clusterID + ";retained=1")
-                        print(sequence + '\n' + '+')
-                        print('#' * len(sequence))
-
-                    # at the end of cluster: for non-singlets,
-                    #  store the padded sequences in the alignment
-                    if counter == 0:
-                        consensus_array = consensus_generator(cluster_seq_alignment,\
-                                                             half_seed_length, offset_range,\
-                                                                 max_mismatch_count, args.debug)
-                        cluster_seq_alignment = [] # clear the collection when done
-
-                        if consensus_array is not None:
-                            if len(consensus_array) >= int(min_size):
-                                print('@MIG' + clusterID + ';retained=' + str(consensus_array[0]))
-                                print(consensus_array[1] + '\n+')
-                                print(consensus_array[2])
-            header = sourceFile.readline()
-
-except FileNotFoundError:
-    sys.exit('File ' + args.sourceName + ' was not found!')
+            migs = seq_reader.read_migs(seq_reader.read_records(args.sourceName),\
+                keep=lambda record: record.valid, max_seqs=args.max_mig_reads)
+            if metrics is not None:
+                migs = metrics.timed('parse', migs)
+            if args.paired:
+                migs = pair_migs(migs, args, metrics)
+            for cluster_id, cluster_seqs in migs:
+                mig_queue.add(cluster_id, cluster_seqs)
+
+    except FileNotFoundError:
+        sys.exit('File ' + args.sourceName + ' was not found!')
+
+    if metrics is not None:
+        metrics.write(args.metrics, 'fastq_barcode_consensus.py', [args.sourceName], 'reads_in')
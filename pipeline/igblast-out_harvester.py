@@ -5,72 +5,25 @@ igblast-out_harvester.py
 
 import sys
 import argparse
+import contextlib
+import collections
+import functools
+import io
+import itertools
+import json
+import mmap
 import re
-from os.path import exists
-
-
-def codon2aa(codon):
-    '''
-        Look up the amino acid from a codon.
-        1st argument--codon
-        returns an amino acid
-        adapted from http://www.techcuriosity.com/resources/bioinformatics/dna2protein.php
-    '''
-
-    gcode = {'TCA':'S','TCC':'S','TCG':'S','TCT':'S','AGC':'S','AGT':'S',
-             'TTC':'F','TTT':'F',
-             'TTA':'L','TTG':'L','CTA':'L','CTC':'L','CTG':'L','CTT':'L',
-             'TAC':'Y','TAT':'Y',
-             'TAA':'*','TAG':'*','TGA':'*',
-             'TGC':'C','TGT':'C',
-             'TGG':'W',
-             'CCA':'P','CCC':'P','CCG':'P','CCT':'P',
-             'CAC':'H','CAT':'H',
-             'CAA':'Q','CAG':'Q',
-             'CGA':'R','CGC':'R','CGG':'R','CGT':'R','AGA':'R','AGG':'R',
-             'ATA':'I','ATC':'I','ATT':'I',
-             'ATG':'M',
-             'ACA':'T','ACC':'T','ACG':'T','ACT':'T',
-             'AAC':'N','AAT':'N',
-             'AAA':'K','AAG':'K',
-             'GTA':'V','GTC':'V','GTG':'V','GTT':'V',
-             'GCA':'A','GCC':'A','GCG':'A','GCT':'A',
-             'GAC':'D','GAT':'D',
-             'GAA':'E','GAG':'E',
-             'GGA':'G','GGC':'G','GGG':'G','GGT':'G',
-             'NAA':'X','NAT':'X','NAG':'X','NAC':'X','NTA':'X','NTT':'X','NTG':'X','NTC':'X',
-             'NGA':'X','NGT':'X','NGG':'X','NGC':'X','NCA':'X','NCT':'X','NCG':'X','NCC':'X',
-             'ANA':'X','ANT':'X','ANG':'X','ANC':'X','TNA':'X','TNT':'X','TNG':'X','TNC':'X',
-             'GNA':'X','GNT':'X','GNG':'X','GNC':'X','CNA':'X','CNT':'X','CNG':'X','CNC':'X',
-             'AAN':'X','ATN':'X','AGN':'X','ACN':'X','TAN':'X','TTN':'X','TGN':'X','TCN':'X',
-             'GAN':'X','GTN':'X','GGN':'X','GCN':'X','CAN':'X','CTN':'X','CGN':'X','CCN':'X',
-             'ANN':'X','TNN':'X','CNN':'X','GNN':'X',
-             'NAN':'X','NTN':'X','NCN':'X','NGN':'X',
-             'NNA':'X','NNT':'X','NNC':'X','NNG':'X',
-             'NNN':'X'
-            }
-
-    if codon in gcode:
-        return gcode[codon]
-
-    sys.exit('Bad codon \"' + codon + '\"!!\n\n')
-
-def translate(seq):
-    '''
-    translate input sequence
-      adapted from http://www.techcuriosity.com/resources/bioinformatics/dna2protein.php
-    '''
-
-    codon = ''
-    transl = ''
-    ind = 0
-
-    while ind < (len(seq) - 2):
-        codon = seq[ind:ind+3]
-        transl = transl + codon2aa(codon)
-        ind = ind + 3
-
-    return transl
+from os.path import exists, getsize
+
+import annotation_table
+import clonotypes
+import mig_pool
+import run_metrics
+import seq_reader
+import stream_io
+import topup_state
+import translator
+
 
 def rev_comp(seq):
     '''
@@ -84,305 +37,1144 @@ def rev_comp(seq):
     table = seq.maketrans(complement)
     return seq.translate(table)
 
+class IgBlastRecord:
+    '''
+    data harvested from one IgBLAST output block
+      query        ... query ID
+      q_length     ... query length
+      gene_usage   ... V-(D)-J rearrangement summary line
+      rearr        ... junction nucleotide sequence
+      cdr3_nt      ... CDR3 nucleotide sequence
+      cdr3_bounds  ... [start, end] of the CDR3
+      cdr3_aa      ... CDR3 amino acid sequence
+      perc_ident   ... percent identity to the top V gene
+      cov          ... percent of the query covered by the V alignment
+      trunc_flags  ... Fr1, CDR1, Fr2, CDR2, Fr3, CDR3, J-family flags
+                       (1 if the region is absent)
+      fwk_bounds   ... from/to positions of the alignment summary rows
+      q_rev_flag   ... 1 if the query is reverse-complemented
+    '''
+    __slots__ = ('query', 'q_length', 'gene_usage', 'rearr', 'cdr3_nt', 'cdr3_bounds',\
+                 'cdr3_aa', 'perc_ident', 'cov', 'trunc_flags', 'fwk_bounds', 'q_rev_flag')
+
+    def __init__(self, query):
+        self.query       = query
+        self.q_length    = 0
+        self.gene_usage  = ''
+        self.rearr       = ''
+        self.cdr3_nt     = '0null0'
+        self.cdr3_bounds = [0, 0]
+        self.cdr3_aa     = '0null0'
+        self.perc_ident  = 0
+        self.cov         = 0
+        self.trunc_flags = [1, 1, 1, 1, 1, 1, 1]
+        self.fwk_bounds  = []
+        self.q_rev_flag  = 0
+
+
+# parser states: scanning for section headers, or expecting the section data
+SCAN, SUMMARY_LINE, JUNCTION_LINE, CDR3_LINE, ALIGNMENT_TABLE = range(5)
+
+# section headers, keyed by the first character of the line
+SECTION_HEADERS = {
+    'L' : (('Length=', 'length'),),
+    'V' : (('rearrangement summary for query sequence', 'summary'),\
+           ('junction details based on top germline gene', 'junction')),
+    'S' : (('region sequence details', 'cdr3'),),
+    'A' : (('Alignment summary', 'table'),),
+    '*' : (('***** No hits found *****', 'no_hits'),),
+    'E' : (('Effective search space used', 'end'),),
+}
+
+AA_SET          = r'[ACDEFGHIKLMNPQRSTVWXY\*]'
+NT_SET          = r'[ACGTN]'
+QUERY_LINE      = re.compile(r'Query=\s(\S*)')
+LENGTH_FIELD    = re.compile(r'Length=(\d+)')
+REVERSE_STRAND  = re.compile(r'\t\-\t?[^\t]*$')
+J_MISSING       = re.compile(r'\tN\/A\s*$')
+JUNCTION_MARKS  = re.compile(r'N\/A|\(|\)|\t')
+CDR3_LINE_DATA  = re.compile(r'CDR3\s+(' + NT_SET + r'+)\s+(' + AA_SET + r'*)\t(\d+)\t(\d+)')
+TABLE_ROW       = re.compile(r'([^\t]+)\t(\S+)\t(\S+)\t(\d+)\t\S+\t\S+\t\S+\t(\d+\.?\d*)')
+
+# alignment summary rows (by name prefix) and their truncation flag positions
+TABLE_ROW_FLAGS = {'FR1' : 0, 'CDR1' : 1, 'FR2' : 2, 'CDR2' : 3, 'FR3' : 4, 'CDR3' : 5}
+
 def parse_igblast_block(file, line):
     '''
-    read from the IgBLAST output file and store data
-    1st argument -- filehandle for reading inputFile
+    read from the IgBLAST output file and store data; the lines are
+      dispatched on their first character to the section handlers, and the
+      line following a section header is read as that section's data
+    1st argument -- filehandle (or line iterator) for reading inputFile
     2nd argument -- first line in the block ("Query...")
-    returns hash containing (keys):
-      ['query']
-      ['q_length']
-      ['gene_usage']
-      ['rearr']
-      ['cdr3_nt']      ... CDR3 nucleotide sequence
-      ['cdr3_bounds']  array
-      ['cdr3_aa']      ... CDR3 amino acid sequence
-      ['perc_ident']
-      ['cov']
-      ['trunc_flags'] array
-      ['fwk_bounds']  array
-      ['q_rev_flag']
-    '''
-
-    end_table_flag        = 0
-    end_block_flag        = 0
-    aa_set                = r'[ACDEFGHIKLMNPQRSTVWXY\*]'
-    nt_set                = r'[ACGTN]'
-    alignment_tbl_data    = {}
-    result                = {}
-
-    result['q_length']    = 0
-    result['gene_usage']  = ''
-    result['rearr']       = ''
-    result['cdr3_aa']     = '0null0'
-    result['cdr3_nt']     = '0null0'
-    result['perc_ident']  = 0
-    result['cov']         = 0
-
-    # positions for Fr1, CDR1, Fr2, CDR2, Fr3, CDR3, J-family assignment
-    result['trunc_flags'] = [1, 1, 1, 1, 1, 1, 1 ]
-    result['cdr3_bounds'] = [0, 0]
-    result['fwk_bounds']  = []
-    result['q_rev_flag']  = 0
-
-    match_result = re.search(r'^Query=\s(\S*)', line)
+    returns IgBlastRecord
+    '''
+    match_result = QUERY_LINE.match(line)
 
     if match_result is None:
         sys.exit('Error: invald start of IgBLAST output section at ' + line + '.')
 
-    result['query'] = match_result.group(1)
+    result = IgBlastRecord(match_result.group(1))
+    state  = SCAN
 
-    line = file.readline() # initial read
+    for line in file:
+        if state == SCAN:
+            for header, section in SECTION_HEADERS.get(line[:1], ()):
+                if header in line:
+                    break
+            else:
+                continue
 
-    while not end_block_flag and line:
-        # skip all empty lines
-        while re.search(r'^\s*$', line):
-            line = file.readline()
+            if section == 'length':
+                match_result = LENGTH_FIELD.search(line)
+                if match_result:
+                    result.q_length = int(match_result.group(1))
+            elif section == 'summary':
+                state = SUMMARY_LINE
+            elif section == 'junction':
+                state = JUNCTION_LINE
+            elif section == 'cdr3':
+                state = CDR3_LINE
+            elif section == 'table':
+                # Framework alignment summary table; expected to end with the "Total" line
+                if line.startswith('Alignment summary'):
+                    state = ALIGNMENT_TABLE
+            elif section == 'no_hits':
+                result.gene_usage = 'invalid_query_seq'
+                result.rearr      = ''
+                result.cov        = 0
+                result.perc_ident = 0
+            else:
+                break
 
-        match_result = re.search(r'Length=(\d+)', line)
-        if match_result:
-            result['q_length'] = int(match_result.group(1))
+        elif state == ALIGNMENT_TABLE:
+            match_result = TABLE_ROW.match(line)
+            if match_result is None:
+                continue
 
-            line = file.readline()
-            # skip all empty lines
-            while re.search(r'^\s*$', line):
-                line = file.readline()
+            rowname = match_result.group(1)
+            if rowname == 'Total':
+                result.perc_ident = float(match_result.group(5))
+                result.cov = 100 * int(match_result.group(4)) / result.q_length
+                state = SCAN
+                continue
 
-        match_result = re.search(r'rearrangement summary for query sequence', line)
-        if match_result:
-            line = file.readline()
-            result['gene_usage'] = line.strip()
-            if re.search(r'\t\-\t?[^\t]*$', line):
-                result['q_rev_flag'] = 1
+            flag_index = TABLE_ROW_FLAGS.get(rowname[:3], TABLE_ROW_FLAGS.get(rowname[:4]))
+            if flag_index is None:
+                sys.exit('Error interpreting alignment at ' + result.query + ' summary.')
+            result.trunc_flags[flag_index] = 0
 
-            line = file.readline()
-            # skip all empty lines
-            while re.search(r'^\s*$', line):
-                line = file.readline()
+            # collect framework bounds for reading frame determination
+            result.fwk_bounds.append(int(match_result.group(2)))
+            result.fwk_bounds.append(int(match_result.group(3)))
 
-        match_result = re.search(r'junction details based on top germline gene', line)
-        if match_result:
-            line = file.readline()
+        elif state == SUMMARY_LINE:
+            result.gene_usage = line.strip()
+            if REVERSE_STRAND.search(line):
+                result.q_rev_flag = 1
+            state = SCAN
+
+        elif state == JUNCTION_LINE:
             # the last field denotes presence of J chain
-            if re.search(r'\tN\/A\s*$', line) is None:
-                result['trunc_flags'][6] = 0
+            if J_MISSING.search(line) is None:
+                result.trunc_flags[6] = 0
 
             # This may indicate overlapping sequences; proceed with caution.
-            line = re.sub(r'N\/A|\(|\)|\t', '', line)
-            result['rearr'] = line.strip()
+            result.rearr = JUNCTION_MARKS.sub('', line).strip()
+            state = SCAN
 
-            line = file.readline()
-            # skip all empty lines
-            while re.search(r'^\s*$', line):
-                line = file.readline()
-
-        match_result = re.search(r'region sequence details', line)
-        if match_result:
-            line = file.readline()
-            match_result = re.search(r'^CDR3\s+(' + nt_set \
-                            + r'+)\s+(' + aa_set \
-                            + r'*)\t(\d+)\t(\d+)', line)
+        else: # CDR3_LINE
+            match_result = CDR3_LINE_DATA.match(line)
             if match_result is None:
                 sys.exit('Error: invalid IgBLAST output format (CDR3 region); check data for '\
-                            + result['query'])
+                            + result.query)
 
-            result['cdr3_nt'] = match_result.group(1)
-            result['cdr3_aa']  = match_result.group(2) if match_result.group(2) else '0null0'
-            result['cdr3_bounds'][0] = int(match_result.group(3))
-            result['cdr3_bounds'][1] = int(match_result.group(4))
+            result.cdr3_nt = match_result.group(1)
+            result.cdr3_aa = match_result.group(2) if match_result.group(2) else '0null0'
+            result.cdr3_bounds[0] = int(match_result.group(3))
+            result.cdr3_bounds[1] = int(match_result.group(4))
+            state = SCAN
 
-            line = file.readline()
-            # skip all empty lines
-            while re.search(r'^\s*$', line):
-                line = file.readline()
+    return result
 
-        match_result = re.search(r'^Alignment summary', line)
-        # Framework alignment summary table; expected to end with the "Total" line
-        if match_result:
-            while not end_table_flag and line:
-                line = file.readline()
-                match_result = re.search(r'^([^\t]+)\t(\S+)\t(\S+)\t(\d+)\t\S+\t\S+\t\S+\t(\d+\.?\d*)', line)
-                if match_result:
-                    alignment_tbl_data['rowname'] = match_result.group(1)
-                    alignment_tbl_data['from'] = match_result.group(2)
-                    alignment_tbl_data['to'] = match_result.group(3)
-                    alignment_tbl_data['length'] = int(match_result.group(4))
-                    alignment_tbl_data['pct_id'] = float(match_result.group(5))
-
-                    if re.search(r'^FR1', alignment_tbl_data['rowname']):
-                        result['trunc_flags'][0] = 0
-                    elif re.search(r'^CDR1', alignment_tbl_data['rowname']):
-                        result['trunc_flags'][1] = 0
-                    elif re.search(r'^FR2', alignment_tbl_data['rowname']):
-                        result['trunc_flags'][2] = 0
-                    elif re.search(r'^CDR2', alignment_tbl_data['rowname']):
-                        result['trunc_flags'][3] = 0
-                    elif re.search(r'^FR3', alignment_tbl_data['rowname']):
-                        result['trunc_flags'][4] = 0
-                    elif re.search(r'^CDR3', alignment_tbl_data['rowname']):
-                        result['trunc_flags'][5] = 0
-                    elif alignment_tbl_data['rowname'] == 'Total':
-                        result['perc_ident'] = alignment_tbl_data['pct_id']
-                        result['cov'] = 100 * alignment_tbl_data['length'] / result['q_length']
-                        end_table_flag = 1
-                    else:
-                        sys.exit('Error interpreting alignment at ' + result['query'] + ' summary.')
-
-                # collect framework bounds for reading frame determination
-                if alignment_tbl_data['rowname'] != 'Total':
-                    result['fwk_bounds'].append(int(alignment_tbl_data['from']))
-                    result['fwk_bounds'].append(int(alignment_tbl_data['to']))
-
-        match_result = re.search(re.escape(r'***** No hits found *****'), line)
-        if match_result:
-            result['gene_usage'] = 'invalid_query_seq'
-            result['rearr']      = ''
-            result['cov']        = 0
-            result['perc_ident'] = 0
+# AIRR rearrangement (IgBLAST -outfmt 19) values as written in the verbose report
+AIRR_CHAIN_TYPES = {'IGH' : 'VH', 'IGK' : 'VK', 'IGL' : 'VL',\
+                    'TRA' : 'VA', 'TRB' : 'VB', 'TRG' : 'VG', 'TRD' : 'VD'}
+AIRR_D_CHAINS    = ('VH', 'VB', 'VD') # chain types with a D-gene column in the summary
+AIRR_YES_NO      = {'T' : 'Yes', 'F' : 'No'}
+AIRR_VJ_FRAME    = {'T' : 'In-frame', 'F' : 'Out-of-frame'}
+AIRR_V_REGIONS   = ('fwr1', 'cdr1', 'fwr2', 'cdr2', 'fwr3')
+AIRR_COLUMNS     = ('sequence_id', 'sequence', 'locus', 'stop_codon', 'vj_in_frame',\
+                    'v_frameshift', 'productive', 'rev_comp', 'v_call', 'd_call', 'j_call',\
+                    'v_identity', 'cdr3', 'cdr3_aa', 'cdr3_start', 'cdr3_end',\
+                    'v_sequence_start', 'v_sequence_end', 'd_sequence_start', 'd_sequence_end',\
+                    'j_sequence_start', 'fwr3_end')\
+                   + tuple(region + bound for region in AIRR_V_REGIONS\
+                           for bound in ('_start', '_end'))
+JUNCTION_FLANK   = 5 # V end/J start nucleotides shown in the junction details
 
-        match_result = re.search(r'Effective search space used', line)
-        if match_result:
-            end_block_flag = 1
+def airr_int(value):
+    '''
+    returns the integer value of an AIRR coordinate column (0 if empty)
+    '''
+    return int(value) if value else 0
+
+def parse_airr_row(row):
+    '''
+    convert one row of the IgBLAST AIRR tabular output (-outfmt 19) into the
+      data harvested from a verbose IgBLAST block
+    1st argument -- dictionary of column name : value
+    returns IgBlastRecord
+    '''
+    result   = IgBlastRecord(row['sequence_id'])
+    sequence = row['sequence']
+    result.q_length = len(sequence)
+
+    if not (row['v_call'] or row['d_call'] or row['j_call']):
+        result.gene_usage = 'invalid_query_seq'
+        return result
+
+    # AIRR coordinates refer to the reverse complement for reversed queries
+    if row['rev_comp'] == 'T':
+        result.q_rev_flag = 1
+        sequence = rev_comp(sequence)
 
-        line = file.readline()
+    # rearrangement summary, in the column order of the verbose report
+    chain_type = AIRR_CHAIN_TYPES.get(row['locus'], 'N/A')
+    gene_usage = [row['v_call'] or 'N/A']
+    if chain_type in AIRR_D_CHAINS:
+        gene_usage.append(row['d_call'] or 'N/A')
+    gene_usage.extend([row['j_call'] or 'N/A', chain_type,\
+                       AIRR_YES_NO.get(row['stop_codon'], 'N/A'),\
+                       AIRR_VJ_FRAME.get(row['vj_in_frame'], 'N/A'),\
+                       AIRR_YES_NO.get(row['productive'], 'N/A'),\
+                       '-' if result.q_rev_flag else '+',\
+                       AIRR_YES_NO.get(row['v_frameshift'], 'N/A')])
+    result.gene_usage = '\t'.join(gene_usage)
+
+    # framework/CDR rows of the V alignment summary
+    for flag_index, region in enumerate(AIRR_V_REGIONS):
+        if row[region + '_start']:
+            result.trunc_flags[flag_index] = 0
+            result.fwk_bounds.append(int(row[region + '_start']))
+            result.fwk_bounds.append(int(row[region + '_end']))
+
+    v_start = airr_int(row['v_sequence_start'])
+    v_end   = airr_int(row['v_sequence_end'])
+    fwr3_end = airr_int(row['fwr3_end'])
+    if fwr3_end and v_end > fwr3_end: # "CDR3-IMGT (germline)" row
+        result.trunc_flags[5] = 0
+        result.fwk_bounds.extend([fwr3_end + 1, v_end])
+
+    if v_end:
+        result.perc_ident = float(row['v_identity']) if row['v_identity'] else 0
+        v_aln_length = len(row.get('v_sequence_alignment', '')) or v_end - v_start + 1
+        result.cov = 100 * v_aln_length / result.q_length
+
+    # junction: V end through J start, overlapping nucleotides included once
+    d_start = airr_int(row['d_sequence_start'])
+    d_end   = airr_int(row['d_sequence_end'])
+    j_start = airr_int(row['j_sequence_start'])
+    if row['j_call']:
+        result.trunc_flags[6] = 0
+    if v_end:
+        junction_start = min(v_end, (d_start or j_start or v_end + 1) - 1) - JUNCTION_FLANK
+        if j_start:
+            junction_end = max(v_end, d_end, j_start - 1) + JUNCTION_FLANK
+        else:
+            junction_end = max(v_end, d_end)
+        result.rearr = sequence[max(junction_start, 0):junction_end]
+
+    if row['cdr3']:
+        result.cdr3_nt = row['cdr3']
+        result.cdr3_aa = row['cdr3_aa'] if row['cdr3_aa'] else '0null0'
+        result.cdr3_bounds[0] = airr_int(row['cdr3_start'])
+        result.cdr3_bounds[1] = airr_int(row['cdr3_end'])
 
     return result
 
-def compose_fasta_block(file, filename, line, igblast_data_dict):
+def skip_igblast_block(file):
     '''
-    read a FASTA entry, determine the reading frame from igblast_data_dict,
-        compose the new description line, and return the FASTA block
-    1st argument -- file handle for input FASTA file
-    2nd argument -- filename for input FASTA file
-    3rd argument -- first line of input FASTA file
-    4th argument -- igblast_data_dict
+    read past the rest of a query block of the verbose IgBLAST output, up to
+      the line that ends parse_igblast_block
+    1st argument -- filehandle (or line iterator) for reading inputFile
     '''
-    # initialize
-    result      = {}
-    readframe   = 0
-    rearr_aa    = '0null0'
-    translation = ''
-    aa_set      = r'[ACDEFGHIKLMNPQRSTVWXY\*]'
+    for line in file:
+        if line.startswith('Effective search space used'):
+            return
 
-    if re.search(r'^>' + igblast_data_dict['query'] + '.*', line) is None:
-        sys.exit('Error at ' + igblast_data_dict['query'] + ' FASTA entry retrieval.')
+def read_igblast_records(file, reused=None):
+    '''
+    yield the harvested data for each query in the IgBLAST output; the AIRR
+      tabular format (-outfmt 19) is recognized by its header line, anything
+      else is read as the verbose report (-show_translation)
+    1st argument -- filehandle for reading inputFile
+    2nd argument -- function of the query ID, called for each query in order;
+      the blocks of the queries for which it is True are skipped without
+      parsing (optional)
+    returns iterator of IgBlastRecord (None for the skipped queries)
+    '''
+    first_line = file.readline()
 
-    result['query_id'] = line.strip()
-    result['query_id'] = re.sub(r'^>', '', result['query_id'])
+    if first_line.startswith('sequence_id\t'):
+        columns = first_line.rstrip('\r\n').split('\t')
+        missing = [column for column in AIRR_COLUMNS if column not in columns]
+        if missing:
+            sys.exit('Error: AIRR-format IgBLAST output lacks the columns: ' + ', '.join(missing))
 
-    # grab the sequence from the FASTA file
-    line = file.readline()
-    if line:
-        result['query_seq'] = line.strip()
-    else:
-        sys.exit('Error: cannot retrieve the sequence for\n\t' + \
-          result['query_id'] + '\n\tfrom ' + filename)
+        for line in file:
+            if line.strip():
+                if reused is not None and reused(line.split('\t', 1)[0]):
+                    yield None
+                    continue
+                yield parse_airr_row(dict(itertools.zip_longest(columns,\
+                    line.rstrip('\r\n').split('\t'), fillvalue='')))
+        return
 
-    if len(igblast_data_dict['fwk_bounds']) > 1:
-        readframe = igblast_data_dict['fwk_bounds'][1] % 3 + 1
+    lines = itertools.chain([first_line], file)
+    for line in lines:
+        match_result = QUERY_LINE.match(line)
+        if match_result:
+            if reused is not None and reused(match_result.group(1)):
+                skip_igblast_block(lines)
+                yield None
+                continue
+            yield parse_igblast_block(lines, line)
 
-    # another possibility that isn't always available:
-    # readframe = str((result['cdr3_bounds'][0]-1)%3+1)
+ANNOTATION_CACHE_SIZE = 32768 # default number of cached translation results
+
+def resolve_translation(query_seq, readframe, q_rev_flag, cdr3_aa, rearr):
+    '''
+    determine the reading frame, the translation, the CDR3 amino acid sequence
+      with its context residues and the junction translation of a query; the
+      result depends only on the arguments, so it can be cached (see
+      annotation_cache)
+    1st argument -- query sequence (as in the FASTA file)
+    2nd argument -- reading frame from the alignment summary (0 if unknown)
+    3rd argument -- 1 if the query is reverse-complemented
+    4th argument -- CDR3 amino acid sequence reported by IgBLAST (or '0null0')
+    5th argument -- junction nucleotide sequence
+    returns tuple of reading frame, translation, CDR3 with context, junction translation
+    '''
+    rearr_aa    = '0null0'
+    translation = ''
 
     # if the sequence is determined to be "reversed", determine the revcomp
-    working_seq = rev_comp(result['query_seq']) \
-        if igblast_data_dict['q_rev_flag'] else result['query_seq']
+    working_seq = rev_comp(query_seq) if q_rev_flag else query_seq
 
-    # translate the sequence, possibly reverse-complement
+    # translate the sequence, possibly reverse-complement; the three frames
+    #   are translated once and reused for the frame, CDR3 and junction lookups
     if readframe:
-        translation = translate(working_seq[readframe - 1:])
+        frames = translator.translate_frames(working_seq)
+        translation = frames[readframe - 1]
 
         # fix the translation for cases when only a portion of the sequence
         #   was used in the igblast annotation
-        if igblast_data_dict['cdr3_aa'] != '0null0' \
-          and re.search(re.escape(igblast_data_dict['cdr3_aa']), translation) is None:
+        if cdr3_aa != '0null0' and cdr3_aa not in translation:
             readframe = 3
             while readframe >= 1:
-                translation = translate(working_seq[readframe - 1 :])
-                if re.search(re.escape(igblast_data_dict['cdr3_aa']), translation):
+                translation = frames[readframe - 1]
+                if cdr3_aa in translation:
                     break
                 readframe = readframe - 1
 
-    # obtain context residues for the cdr3_aa
-    if igblast_data_dict['cdr3_aa'] != '0null0':
-        match_result = re.search(aa_set + r'+(' + aa_set + r'{3}' + \
-                       re.escape(igblast_data_dict['cdr3_aa']) + \
-                       aa_set + r'{2})', translation)
-        if match_result:
-            igblast_data_dict['cdr3_aa'] = match_result.group(1)
+    # obtain context residues for the cdr3_aa: three residues before and two
+    #   after its last occurrence that has at least four residues in front
+    if cdr3_aa != '0null0':
+        cdr3_pos = translation.rfind(cdr3_aa, 4, len(translation) - 2)
+        if cdr3_pos >= 0:
+            cdr3_aa = translation[cdr3_pos - 3 : cdr3_pos + len(cdr3_aa) + 2]
         else:
-            igblast_data_dict['cdr3_aa'] = '0null0'  # TODO, see below
+            cdr3_aa = '0null0'  # TODO, see below
             # sys.exit('Error: cannot obtain CDR3 amino acid sequence context.')
 
-    if igblast_data_dict['q_rev_flag']:
+    if q_rev_flag:
         readframe = -readframe
 
-    # generate the translation for the junction sequence
-    if len(igblast_data['rearr']) and igblast_data_dict['cdr3_aa'] != '0null0':
+    # generate the translation for the junction sequence; the junction is
+    #   cut out of the query frames when it can be located in the query
+    if len(rearr) and cdr3_aa != '0null0':
+        rearr_pos = working_seq.find(rearr)
         for idx in range(0,3):
-            rearr_aa = translate(igblast_data_dict['rearr'][idx:])
-            if re.search(re.escape(rearr_aa), igblast_data_dict['cdr3_aa']):
+            if rearr_pos >= 0:
+                codon_start = rearr_pos + idx
+                rearr_aa = frames[codon_start % 3][codon_start // 3 :\
+                    codon_start // 3 + (len(rearr) - idx) // 3]
+            else:
+                rearr_aa = translator.translate(rearr[idx:])
+            if rearr_aa in cdr3_aa:
                 break
 
-        if re.search(re.escape(rearr_aa), translation) is None:
+        if rearr_aa not in translation:
             rearr_aa = '0null0'
 
-    ### result construction start
-    result['query_id'] = '>' + result['query_id'] + '\t' \
-                             + igblast_data_dict['gene_usage'] + '\t'
-    if   igblast_data_dict['trunc_flags'][0] \
-      or igblast_data_dict['trunc_flags'][1] \
-      or igblast_data_dict['trunc_flags'][2] \
-      or igblast_data_dict['trunc_flags'][3] \
-      or igblast_data_dict['trunc_flags'][4]:
-        result['query_id'] = result['query_id'] + 'Vtruncated.' + \
-          ''.join(map(str,igblast_data_dict['trunc_flags']))
-    elif igblast_data_dict['trunc_flags'][6]:
-        result['query_id'] = result['query_id'] + 'Jtruncated.' + \
-          ''.join(map(str,igblast_data_dict['trunc_flags']))
+    return readframe, translation, cdr3_aa, rearr_aa
+
+# bounded LRU cache for resolve_translation; identical consensus sequences
+#   with identical IgBLAST calls are translated only once
+annotation_cache = functools.lru_cache(maxsize=ANNOTATION_CACHE_SIZE)(resolve_translation)
+
+def set_annotation_cache(size):
+    '''
+    resize the annotation cache of this process (a new, empty cache; kept as
+      it is if it already has that size)
+    1st argument -- number of translation results kept (0 disables the cache)
+    '''
+    global annotation_cache
+    size = max(size, 0)
+    if annotation_cache.cache_parameters()['maxsize'] != size:
+        annotation_cache = functools.lru_cache(maxsize=size)(resolve_translation)
+
+def compose_fasta_block(record, igblast_data):
+    '''
+    take a FASTA entry, determine the reading frame from igblast_data,
+        compose the new description line, and return the FASTA block
+    1st argument -- FASTA record (seq_reader.SeqRecord) matching the IgBLAST query
+    2nd argument -- IgBlastRecord for the query (see parse_igblast_block)
+    '''
+    # initialize
+    result      = {}
+    readframe   = 0
+
+    if record is None or not record.header.startswith(igblast_data.query):
+        sys.exit('Error at ' + igblast_data.query + ' FASTA entry retrieval.')
+
+    result['query_id'] = record.header
+    result['query_seq'] = record.seq
+
+    if len(igblast_data.fwk_bounds) > 1:
+        readframe = igblast_data.fwk_bounds[1] % 3 + 1
+
+    # another possibility that isn't always available:
+    # readframe = str((result['cdr3_bounds'][0]-1)%3+1)
+
+    if readframe:
+        unknown_bases = translator.invalid_bases(record.seq)
+        if unknown_bases:
+            sys.stderr.write('Warning: unexpected characters "' + ''.join(sorted(set(unknown_bases)))\
+                             + '" in ' + igblast_data.query + '; codons translated as '\
+                             + translator.UNKNOWN_AA + '.\n')
+
+    readframe, translation, igblast_data.cdr3_aa, rearr_aa = \
+        annotation_cache(record.seq, readframe, igblast_data.q_rev_flag,\
+                         igblast_data.cdr3_aa, igblast_data.rearr)
+
+    if   igblast_data.trunc_flags[0] \
+      or igblast_data.trunc_flags[1] \
+      or igblast_data.trunc_flags[2] \
+      or igblast_data.trunc_flags[3] \
+      or igblast_data.trunc_flags[4]:
+        result['trunc_label'] = 'Vtruncated.' + ''.join(map(str,igblast_data.trunc_flags))
+    elif igblast_data.trunc_flags[6]:
+        result['trunc_label'] = 'Jtruncated.' + ''.join(map(str,igblast_data.trunc_flags))
     else:
-        result['query_id'] = result['query_id'] + 'Vintact'
+        result['trunc_label'] = 'Vintact'
 
-    result['query_id'] = result['query_id'] + '\t' + \
-      'junctnn:' + igblast_data_dict['rearr'] + '\t' + \
+    ### result construction start
+    result['query_id'] = '>' + result['query_id'] + '\t' \
+                             + igblast_data.gene_usage + '\t' + result['trunc_label'] + '\t' + \
+      'junctnn:' + igblast_data.rearr + '\t' + \
       'junctaa:' + rearr_aa + '\t' + \
-      'CDR3aa:' + igblast_data_dict['cdr3_aa'] + '\t' + \
+      'CDR3aa:' + igblast_data.cdr3_aa + '\t' + \
       'frame:' + str(readframe) + '\t' + \
-      'pcov:' + f"{igblast_data_dict['cov']:.1f}" + '\t' + \
-      'pid:' + f"{igblast_data_dict['perc_ident']:.1f}" + '\t' + \
+      'pcov:' + f"{igblast_data.cov:.1f}" + '\t' + \
+      'pid:' + f"{igblast_data.perc_ident:.1f}" + '\t' + \
       'transl:' + translation
+    result['frame'] = readframe
+    result['junction_aa'] = rearr_aa
+    result['translation'] = translation
 
     return result
 
+# record categories of the productive/chain filter, in the order they are tested;
+#   records of the last three categories make up the productive set (prod) and
+#   the last one the set of the expected chain type (prod.scrub)
+STOP_CDR3, UNPRODUCTIVE, NULL_CDR3, OTHER_CHAIN, SCRUB = range(5)
+CATEGORY_LABELS = ('stop_cdr3', 'unproductive', 'null_cdr3', 'other_chain', 'scrub')
+PROD_TYPES   = {'intact' : 'Vintact', 'truncated' : 'Vtruncated'}
+STRANDS      = ('+', '-')
+
+def summary_strand(summary):
+    '''
+    returns the index of the strand column in the rearrangement summary; the
+      summary ends with: chain type, stop codon, V-J frame, productive, strand
+      (and V frame shift, missing in older IgBLAST versions), so that the chain
+      type is 4 and the J gene 5 columns before the strand
+    1st argument -- array of the summary columns
+    '''
+    return len(summary) - 1 if summary[-1] in STRANDS else len(summary) - 2
+
+def clonotype_calls(igblast_data):
+    '''
+    returns the (V gene call, J gene call, CDR3aa) of a record, from which its
+      clonotype key is made (see clonotypes.clonotype_key)
+    1st argument -- IgBlastRecord after compose_fasta_block (final CDR3aa)
+    '''
+    summary = igblast_data.gene_usage.split('\t')
+    return summary[0], summary[summary_strand(summary) - 5], igblast_data.cdr3_aa
+
+def record_clonotype(header_line, calls):
+    '''
+    returns the (clonotype key, number of reads) pair of a record of the scrub set
+    1st argument -- FASTA header line of the annotated record (with the '>')
+    2nd argument -- clonotype calls of the record (see clonotype_calls)
+    '''
+    query_id = header_line[1:].split('\t', 1)[0]
+    weight = clonotypes.mig_weight(query_id)
+    if weight is None:
+        sys.exit('Error: no read count at the end of the query ID ' + query_id + '.')
+    return clonotypes.clonotype_key(*calls), weight
+
+def classify_record(igblast_data, trunc_label, prod_type, chain):
+    '''
+    returns the filter category of an annotated record (STOP_CDR3 ... SCRUB);
+      same selection as the former grep filters of IgBLASToutputProcessing
+    1st argument -- IgBlastRecord after compose_fasta_block (final CDR3aa)
+    2nd argument -- truncation label of the record (Vintact, Vtruncated.x, Jtruncated.x)
+    3rd argument -- 'intact' for regular libraries, 'truncated' for hinge/nano
+      libraries (in-frame rearrangements with a truncated V region)
+    4th argument -- expected chain type (VH, VK or VL); None accepts any chain
+    '''
+    if '*' in igblast_data.cdr3_aa:
+        return STOP_CDR3
+
+    summary = igblast_data.gene_usage.split('\t')
+    strand = summary_strand(summary)
+    if strand < 4 or summary[strand] not in STRANDS or summary[strand - 1] != 'Yes'\
+            or not trunc_label.startswith(PROD_TYPES[prod_type]):
+        return UNPRODUCTIVE
+    if prod_type == 'truncated' and summary[strand - 2] != 'In-frame':
+        return UNPRODUCTIVE
+
+    if igblast_data.cdr3_aa == '0null0':
+        return NULL_CDR3
+    if chain is not None and summary[strand - 4] != chain:
+        return OTHER_CHAIN
+    return SCRUB
+
+def header_number(header, field):
+    '''
+    returns the number following a field of a consensus header (e.g.,
+      "retained="), or None
+    1st argument -- FASTA header
+    2nd argument -- field name, with the "="
+    '''
+    pos = header.find(field)
+    if pos >= 0:
+        end = pos + len(field)
+        while end < len(header) and header[end].isdigit():
+            end += 1
+        if end > pos + len(field):
+            return int(header[pos + len(field):end])
+    return None
+
+def record_reads(header):
+    '''
+    returns the number of reads behind a record: the "retained=" or "size="
+      value of a consensus header, otherwise 1
+    1st argument -- FASTA header
+    '''
+    for field in ('retained=', 'size='):
+        number = header_number(header, field)
+        if number is not None:
+            return number
+    return 1
+
+PRODUCTIVE_CODES = {'Yes' : 1, 'No' : 0}
+
+def table_row(annotated_fasta, igblast_data, category):
+    '''
+    returns the row of a record in the columnar export (in the order of
+      annotation_table.COLUMNS); "N/A" calls and "0null0" sequences are empty
+    1st argument -- result of compose_fasta_block
+    2nd argument -- IgBlastRecord of the record
+    3rd argument -- filter category (see classify_record; -1 without the filter)
+    '''
+    header = annotated_fasta['query_id'][1:].split('\t', 1)[0]
+    summary = igblast_data.gene_usage.split('\t')
+    strand = summary_strand(summary)
+    if strand >= 5 and summary[strand] in STRANDS:
+        calls = [summary[0], summary[1] if strand == 7 else 'N/A', summary[strand - 5],\
+                 summary[strand - 4]]
+        calls = [call if call != 'N/A' else '' for call in calls]
+        productive = PRODUCTIVE_CODES.get(summary[strand - 1], -1)
+        vj_frame = summary[strand - 2]
+    else:
+        calls = ['', '', '', '']
+        productive = -1
+        vj_frame = 'N/A'
+
+    def nonnull(seq):
+        return '' if seq == '0null0' else seq
+
+    return (header, header_number(header, 'size=') or 0, record_reads(header), *calls,\
+            productive, vj_frame, igblast_data.q_rev_flag,\
+            sum(flag << ind for ind, flag in enumerate(igblast_data.trunc_flags)),\
+            annotated_fasta['trunc_label'], annotated_fasta['frame'], igblast_data.cov,\
+            igblast_data.perc_ident, igblast_data.rearr, nonnull(annotated_fasta['junction_aa']),\
+            nonnull(igblast_data.cdr3_nt), nonnull(igblast_data.cdr3_aa),\
+            igblast_data.cdr3_bounds[0], igblast_data.cdr3_bounds[1],\
+            annotated_fasta['translation'], category)
+
+class HarvestSink:
+    '''
+    destination of the annotated records: all of them go to the "all" output
+      and, when the filter is on, the productive ones to "prod" and those of
+      the expected chain type to "scrub"; sequences and reads are counted
+      per category, and the clonotypes of the scrub set are handed to
+      add_clonotype (e.g., ClonotypeCounter.add); the table rows of all the
+      records (see table_row) are appended to table
+    '''
+
+    def __init__(self, outputs, prod_type=None, chain=None, add_clonotype=None, table=None):
+        self.all_out, self.prod_out, self.scrub_out = outputs
+        self.prod_type     = prod_type
+        self.chain         = chain
+        self.add_clonotype = add_clonotype
+        self.table         = table
+        self.counts        = [[0, 0] for _ in CATEGORY_LABELS]
+
+    def add(self, annotated_fasta, igblast_data):
+        '''
+        write and count one record
+        1st argument -- result of compose_fasta_block
+        2nd argument -- IgBlastRecord of the record
+        '''
+        block = annotated_fasta['query_id'] + '\n' + annotated_fasta['query_seq'] + '\n'
+        self.all_out.write(block)
+        if self.prod_type is None:
+            if self.table is not None:
+                self.table.append(table_row(annotated_fasta, igblast_data, -1))
+            return -1
+
+        category = classify_record(igblast_data, annotated_fasta['trunc_label'],\
+                                   self.prod_type, self.chain)
+        if self.table is not None:
+            self.table.append(table_row(annotated_fasta, igblast_data, category))
+        self.counts[category][0] += 1
+        self.counts[category][1] += record_reads(annotated_fasta['query_id'])
+        if category >= NULL_CDR3 and self.prod_out is not None:
+            self.prod_out.write(block)
+        if category == SCRUB and self.scrub_out is not None:
+            self.scrub_out.write(block)
+            if self.add_clonotype is not None:
+                self.add_clonotype(*record_clonotype(annotated_fasta['query_id'],\
+                                                     clonotype_calls(igblast_data)))
+        return category
+
+    def add_stored(self, record, result):
+        '''
+        write and count one record from its stored harvest result
+        1st argument -- FASTA record (seq_reader.SeqRecord)
+        2nd argument -- harvest result of its sequence (see stored_result)
+        '''
+        annotation, category, calls, columns = result
+        header_line = '>' + record.header + annotation
+        block = header_line + '\n' + record.seq + '\n'
+        self.all_out.write(block)
+        if self.table is not None:
+            header = header_line[1:].split('\t', 1)[0]
+            self.table.append((header, header_number(header, 'size=') or 0, record_reads(header),\
+                               *columns))
+        if self.prod_type is None:
+            return
+
+        self.counts[category][0] += 1
+        self.counts[category][1] += record_reads(header_line)
+        if category >= NULL_CDR3 and self.prod_out is not None:
+            self.prod_out.write(block)
+        if category == SCRUB and self.scrub_out is not None:
+            self.scrub_out.write(block)
+            if self.add_clonotype is not None:
+                self.add_clonotype(*record_clonotype(header_line, calls))
+
+    def add_counts(self, counts):
+        '''
+        add the category counts of another sink (e.g., of a worker)
+        '''
+        for total, part in zip(self.counts, counts):
+            total[0] += part[0]
+            total[1] += part[1]
+
+    def write_counts(self, filename):
+        '''
+        write the category counts as CSV lines ("category", sequences, reads),
+          preceded by the totals of all and of the productive records
+        1st argument -- output filename
+        '''
+        def total(categories):
+            return [sum(self.counts[category][ind] for category in categories)\
+                    for ind in (0, 1)]
+
+        rows = [('all', total(range(len(CATEGORY_LABELS)))),\
+                ('prod', total((NULL_CDR3, OTHER_CHAIN, SCRUB)))]
+        rows.extend(zip(CATEGORY_LABELS, self.counts))
+        with stream_io.open_output(filename) as output:
+            output.write('# IgBLAST harvest filter counts: category, sequences, reads\n')
+            for label, (sequences, reads) in rows:
+                output.write('"' + label + '", ' + str(sequences) + ', ' + str(reads) + '\n')
+
+BLOCKS_PER_TASK = 500 # IgBLAST query blocks handed to a worker process at a time
+
+def harvest_blocks(igblast, fasta_records, sink, metrics=None):
+    '''
+    write the annotated FASTA entries for all query blocks of the IgBLAST output
+    1st argument -- filehandle (text) for reading the IgBLAST output
+    2nd argument -- iterator of FASTA records in the IgBLAST query order
+    3rd argument -- HarvestSink for the output
+    4th argument -- run_metrics.RunMetrics for the phase times and query counters (optional)
+    '''
+    if metrics is None:
+        for igblast_data in read_igblast_records(igblast):
+            sink.add(compose_fasta_block(next(fasta_records, None), igblast_data), igblast_data)
+        return
+
+    # the same loop with the parse/annotate/output phases timed
+    clock = metrics.clock()
+    for igblast_data in read_igblast_records(igblast):
+        record = next(fasta_records, None)
+        clock = metrics.add_time('parse', clock)
+        annotated_fasta = compose_fasta_block(record, igblast_data)
+        clock = metrics.add_time('annotate', clock)
+        sink.add(annotated_fasta, igblast_data)
+        clock = metrics.add_time('output', clock)
+        metrics.count('queries')
+        if igblast_data.gene_usage == 'invalid_query_seq':
+            metrics.count('no_hit_queries')
+    metrics.add_time('parse', clock)
+
+def stored_result(record, annotated_fasta, igblast_data, category):
+    '''
+    returns the harvest result of a record that depends on its sequence only, as
+      kept in the state store of the incremental mode: (annotation after the
+      query ID, filter category, clonotype calls (see clonotype_calls) of a
+      scrub record or None, table columns after those of the query ID)
+    1st argument -- FASTA record (seq_reader.SeqRecord)
+    2nd argument -- result of compose_fasta_block
+    3rd argument -- IgBlastRecord of the record
+    4th argument -- filter category (see classify_record; -1 without the filter)
+    '''
+    return (annotated_fasta['query_id'][1 + len(record.header):], category,\
+            clonotype_calls(igblast_data) if category == SCRUB else None,\
+            table_row(annotated_fasta, igblast_data, category)[3:])
+
+class TopupHarvest:
+    '''
+    incremental mode of the harvester (see topup_state.py): the harvest result
+      of each sequence (see stored_result) is kept in the state store, so that
+      the query blocks of the stored sequences are skipped, and the clonotype
+      counts of the scrub set are updated in the store with the records that
+      changed since the previous run
+    '''
+
+    def __init__(self, store, clonotype_counter=None):
+        self.store             = store
+        self.clonotype_counter = clonotype_counter
+        self.weights           = collections.Counter()
+
+    def add_clonotype(self, key, weight):
+        '''
+        count a record of the scrub set (for HarvestSink)
+        '''
+        self.clonotype_counter.add(key, weight)
+        self.weights[key + (weight,)] += 1
+
+    def harvest(self, igblast, fasta_records, sink, metrics=None):
+        '''
+        write the annotated FASTA entries for all query blocks of the IgBLAST
+          output, as harvest_blocks does, with the stored results of the known
+          sequences; the results of the new ones are stored
+        1st argument -- filehandle (text) for reading the IgBLAST output
+        2nd argument -- iterable of FASTA records in the IgBLAST query order
+        3rd argument -- HarvestSink for the output
+        4th argument -- run_metrics.RunMetrics for the phase times and query counters (optional)
+        '''
+        clock = run_metrics.RunMetrics.clock()
+        records = [(record, topup_state.seq_digest(record.seq)) for record in fasta_records]
+        stored = {digest : json.loads(result) for digest, result\
+                  in self.store.stored_harvests({digest for record, digest in records}).items()}
+        queries = iter(records)
+        current = []
+        new_results = []
+
+        def reused(query):
+            record, digest = next(queries, (None, None))
+            if record is None or not record.header.startswith(query):
+                sys.exit('Error at ' + query + ' FASTA entry retrieval.')
+            current[:] = record, digest
+            return digest in stored
+
+        for igblast_data in read_igblast_records(igblast, reused):
+            record, digest = current
+            if igblast_data is None:
+                sink.add_stored(record, stored[digest])
+                if metrics is not None:
+                    metrics.count('queries')
+                    metrics.count('reused_queries')
+                    if stored[digest][0].startswith('\tinvalid_query_seq\t'):
+                        metrics.count('no_hit_queries')
+                continue
+            annotated_fasta = compose_fasta_block(record, igblast_data)
+            category = sink.add(annotated_fasta, igblast_data)
+            stored[digest] = stored_result(record, annotated_fasta, igblast_data, category)
+            new_results.append((digest, json.dumps(stored[digest])))
+            if metrics is not None:
+                metrics.count('queries')
+                if igblast_data.gene_usage == 'invalid_query_seq':
+                    metrics.count('no_hit_queries')
+        self.store.store_harvests(new_results)
+        if metrics is not None:
+            metrics.add_time('annotate', clock)
+
+    def finish(self):
+        '''
+        update the stored clonotype counts and count the clonotypes with them
+        '''
+        if self.clonotype_counter is not None:
+            self.clonotype_counter.set_counts(self.store.update_clonotypes(self.weights))
+
+def query_block_starts(data, pos):
+    '''
+    yield the byte offsets of the "Query=" lines in the verbose IgBLAST report
+    1st argument -- file contents (bytes or mmap)
+    2nd argument -- offset to start the search from (at a line start)
+    '''
+    while True:
+        if data[pos:pos + 6] == b'Query=' and data[pos + 6:pos + 7].isspace():
+            yield pos
+        pos = data.find(b'\nQuery=', pos) + 1
+        if not pos:
+            return
+
+def airr_row_starts(data, pos):
+    '''
+    yield the byte offsets of the non-empty lines in the AIRR tabular output
+    1st argument -- file contents (bytes or mmap)
+    2nd argument -- offset of the first row (after the header line)
+    '''
+    while pos < len(data):
+        end = data.find(b'\n', pos) + 1 or len(data)
+        if data[pos:end].strip():
+            yield pos
+        pos = end
+
+def index_igblast_blocks(filename, blocks_per_range=BLOCKS_PER_TASK):
+    '''
+    yield byte ranges of an uncompressed IgBLAST output file holding up to
+      blocks_per_range query blocks each; the block starts ("Query=" lines or
+      AIRR rows) are located with bytes.find on a memory map, without parsing
+    1st argument -- filename
+    2nd argument -- number of query blocks per range
+    returns iterator of ((filename, start, end), number of blocks, AIRR header line or '')
+    '''
+    if not getsize(filename):
+        return
+
+    with open(filename, 'rb') as handle,\
+            mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        first_end = data.find(b'\n') + 1 or len(data)
+        if data[:first_end].startswith(b'sequence_id\t'):
+            header = data[:first_end].decode('utf8')
+            block_starts = airr_row_starts(data, first_end)
+        else:
+            header = ''
+            block_starts = query_block_starts(data, 0)
+
+        range_start = 0
+        block_count = 0
+        for start in block_starts:
+            if block_count == blocks_per_range:
+                yield (filename, range_start, start), block_count, header
+                block_count = 0
+            if not block_count:
+                range_start = start
+            block_count += 1
+        if block_count:
+            yield (filename, range_start, len(data)), block_count, header
+
+def split_igblast_stream(filename, blocks_per_range=BLOCKS_PER_TASK):
+    '''
+    yield the text of up to blocks_per_range query blocks at a time from a
+      (gzipped) IgBLAST output stream that cannot be indexed by byte offset
+    1st argument -- filename
+    2nd argument -- number of query blocks per range
+    returns iterator of (text, number of blocks, AIRR header line or '')
+    '''
+    with stream_io.open_input(filename, text=True) as igblast:
+        first_line = igblast.readline()
+        if first_line.startswith('sequence_id\t'):
+            header = first_line
+            lines  = igblast
+            starts_block = str.strip
+        else:
+            header = ''
+            lines  = itertools.chain([first_line], igblast)
+            starts_block = QUERY_LINE.match
+
+        block_lines = []
+        block_count = 0
+        for line in lines:
+            if starts_block(line):
+                if block_count == blocks_per_range:
+                    yield ''.join(block_lines), block_count, header
+                    block_lines = []
+                    block_count = 0
+                block_count += 1
+            if block_count:
+                block_lines.append(line)
+        if block_count:
+            yield ''.join(block_lines), block_count, header
+
+def read_file_pairs(filename):
+    '''
+    yield the (IgBLAST output, FASTA) filename pairs listed one per line in a
+      file, as the lines arrive
+    1st argument -- filename ("-" for stdin)
+    '''
+    with (contextlib.nullcontext(sys.stdin) if filename == '-' else open(filename)) as handle:
+        for line in handle:
+            names = line.split()
+            if not names:
+                continue
+            if len(names) != 2:
+                sys.exit('Error: expecting an IgBLAST output and a FASTA filename in "'\
+                         + line.rstrip('\n') + '".')
+            yield names[0], names[1]
+
+def harvest_batch(tasks, prod_type=None, chain=None, clonotyping=False, with_metrics=False,\
+                  tabulating=False, cache_size=ANNOTATION_CACHE_SIZE):
+    '''
+    returns the annotated FASTA text for a batch of IgBLAST block ranges
+      (run in the worker processes) as (all, prod, scrub) texts, with the
+      filter counts, the clonotypes of the scrub records, the annotation
+      cache hits and misses of the batch, its metrics (RunMetrics state or None)
+      and its table rows (or None)
+    1st argument -- array of ((block source, AIRR header line), FASTA records)
+      pairs; the source is either a (filename, start, end) byte range or the
+      text of the blocks
+    2nd argument -- productive filter type (see classify_record; None for no filter)
+    3rd argument -- expected chain type (see classify_record)
+    4th argument -- True to collect the (clonotype key, weight) pairs
+    5th argument -- True to time the phases and count the queries (see run_metrics.py)
+    6th argument -- True to collect the table rows (see table_row)
+    7th argument -- size of the annotation cache of the worker (see set_annotation_cache)
+    '''
+    set_annotation_cache(cache_size)
+    cache_before = annotation_cache.cache_info()
+    metrics = run_metrics.RunMetrics() if with_metrics else None
+    outputs = (io.StringIO(), io.StringIO(), io.StringIO())
+    clones = []
+    sink = HarvestSink(outputs, prod_type, chain,\
+                       (lambda key, weight: clones.append((key, weight))) if clonotyping else None,\
+                       [] if tabulating else None)
+    for (source, header), records in tasks:
+        if isinstance(source, str):
+            text = source
+        else:
+            filename, start, end = source
+            with open(filename, 'rb') as handle:
+                handle.seek(start)
+                text = handle.read(end - start).decode('utf8')
+        harvest_blocks(io.StringIO(header + text), iter(records), sink, metrics)
+
+    cache_after = annotation_cache.cache_info()
+    return [output.getvalue() for output in outputs], sink.counts, clones,\
+        cache_after.hits - cache_before.hits, cache_after.misses - cache_before.misses,\
+        metrics.state() if metrics is not None else None, sink.table
+
+class HarvestOutput:
+    '''
+    output handle for the worker results of harvest_batch: writes the texts
+      and the table rows to the outputs of the sink and adds up the filter,
+      clonotype and annotation cache counters and the metrics of the workers
+    '''
+
+    def __init__(self, sink, clonotype_counter=None, metrics=None):
+        self.sink              = sink
+        self.clonotype_counter = clonotype_counter
+        self.metrics           = metrics
+        self.cache_hits        = 0
+        self.cache_misses      = 0
+
+    def write(self, batch_result):
+        texts, counts, clones, cache_hits, cache_misses, metrics_state, rows = batch_result
+        clock = run_metrics.RunMetrics.clock()
+        outputs = (self.sink.all_out, self.sink.prod_out, self.sink.scrub_out)
+        for output, text in zip(outputs, texts):
+            if output is not None and text:
+                output.write(text)
+        if rows:
+            self.sink.table.extend(rows)
+        self.sink.add_counts(counts)
+        if self.clonotype_counter is not None:
+            self.clonotype_counter.add_all(clones)
+        self.cache_hits   += cache_hits
+        self.cache_misses += cache_misses
+        if self.metrics is not None:
+            self.metrics.add_time('output', clock)
+            self.metrics.merge(metrics_state)
+
 #-------------------------------------------------------------------------------
 #### main section
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('igblastOut_name', \
-        help='Filename for the IgBLAST output (e.g., "source.igblast_out")')
-    parser.add_argument('fasta_name', \
-        help='Filename for the FASTA data set (e.g., "source.fasta")')
+    parser.add_argument('file_pairs', nargs='*', metavar='igblastOut_name fasta_name', \
+        help='Filenames for the IgBLAST output (e.g., "source.igblast_out"; verbose report'\
+            + ' or AIRR tabular -outfmt 19, optionally gzipped) and the FASTA data set'\
+            + ' (e.g., "source.fasta"; FASTQ and gzip are accepted); several pairs (e.g.,'\
+            + ' the IgBLAST split chunks) are harvested in the given order')
+    parser.add_argument('--pairs_from', nargs='?', type=str, \
+        help='Filename ("-" for stdin) with one "igblastOut_name fasta_name" pair per line,'\
+            + ' harvested after the pairs of the command line as the lines arrive (e.g., from'\
+            + ' igblast_scheduler.py)')
+    parser.add_argument('-o', '--output', nargs='?', type=str, default='-', \
+        help='Output FASTA filename; gzipped if it ends in ".gz" (default is stdout)')
+    parser.add_argument('-W', '--workers', nargs='?', type=int, default=1, \
+        help='Number of worker processes for harvesting (default is 1)')
+    parser.add_argument('-C', '--cache_size', nargs='?', type=int, default=ANNOTATION_CACHE_SIZE, \
+        help='Number of translation results kept in the annotation cache per process'\
+            + ' (default is ' + str(ANNOTATION_CACHE_SIZE) + '; 0 disables the cache)')
+    parser.add_argument('--prod', nargs='?', type=str, \
+        help='Output FASTA filename for the productively-rearranged sequences (no stop'\
+            + ' codon in the CDR3aa); gzipped if it ends in ".gz"')
+    parser.add_argument('--scrub', nargs='?', type=str, \
+        help='Output FASTA filename for the productive sequences with a recognized CDR3'\
+            + ' of the chain type given by --chain; gzipped if it ends in ".gz"')
+    parser.add_argument('--prod_type', nargs='?', type=str, default='intact',\
+        choices=sorted(PROD_TYPES), help='Productive sequences have an intact V region'\
+            + ' ("intact", default) or an in-frame rearrangement with a truncated V region'\
+            + ' ("truncated", for hinge and nano libraries)')
+    parser.add_argument('--chain', nargs='?', type=str, choices=['VH', 'VK', 'VL'], \
+        help='Chain type kept in the --scrub output')
+    parser.add_argument('--clonotype_dict', nargs='?', type=str, \
+        help='Output filename for the clonotype dictionary of the --scrub set'\
+            + ' (formerly clonotype_count.pl)')
+    parser.add_argument('--clon_fasta', nargs='?', type=str, \
+        help='Output FASTA filename for the --scrub set with the clonotype labels'\
+            + ' (formerly clonotype_annotate.pl); gzipped if it ends in ".gz"')
+    parser.add_argument('--counts', nargs='?', type=str, \
+        help='Output CSV filename for the sequence and read counts per filter category')
+    parser.add_argument('--table', nargs='?', type=str, \
+        help='Output filename for the columnar export of the annotations (Arrow IPC with'\
+            + ' pyarrow, otherwise NumPy .npz, both memory-mapped when loaded; Parquet for'\
+            + ' a name ending in .parquet; the extension is added if missing, see'\
+            + ' annotation_table.py)')
+    parser.add_argument('--metrics', nargs='?', type=str, \
+        help='Output JSON filename for the run metrics (phase times, query and filter'\
+            + ' counters, peak memory; see run_metrics.py)')
+    parser.add_argument('--state', nargs='?', type=str, \
+        help='State store of the incremental mode (see topup_state.py): reuse the harvest'\
+            + ' results of the sequences of the previous run and update its clonotype counts'\
+            + ' (the chunks are harvested in this process)')
     #parser.add_argument('--debug', help='output debug information', action='store_true')
     args = parser.parse_args()
 
-try:
-    with open(args.igblastOut_name, encoding="utf8") as igblast, \
-         open(args.fasta_name, encoding="utf8") as fasta:
-        in_line = igblast.readline()
-
-        while in_line:
-            # print("0")
-            if re.search(r'^Query=\s', in_line):
-                igblast_data = parse_igblast_block(igblast, in_line)
-                in_line = fasta.readline()
-                annotated_fasta = compose_fasta_block(fasta, \
-                  args.fasta_name, in_line, igblast_data)
-                print(annotated_fasta['query_id'])
-                print(annotated_fasta['query_seq'])
-            in_line = igblast.readline()
-
-except FileNotFoundError:
-    if not exists(args.igblastOut_name):
-        sys.exit('File ' + args.igblastOut_name + ' was not found!')
-    else:
-        sys.exit('File ' + args.fasta_name + ' was not found!')
+    if len(args.file_pairs) % 2 or not (args.file_pairs or args.pairs_from):
+        sys.exit('Error: expecting pairs of IgBLAST output and FASTA filenames.')
+
+    if args.scrub and not args.chain:
+        sys.exit('Error: --scrub requires the chain type (--chain).')
+    if (args.clonotype_dict or args.clon_fasta) and not args.scrub:
+        sys.exit('Error: the clonotypes are determined for the --scrub output.')
+    filter_on = bool(args.prod or args.scrub or args.counts)
+    clonotype_counter = clonotypes.ClonotypeCounter()\
+        if args.clonotype_dict or args.clon_fasta else None
+
+    set_annotation_cache(args.cache_size)
+    metrics = run_metrics.RunMetrics() if args.metrics else None
+    harvested_files = []
+    workers = 1 if args.state else args.workers
+
+    try:
+        with contextlib.ExitStack() as outputs:
+            topup = None
+            if args.state:
+                store = outputs.enter_context(topup_state.StateStore(args.state))
+                # the stored results depend on the filter and the harvester code (and on
+                #   the igblastn options, see igblast_scheduler.py)
+                store.check_settings('harvest', topup_state.settings_key((args.prod_type\
+                    if filter_on else None, args.chain), (__file__, translator.__file__,\
+                    clonotypes.__file__)), 'harvests', 'clone_weights', 'clonotypes')
+                topup = TopupHarvest(store, clonotype_counter)
+            add_clonotype = None
+            if clonotype_counter is not None:
+                add_clonotype = topup.add_clonotype if topup is not None else clonotype_counter.add
+            sink = HarvestSink([outputs.enter_context(stream_io.open_output(filename))\
+                                if filename else None\
+                                for filename in (args.output, args.prod, args.scrub)],\
+                               args.prod_type if filter_on else None, args.chain,\
+                               add_clonotype,\
+                               outputs.enter_context(annotation_table.TableWriter(args.table))\
+                               if args.table else None)
+            with mig_pool.OrderedMigPool(harvest_batch, (sink.prod_type, sink.chain,\
+                                                         clonotype_counter is not None,\
+                                                         metrics is not None,\
+                                                         sink.table is not None,\
+                                                         args.cache_size),\
+                                         workers,\
+                                         HarvestOutput(sink, clonotype_counter, metrics),\
+                                         batch_migs=1) as block_queue:
+                file_pairs = zip(args.file_pairs[::2], args.file_pairs[1::2])
+                if args.pairs_from:
+                    file_pairs = itertools.chain(file_pairs, read_file_pairs(args.pairs_from))
+                for igblast_name, fasta_name in file_pairs:
+                    harvested_files.extend((igblast_name, fasta_name))
+                    fasta_records = seq_reader.read_records(fasta_name)
+
+                    if topup is not None:
+                        with stream_io.open_input(igblast_name, text=True) as igblast:
+                            topup.harvest(igblast, fasta_records, sink, metrics)
+                        continue
+                    if workers <= 1:
+                        with stream_io.open_input(igblast_name, text=True) as igblast:
+                            harvest_blocks(igblast, fasta_records, sink, metrics)
+                        continue
+
+                    # fan the query blocks out to the workers; the FASTA records go along
+                    block_ranges = split_igblast_stream(igblast_name)\
+                        if stream_io.is_gzipped(igblast_name)\
+                        else index_igblast_blocks(igblast_name)
+                    if metrics is not None:
+                        block_ranges = metrics.timed('parse', block_ranges)
+                    for source, block_count, header in block_ranges:
+                        block_queue.add((source, header),\
+                                        list(itertools.islice(fasta_records, block_count)))
+            if topup is not None:
+                topup.finish()
+
+        if args.counts:
+            sink.write_counts(args.counts)
+
+        # clonotypes of the scrub set; the annotation pass reads it back once
+        clock = run_metrics.RunMetrics.clock()
+        if args.clonotype_dict:
+            with stream_io.open_output(args.clonotype_dict) as dict_output:
+                clonotype_counter.write_dictionary(dict_output)
+        if args.clon_fasta:
+            with stream_io.open_output(args.clon_fasta) as clon_output:
+                clonotype_counter.annotate(seq_reader.read_records(args.scrub), clon_output)
+        if metrics is not None:
+            metrics.add_time('clonotypes', clock)
+
+        # annotation cache counters of this process and of the workers
+        cache_info = annotation_cache.cache_info()
+        cache_hits = cache_info.hits + block_queue.out.cache_hits
+        cache_misses = cache_info.misses + block_queue.out.cache_misses
+        sys.stderr.write('Annotation cache: ' + str(cache_hits) + ' hits, '\
+                         + str(cache_misses) + ' misses ('\
+                         + f"{100 * cache_hits / max(cache_hits + cache_misses, 1):.1f}"\
+                         + '% hit rate, size ' + str(args.cache_size) + ').\n')
+
+        if metrics is not None:
+            if sink.prod_type is not None:
+                for label, (sequences, reads) in zip(CATEGORY_LABELS, sink.counts):
+                    metrics.count(label + '_sequences', sequences)
+                    metrics.count(label + '_reads', reads)
+            metrics.count('annotation_cache_hits', cache_hits)
+            metrics.count('annotation_cache_misses', cache_misses)
+            metrics.write(args.metrics, 'igblast-out_harvester.py', harvested_files, 'queries')
+
+    except FileNotFoundError:
+        for filename in harvested_files:
+            if not exists(filename):
+                sys.exit('File ' + filename + ' was not found!')
+        raise
@@ -0,0 +1,380 @@
+'''
+igblast_scheduler.py
+  Concurrent igblastn runs over the chunks of the IgBLAST input. The input
+  FASTA is split into input_fasta_split.* chunks sized to the data set and to
+  the number of concurrent jobs (several chunks per job, so that the last jobs
+  finish together), and up to cores / threads igblastn processes, each with
+  -num_threads threads, are kept running, since the internal threading of
+  igblastn scales poorly. As soon as a chunk and all the chunks before it are
+  annotated, the "IgBLAST output, chunk" pair is printed on stdout for
+  igblast-out_harvester.py --pairs_from -, so that harvesting overlaps with
+  the remaining igblastn runs and its output keeps the input order. Each
+  output is written to a ".partial" file and renamed when complete, so that a
+  resumed run (--resume) starts at the first chunk without IgBLAST output.
+  With --state (incremental mode, see topup_state.py), only the sequences
+  without IgBLAST output in the state store are sent to igblastn; the output
+  of each chunk is assembled from the stored and the new query blocks, in the
+  query order, and the new blocks are stored.
+  Usage:
+    python3 igblast_scheduler.py input.fasta --prefix sample --cores 16 -- \
+      igblastn -organism mouse ... -show_translation
+'''
+
+import sys
+import argparse
+import glob
+import math
+import os
+import subprocess
+import time
+
+import seq_reader
+import topup_state
+
+CHUNK_PREFIX    = 'input_fasta_split.'
+CHUNK_SEQS_FILE = '.chunk_seqs' # suffix of the file recording the chunk size of an input
+CHUNKS_PER_JOB  = 4             # chunks per concurrent job
+MIN_CHUNK_SEQS  = 1000
+MAX_CHUNK_SEQS  = 100000        # the former fixed chunk size
+MAX_CHUNKS      = 650           # suffixes aa ... yz, in the order of the shell glob
+POLL_SECONDS    = 0.5
+
+
+#-------------------------------------------------------------------------------
+def chunk_suffix (index):
+    '''
+    returns the two-letter suffix of a chunk (as from split: aa, ab, ...)
+    '''
+    return chr(ord('a') + index // 26) + chr(ord('a') + index % 26)
+
+
+#-------------------------------------------------------------------------------
+def chunk_seqs_for (seq_count, jobs):
+    '''
+    returns the number of sequences per chunk
+    1st argument--number of sequences in the input
+    2nd argument--number of concurrent igblastn jobs
+    '''
+    chunk_seqs = math.ceil(seq_count / (jobs * CHUNKS_PER_JOB))
+    chunk_seqs = min(max(chunk_seqs, MIN_CHUNK_SEQS), MAX_CHUNK_SEQS)
+    return max(chunk_seqs, math.ceil(seq_count / MAX_CHUNKS), 1)
+
+
+#-------------------------------------------------------------------------------
+def split_input (filename, chunk_seqs):
+    '''
+    split a FASTA file into input_fasta_split.* chunks next to it; returns the
+      array of chunk filenames
+    1st argument--FASTA filename
+    2nd argument--number of sequences per chunk
+    '''
+    directory = os.path.dirname(filename)
+    chunks = []
+    output = None
+    seq_count = 0
+    with open(filename, 'rb') as handle:
+        for line in handle:
+            if line.startswith(b'>'):
+                if seq_count % chunk_seqs == 0:
+                    if output is not None:
+                        output.close()
+                    chunks.append(os.path.join(directory, CHUNK_PREFIX + chunk_suffix(len(chunks))))
+                    output = open(chunks[-1], 'wb')
+                seq_count += 1
+            if output is not None:
+                output.write(line)
+    if output is not None:
+        output.close()
+    return chunks
+
+
+#-------------------------------------------------------------------------------
+def prepare_chunks (filename, jobs, chunk_seqs = 0, resume = False):
+    '''
+    returns the array of chunk filenames of the input; the chunks of a resumed
+      run are kept, and chunks made again (e.g., after harvesting removed them)
+      use the chunk size recorded for the input, so that they match the IgBLAST
+      outputs
+    1st argument--FASTA filename
+    2nd argument--number of concurrent igblastn jobs
+    3rd argument--number of sequences per chunk (0 to size the chunks to the input)
+    4th argument--True to keep the chunks and the chunk size of the previous run
+    '''
+    directory = os.path.dirname(filename)
+    chunks = sorted(glob.glob(os.path.join(directory, CHUNK_PREFIX + '??')))
+    if resume and chunks:
+        return chunks
+
+    for chunk in chunks:
+        os.remove(chunk)
+    if resume and os.path.exists(filename + CHUNK_SEQS_FILE):
+        with open(filename + CHUNK_SEQS_FILE) as size_file:
+            chunk_seqs = int(size_file.read())
+    elif not chunk_seqs:
+        with open(filename, 'rb') as handle:
+            seq_count = sum(1 for line in handle if line.startswith(b'>'))
+        chunk_seqs = chunk_seqs_for(seq_count, jobs)
+    with open(filename + CHUNK_SEQS_FILE, 'w') as size_file:
+        size_file.write(str(chunk_seqs) + '\n')
+
+    sys.stderr.write('Splitting the input file into ' + str(chunk_seqs) + '-sequence chunks.\n')
+    return split_input(filename, chunk_seqs)
+
+
+#-------------------------------------------------------------------------------
+def chunk_output (prefix, chunk):
+    '''
+    returns the IgBLAST output filename of a chunk (e.g., sample.aa.igblast_out)
+    '''
+    return os.path.join(os.path.dirname(chunk), prefix + '.' + chunk.rsplit('.', 1)[1] + '.igblast_out')
+
+
+#-------------------------------------------------------------------------------
+def completed_output (output):
+    '''
+    returns the filename of the complete IgBLAST output of a chunk (possibly
+      gzipped by compressIntermediates), or None
+    '''
+    for filename in (output, output + '.gz'):
+        if os.path.exists(filename):
+            return filename
+    return None
+
+
+#-------------------------------------------------------------------------------
+def chunk_queries (chunk):
+    '''
+    returns the array of (query ID, sequence digest) of a chunk
+    '''
+    return [(record.header, topup_state.seq_digest(record.seq))\
+            for record in seq_reader.read_records(chunk)]
+
+
+#-------------------------------------------------------------------------------
+def report_blocks (handle):
+    '''
+    yields the header, the query blocks and the footer ('' if none) of an
+      IgBLAST output: verbose report ("Query=" blocks) or AIRR tabular (rows)
+    1st argument--IgBLAST output filehandle
+    '''
+    first_line = handle.readline()
+    if first_line.startswith('sequence_id\t'):
+        yield first_line
+        for line in handle:
+            yield line
+        yield ''
+        return
+
+    lines = [first_line]
+    for line in handle:
+        if line.startswith('Query= ') or line.startswith('  Database: '):
+            yield ''.join(lines)
+            lines = []
+            if line.startswith('  Database: '):
+                lines = [line] + handle.readlines()
+                break
+        lines.append(line)
+    yield ''.join(lines)
+
+
+#-------------------------------------------------------------------------------
+def write_new_queries (chunk, store):
+    '''
+    write the sequences of a chunk without stored IgBLAST output (each once)
+      to "<chunk>.new"; returns their number
+    1st argument--chunk filename
+    2nd argument--topup_state.StateStore
+    '''
+    queries = chunk_queries(chunk)
+    stored = store.stored_blocks(digest for query_id, digest in queries)
+    new_count = 0
+    with open(chunk + '.new', 'w') as output:
+        for record in seq_reader.read_records(chunk):
+            digest = topup_state.seq_digest(record.seq)
+            if digest not in stored:
+                output.write('>' + record.header + '\n' + record.seq + '\n')
+                stored[digest] = None
+                new_count += 1
+    return new_count
+
+
+#-------------------------------------------------------------------------------
+def merge_outputs (chunk, store, new_output, output):
+    '''
+    write the IgBLAST output of a chunk from the stored query blocks and those
+      of the new queries (see write_new_queries), and store the new blocks
+    1st argument--chunk filename
+    2nd argument--topup_state.StateStore
+    3rd argument--IgBLAST output of the new queries (None if there are none)
+    4th argument--output filename
+    '''
+    queries = chunk_queries(chunk)
+    stored = store.stored_blocks(digest for query_id, digest in queries)
+    if new_output is not None:
+        handle = open(new_output)
+        new_blocks = report_blocks(handle)
+        header = next(new_blocks)
+        store.set_setting('igblast_header', header)
+    else:
+        handle = None
+        new_blocks = iter(())
+        header = store.setting('igblast_header')
+    airr = header.startswith('sequence_id\t')
+
+    added = []
+    with open(output + '.partial', 'w') as merged:
+        merged.write(header)
+        for query_id, digest in queries:
+            block = stored.get(digest)
+            if block is None:
+                block = next(new_blocks, '')
+                if not block or not (airr or block.startswith('Query= ')):
+                    sys.exit('Error: the output of ' + query_id + ' is missing from ' + new_output + '.')
+                # the block without its query ID (the rest of the "Query=" line or row)
+                block = block.partition('\t' if airr else '\n')[2]
+                stored[digest] = block
+                added.append((digest, block))
+            merged.write((query_id + '\t' if airr else 'Query= ' + query_id + '\n') + block)
+        footer = next(new_blocks, None)
+        if handle is not None:
+            store.set_setting('igblast_footer', footer or '')
+            handle.close()
+        merged.write(store.setting('igblast_footer') or '')
+    store.store_blocks(added)
+    os.replace(output + '.partial', output)
+
+
+#-------------------------------------------------------------------------------
+def run_chunks (chunks, prefix, igblastn, jobs, threads, store = None):
+    '''
+    run igblastn on the chunks without complete output, up to jobs at a time,
+      and print the (IgBLAST output, chunk) pairs in chunk order as they become
+      available
+    1st argument--array of chunk filenames
+    2nd argument--prefix of the IgBLAST output filenames (dataset name)
+    3rd argument--igblastn command line, without -query, -num_threads and -out
+    4th argument--number of concurrent igblastn jobs
+    5th argument--number of threads of each igblastn job
+    6th argument--topup_state.StateStore of the incremental mode (optional)
+    '''
+    outputs = [completed_output(chunk_output(prefix, chunk)) for chunk in chunks]
+    pending = [ind for ind, output in enumerate(outputs) if output is None]
+    if len(pending) < len(chunks):
+        sys.stderr.write('Resuming at ' + (os.path.basename(chunks[pending[0]]) if pending\
+            else 'the end') + ' ... ' + str(len(chunks) - len(pending))\
+            + ' chunk(s) annotated during the previous run.\n')
+    pending.reverse()
+    running = {}
+    next_out = 0
+    try:
+        while True:
+            # hand the annotated chunks over to the harvester, in order
+            while next_out < len(chunks) and outputs[next_out] is not None:
+                print(outputs[next_out] + ' ' + chunks[next_out], flush=True)
+                next_out += 1
+            if not pending and not running:
+                return
+
+            merged = False
+            while pending and len(running) < jobs and not merged:
+                ind = pending.pop()
+                output = chunk_output(prefix, chunks[ind])
+                if store is None:
+                    running[ind] = subprocess.Popen(igblastn + ['-query', chunks[ind],\
+                        '-num_threads', str(threads), '-out', output + '.partial'])
+                elif write_new_queries(chunks[ind], store):
+                    running[ind] = subprocess.Popen(igblastn + ['-query', chunks[ind] + '.new',\
+                        '-num_threads', str(threads), '-out', output + '.new'])
+                else: # all the queries have stored output
+                    merge_outputs(chunks[ind], store, None, output)
+                    os.remove(chunks[ind] + '.new')
+                    outputs[ind] = output
+                    merged = True
+            if merged:
+                continue # hand the output over before the next chunk
+
+            time.sleep(POLL_SECONDS)
+            for ind, process in list(running.items()):
+                status = process.poll()
+                if status is None:
+                    continue
+                del running[ind]
+                if status != 0:
+                    sys.exit('Error: igblastn did not complete the annotation of '\
+                             + chunks[ind] + ' (exit status ' + str(status) + ').')
+                output = chunk_output(prefix, chunks[ind])
+                if store is None:
+                    os.replace(output + '.partial', output)
+                else:
+                    merge_outputs(chunks[ind], store, output + '.new', output)
+                    os.remove(output + '.new')
+                    os.remove(chunks[ind] + '.new')
+                outputs[ind] = output
+                sys.stderr.write('[' + time.strftime('%H:%M:%S%Z') + ']...Completed IgBLAST'\
+                                 + ' annotation of ' + os.path.basename(chunks[ind]) + '\n')
+    finally:
+        for process in running.values():
+            process.terminate()
+        for process in running.values():
+            process.wait()
+
+
+#-------------------------------------------------------------------------------
+#### main section
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage='%(prog)s [options] input -- igblastn [igblastn options]',\
+        description='Run igblastn on the chunks of the input'\
+        + ' concurrently; the IgBLAST output and chunk filenames are printed in chunk order'\
+        + ' as the chunks are annotated.')
+    parser.add_argument('input', type=str, \
+        help='IgBLAST input FASTA filename (e.g., "input.fasta")')
+    parser.add_argument('--prefix', nargs='?', type=str, \
+        help='Prefix of the IgBLAST output filenames (dataset name)')
+    parser.add_argument('--cores', nargs='?', type=int, default=os.cpu_count(), \
+        help='Number of cores for the igblastn jobs (default is the number of CPUs)')
+    parser.add_argument('--threads', nargs='?', type=int, default=1, \
+        help='Number of threads of each igblastn job (-num_threads, default is 1)')
+    parser.add_argument('--chunk_seqs', nargs='?', type=int, default=0, \
+        help='Number of sequences per chunk (default is sized to the input and the jobs, from '\
+            + str(MIN_CHUNK_SEQS) + ' to ' + str(MAX_CHUNK_SEQS) + ')')
+    parser.add_argument('--resume', action='store_true', \
+        help='Keep the chunks and the complete IgBLAST outputs of the previous run')
+    parser.add_argument('--state', nargs='?', type=str, \
+        help='State store of the incremental mode (see topup_state.py): igblastn runs only on'\
+            + ' the sequences without stored IgBLAST output')
+    parser.add_argument('--split_only', action='store_true', \
+        help='Only make the chunks (with the chunk size of the previous run, if recorded)')
+    # the igblastn command line (without -query, -num_threads and -out) follows "--"
+    argv = sys.argv[1:]
+    igblastn = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:len(argv) - len(igblastn) - ('--' in argv)])
+
+    if not args.split_only and (not igblastn or not args.prefix):
+        sys.exit('Error: expecting the output prefix (--prefix) and the igblastn command line.')
+    if args.cores < 1 or args.threads < 1 or args.chunk_seqs < 0:
+        sys.exit('Error: the numbers of cores, threads and chunk sequences must be positive.')
+    if not os.path.exists(args.input):
+        sys.exit('File ' + args.input + ' was not found!')
+    jobs = max(args.cores // args.threads, 1)
+
+    if args.split_only:
+        prepare_chunks(args.input, jobs, args.chunk_seqs, resume=True)
+        sys.exit()
+
+    if not args.resume:
+        # outputs of a previous run that could be mistaken for those of this one
+        for filename in glob.glob(os.path.join(os.path.dirname(args.input),\
+                                               glob.escape(args.prefix) + '.??.igblast_out*')):
+            os.remove(filename)
+    chunks = prepare_chunks(args.input, jobs, args.chunk_seqs, args.resume)
+    sys.stderr.write('Running up to ' + str(jobs) + ' igblastn job(s) of ' + str(args.threads)\
+                     + ' thread(s) on ' + str(len(chunks)) + ' chunk(s).\n')
+    if args.state:
+        with topup_state.StateStore(args.state) as store:
+            # the stored output (and its harvest) depends on the igblastn options (species,
+            #   databases, format)
+            store.check_settings('igblastn', topup_state.settings_key(igblastn, ()), 'annotations',\
+                                 'harvests')
+            run_chunks(chunks, args.prefix, igblastn, jobs, args.threads, store)
+    else:
+        run_chunks(chunks, args.prefix, igblastn, jobs, args.threads)
@@ -0,0 +1,139 @@
+'''
+mig_pool.py
+  Ordered multi-process execution of MIG batches for the barcode consensus
+  scripts. Complete MIGs are collected into batches, handed to a pool of worker
+  processes, and the text returned for each batch is written back in the
+  original MIG order so that the output stays deterministic. Streamed MIGs
+  (too large to be sent to a worker) are processed in the main process and
+  their output is queued in order with the batches.
+'''
+
+import sys
+from collections import deque
+from multiprocessing import Pool
+
+import seq_reader
+
+BATCH_MIGS  = 256   # maximal number of MIGs in a batch
+BATCH_READS = 8192  # submit a batch early once it holds this many reads
+PENDING_PER_WORKER = 4  # batches in flight per worker (bounds the memory use)
+
+
+class BatchExit(Exception):
+    '''
+    sys.exit() called while a worker process handled a batch
+    '''
+
+
+class ReadyResult:
+    '''
+    output text computed in place, queued with the pending batch results
+    '''
+
+    def __init__(self, text):
+        self.text = text
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.text
+
+
+#-------------------------------------------------------------------------------
+def run_batch (batch_func, batch, *func_args):
+    '''
+    calls batch_func in a worker process; sys.exit() is passed on as BatchExit,
+      since a SystemExit would end the worker without returning a result
+    '''
+    try:
+        return batch_func(batch, *func_args)
+    except SystemExit as error:
+        raise BatchExit(error.code) from None
+
+
+class OrderedMigPool:
+    '''
+    Collect MIGs, process them in batches with batch_func and write the results
+      in submission order.
+    batch_func(migs, *func_args) receives a list of (cluster_id, seqs) pairs
+      and returns the output text for the whole batch; it has to be defined at
+      module level so that it can be sent to the worker processes.
+    With workers <= 1 every MIG is processed in place (no pool is started), as
+      is every seq_reader.StreamedMig.
+    batch_migs caps the number of MIGs (or other work items) per batch.
+    '''
+
+    def __init__(self, batch_func, func_args=(), workers=1, out=sys.stdout,\
+                 batch_migs=BATCH_MIGS):
+        self.batch_func  = batch_func
+        self.func_args   = tuple(func_args)
+        self.workers     = workers
+        self.batch_migs  = batch_migs
+        self.out         = out
+        self.batch       = []
+        self.batch_reads = 0
+        self.pending     = deque()
+        self.pool        = Pool(workers) if workers > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.pool is not None:
+            self.pool.terminate()
+        return False
+
+    def add(self, cluster_id, seqs):
+        '''
+        queue a complete MIG for processing
+        1st argument--MIG identifier
+        2nd argument--array of sequences in the MIG (or seq_reader.StreamedMig)
+        '''
+        if self.pool is None:
+            self.out.write(self.batch_func([(cluster_id, seqs)], *self.func_args))
+            return
+        if isinstance(seqs, seq_reader.StreamedMig):
+            if self.batch:
+                self._submit()
+            self.pending.append(ReadyResult(self.batch_func([(cluster_id, seqs)],\
+                                                            *self.func_args)))
+            return
+
+        self.batch.append((cluster_id, seqs))
+        self.batch_reads += len(seqs)
+        if len(self.batch) >= self.batch_migs or self.batch_reads >= BATCH_READS:
+            self._submit()
+
+    def _submit(self):
+        self.pending.append(self.pool.apply_async(run_batch,\
+            (self.batch_func, self.batch) + self.func_args))
+        self.batch = []
+        self.batch_reads = 0
+
+        # write out the finished batches in order, waiting if too many are in flight
+        while self.pending and (self.pending[0].ready() or\
+                len(self.pending) > self.workers * PENDING_PER_WORKER):
+            self._write_next()
+
+    def _write_next(self):
+        try:
+            self.out.write(self.pending.popleft().get())
+        except BatchExit as error:
+            sys.exit(error.args[0])
+
+    def close(self):
+        '''
+        process the remaining MIGs, write out all results and shut down the pool
+        '''
+        if self.pool is None:
+            return
+        if self.batch:
+            self._submit()
+        while self.pending:
+            self._write_next()
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
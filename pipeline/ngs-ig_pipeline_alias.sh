@@ -13,32 +13,59 @@ if [ -z $BLAST_INSTALL ]; then
   BLAST_INSTALL='Y'
 fi
 
+## quality profiles of the raw reads (step 1): fraction of the reads profiled
+#   (1 for every read; the same reads are sampled from R1 and R2 at each run)
+QUALITY_sample=1
+# processes profiling the FASTQ files (0 for one per file)
+QUALITY_numworkers=${QUALITY_numworkers:-0}
+
 ## variables passed to FLASH (step 1)
 FLASH_minoverlap=20
 FLASH_maxoverlap=200
 FLASH_mismatch_density=0.45 # 0.25 is the default
+FLASH_numthreads=${FLASH_numthreads:-`nproc`}
 
 ## If reads need to be "stitched", this palindromic string is to be used (and recognized later, if needed)
 READ_stitch='NNNNNNANNNCNNNGNNNTNNNNNN'
 
 ## UMI barcode pattern: "TNNNNTNNNNTNNNNT"
 UMIbarcode='T[ATCG]{4}T[ATCG]{4}T[ATCG]{4}T'
+# barcodes within this Hamming distance of a more abundant one are merged into its
+#   MIG (sequencing errors in the UMI; 0 keeps exact barcodes, 1 is recommended)
+UMIdistance=0
 
 ## variables passed to cutadapt (step 4)
 MINLENGTH=200
 MAXLENGTH=800
 
+## The worker and core counts below keep the values preset in the environment (as
+##   set for each stage by batch_runner.py, which shares the cores among the datasets)
+
+## UMI consensus variables (step 4): worker processes for MIG consensus building
+CONSENSUS_numworkers=${CONSENSUS_numworkers:-`nproc`}
+# MIGs with more reads are streamed through a memory-bounded consensus, with the seed
+#   chosen from their first CONSENSUS_maxreads reads (0 holds every MIG in memory)
+CONSENSUS_maxreads=0
+
 ## IgBLAST variables (step 5)
 # It is important for IgBLAST that the IGDATA variable be available in global scope!
 export IGDATA="$RESOURCEDIR/igblast_data"
-IGBLAST_numthreads=`nproc`
+# cores for the concurrent igblastn jobs (igblast_scheduler.py), each running
+#   IGBLAST_jobthreads threads; the internal threading of igblastn scales poorly
+IGBLAST_numthreads=${IGBLAST_numthreads:-`nproc`}
+IGBLAST_jobthreads=1
+# IgBLAST output: empty for the verbose report, 19 for the (much smaller) AIRR
+#   tabular format; igblast-out_harvester.py reads either one
+IGBLAST_outfmt=''
+# worker processes for harvesting the IgBLAST output
+HARVEST_numworkers=${HARVEST_numworkers:-`nproc`}
 
 ## BLAST variables (optional step used for hinge data)
 # BLAST_INSTALL='Y' # expected: Y or N, inheriting variable from Docker container
 
 if [[ $BLAST_INSTALL == 'Y' ]]; then
   export BLAST_DATA="$RESOURCEDIR/blast_data"
-  BLAST_numthreads=`nproc`
+  BLAST_numthreads=${BLAST_numthreads:-`nproc`}
 fi
 
 ####################################################################
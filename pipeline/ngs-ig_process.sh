@@ -71,8 +71,14 @@ case $1 in
     prepareArchive
     exit
     ;;
+  stage )
+    # a single stage, without the checks of the main routine (see stage_runner.py)
+    FRESH=0
+    STAGE=$2
+    STAGE_arg=$3
+    ;;
   *)
-    echo "commandline: ngs-ig_process.sh process|repeat|clean|archive"
+    echo "commandline: ngs-ig_process.sh process|repeat|clean|archive|stage <name>"
     exit 0
     ;;
 esac
@@ -152,6 +158,11 @@ echo "primer: $DATASET_primer"
 echo "libraryMethod: $DATASET_libraryMethod"
 echo "libraryType: $DATASET_libraryType"
 
+if [[ -n $STAGE ]]; then
+  runStage $STAGE $STAGE_arg
+  exit $?
+fi
+
 ###############################################
 ## initialize the output directory structure ##
 ###############################################
@@ -160,12 +171,12 @@ if [[ $FRESH -ne 0 ]]; then
     echo "Already running a process! This was probably started by mistake."
     exit 1
   fi
-  initialize
+  runStage initialize
 fi
 
 checkExist "$WDIR/$SCRDIR/adapter*.conf"
 if [[ $? -ne 1 ]]; then
-  selectAdaptors $DATASET_species $DATASET_chain $DATASET_libraryMethod $DATASET_primer $DATASET_libraryType
+  runStage adapters
 else
   echo "Skipping ... Adapters selected during previous run."
 fi
@@ -175,7 +186,7 @@ fi
 ##################################
 checkExist "$WDIR/$OUTDIR/*.quality.pdf"
 if [[ $? -ne 1 ]]; then
-  plotRunQuality $DATA1 $DATA2
+  runStage quality
 else
   echo "Skipping FASTQ quality plot generation."
 fi
@@ -185,8 +196,7 @@ fi
 ##################
 checkExist "$WDIR/$OUT_flash/out.extendedFrags.fastq*"
 if [[ $? -ne 1 ]]; then
-  FLASHstep ${FLASH_maxoverlap:?} ${FLASH_minoverlap:?} ${FLASH_mismatch_density:?} \
-    "$WDIR/$INDIR/$DATA1" "$WDIR/$INDIR/$DATA2"
+  runStage flash
 else
   echo "Skipping step ... amplicons reconstructed during previous run."
 fi
@@ -196,7 +206,7 @@ fi
 ###################
 checkTargetNewer "$WDIR/$OUT_flash/out.extendedFrags.fastq*" "$WDIR/$OUT_cutadapt/$DATANAME.trim2.fastq*"
 if [[ $? -ne 1 ]]; then
-  cutadaptStep
+  runStage cutadapt
 else
   echo "Skipping step ... Primers trimmed during previous run."
 fi
@@ -206,7 +216,7 @@ fi
 ########################
 checkTargetNewer "$WDIR/$OUT_cutadapt/$DATANAME.trim2.fastq*" "$WDIR/$OUT_igblast/input.fasta"
 if [[ $? -ne 1 ]]; then
-  fastxStep $DATASET_libraryMethod $DATASET_primer $DATASET_libraryType
+  runStage fastx
 else
   echo "Skipping step ... Dataset converted and collapsed during previous run."
 fi
@@ -216,7 +226,7 @@ fi
 ###################
 checkTargetNewer "$WDIR/$OUT_igblast/input.fasta" "$WDIR/$OUT_igblast/$DATANAME.aa.igblast_out*"
 if [[ $? -ne 1 ]]; then
-  IgBLASTstep $DATASET_species
+  runStage igblast
 else
   echo "Skipping step ... IgBLAST annotation completed during previous run."
 fi
@@ -232,7 +242,7 @@ if [[ $? -ne 1 ]]; then
       error "could not locate the IgBLAST output for repeat processing."
     fi
   fi
-  IgBLASToutputProcessing $DATASET_chain $DATASET_primer $DATASET_libraryMethod $DATASET_libraryType
+  runStage harvest
 else
   echo "Skipping step ... IgBLAST output processing completed during previous run."
 fi
@@ -245,7 +255,7 @@ if [[ "$DATASET_libraryType" =~ ^(HINGE|HINGENano)$ ]] ; then
     "$WDIR/$OUT_igblast/$DATANAME.igblast.prod.scrub.clon.subclass.subset.CDR3aa_dict.fasta"
   # TODO: this doesn't take care of the newer UMI5RACE datasets, only the multiplex ones
   if [[ $? -ne 1 ]]; then
-    hingeProcessingStep $DATASET_species
+    runStage hinge
   else
     echo "Skipping step ... hinge BLAST output processing completed during previous run."
   fi
@@ -256,12 +266,7 @@ fi
 #######################################
 checkTargetNewer "$WDIR/$OUTDIR/$DATANAME.process_stats" "$WDIR/$OUTDIR/FASTAViewer/*.RData"
 if [[ $? -ne 1 ]]; then
-  if [ -f $WDIR/$SCRDIR/postprocess/postprocess.sh ]; then
-    echo "########################################"
-    echo "Post-processing (visualization, etc.) ..."
-		# shellcheck source=/dev/null
-    source $WDIR/$SCRDIR/postprocess/postprocess.sh
-  fi
+  runStage postprocess
 else
   echo "Skipping post-processing steps (figures and FASTAViewer processing)."
 fi
@@ -269,11 +274,8 @@ fi
 ############################
 ## Compress intermediates ##
 ############################
-compressIntermediates
+runStage compress
 
 if [[ $FRESH -ne 0 ]]; then
-  mv $WDIR/running $WDIR/done
-  echo "done" >> $WDIR/done
-  date >> $WDIR/done
-  cat $WDIR/done >> $WDIR/run.log
+  runStage finish
 fi
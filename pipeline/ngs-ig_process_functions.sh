@@ -20,6 +20,19 @@ function time_msg () {
   echo "[$(date +%T%Z)]...$1"
 }
 
+# function: run a consensus or harvester script through the worker service
+#   (worker_service.py) if WORKER_SOCKET names one, otherwise with python3
+# arguments: script name, script arguments
+function pythonJob () {
+  local script=$1
+  shift
+  if [[ -n "${WORKER_SOCKET:-}" ]]; then
+    python3 $WDIR/$SCRDIR/worker_client.py $script "$@"
+  else
+    python3 $WDIR/$SCRDIR/$script "$@"
+  fi
+}
+
 # function: clean directory
 # arguments: none
 function cleanWorkingDirectory () {
@@ -68,6 +81,74 @@ function initialize () {
   fi
 }
 
+# function: run one pipeline stage (from the main routine or from stage_runner.py)
+# arguments: stage name, output filename (for the "params" stage)
+function runStage () {
+  stage=$1
+
+  case $stage in
+    initialize )
+      initialize
+      ;;
+    params )
+      # dataset and environment values that the stages depend on (stage_runner.py)
+      for name in DATANAME DATA1 DATA2 DATASET_species DATASET_chain DATASET_libraryMethod \
+                  DATASET_primer DATASET_libraryType FLASH_minoverlap FLASH_maxoverlap \
+                  FLASH_mismatch_density READ_stitch UMIbarcode UMIdistance MINLENGTH MAXLENGTH \
+                  CONSENSUS_maxreads QUALITY_sample IGDATA IGBLAST_outfmt BLAST_DATA; do
+        echo "$name=${!name}"
+      done > $2
+      ;;
+    adapters )
+      selectAdaptors $DATASET_species $DATASET_chain $DATASET_libraryMethod $DATASET_primer $DATASET_libraryType
+      ;;
+    quality )
+      plotRunQuality $DATA1 $DATA2
+      ;;
+    flash )
+      FLASHstep ${FLASH_maxoverlap:?} ${FLASH_minoverlap:?} ${FLASH_mismatch_density:?} \
+        "$WDIR/$INDIR/$DATA1" "$WDIR/$INDIR/$DATA2"
+      ;;
+    cutadapt )
+      cutadaptStep
+      ;;
+    fastx )
+      fastxStep $DATASET_libraryMethod $DATASET_primer $DATASET_libraryType
+      ;;
+    igblast )
+      IgBLASTstep $DATASET_species $DATASET_chain $DATASET_libraryMethod $DATASET_libraryType
+      ;;
+    harvest )
+      IgBLASToutputProcessing $DATASET_chain $DATASET_primer $DATASET_libraryMethod $DATASET_libraryType
+      ;;
+    hinge )
+      hingeProcessingStep $DATASET_species
+      ;;
+    postprocess )
+      if [ -f $WDIR/$SCRDIR/postprocess/postprocess.sh ]; then
+        echo "########################################"
+        echo "Post-processing (visualization, etc.) ..."
+        # shellcheck source=/dev/null
+        source $WDIR/$SCRDIR/postprocess/postprocess.sh
+      fi
+      return 0 # figure problems are reported above and do not stop the pipeline
+      ;;
+    compress )
+      compressIntermediates
+      ;;
+    finish )
+      if [[ -f $WDIR/running ]]; then
+        mv $WDIR/running $WDIR/done
+        echo "done" >> $WDIR/done
+        date >> $WDIR/done
+        cat $WDIR/done >> $WDIR/run.log
+      fi
+      ;;
+    * )
+      error "unknown pipeline stage $stage"
+  esac
+}
+
 # function: checkExist
 # arguments: path to list of files
 # returns: 1 if found
@@ -201,11 +282,14 @@ function plotRunQuality () {
   file1=$1
   file2=$2
 
-  ## Generate sequencing run statistics and graphs
-  time_msg "Generating stats for $file1"
-  Rscript $WDIR/$SCRDIR/readQualityPlot.R --inputFile=$WDIR/$INDIR/$file1 --outputFile=$WDIR/$OUTDIR/$file1.quality.pdf
-  time_msg "Generating stats for $file2"
-  Rscript $WDIR/$SCRDIR/readQualityPlot.R --inputFile=$WDIR/$INDIR/$file2 --outputFile=$WDIR/$OUTDIR/$file2.quality.pdf
+  ## Generate sequencing run statistics and graphs: per-cycle quality table and
+  ##   plot of each file (profiled in parallel)
+  time_msg "Generating stats for $file1 and $file2"
+  python3 $WDIR/$SCRDIR/quality_profile.py --outdir $WDIR/$OUTDIR --sample ${QUALITY_sample:-1} \
+    --workers ${QUALITY_numworkers:-0} $WDIR/$INDIR/$file1 $WDIR/$INDIR/$file2
+  if [[ $? -ne 0 ]]; then
+    error "Couldn't generate the quality profiles of $file1 and $file2."
+  fi
 
   ## accounting start
   buildReadAccountingSummary initialize
@@ -223,14 +307,14 @@ function FLASHstep (){
 
   cd $WDIR/$OUT_flash || { error "Error: FLASH output directory not accessible!"; }
   if [[ "${DATASET_libraryType:?}" =~ ^(variableNano|HINGENano)$ ]] || ([[ "${DATASET_libraryMethod:?}" == UMI5RACENEB ]] && [[ "$DATASET_libraryType" == HINGE ]]); then
-    flash -M $maxoverlap -m $minoverlap -x $mismatchDensity -z $file1 $file2 --output-prefix=out1
+    flash -t ${FLASH_numthreads:-1} -M $maxoverlap -m $minoverlap -x $mismatchDensity -z $file1 $file2 --output-prefix=out1
     time_msg "Generating a stitched FASTQ from the paired reads."
     gunzip -c $file1 > temp1.fastq
     gunzip -c $file2 > temp2.fastq
     perl $WDIR/$SCRDIR/fastq_stitch.pl temp1.fastq temp2.fastq ${READ_stitch:?} > out.extendedFrags.fastq
     gzip out.extendedFrags.fastq
   else
-    flash -M $maxoverlap -m $minoverlap -x $mismatchDensity -z $file1 $file2
+    flash -t ${FLASH_numthreads:-1} -M $maxoverlap -m $minoverlap -x $mismatchDensity -z $file1 $file2
   fi
 
   ## accounting
@@ -247,7 +331,7 @@ function asymmetricSequencingExtension (){
   file=$4
   workingDir=`pwd`
   cd $WDIR/$OUT_flash || { error "Error: FLASH output directory not accessible!"; }
-  flash -M $maxoverlap -m $minoverlap -x $mismatchDensity --interleaved-input -o UMI5RACEASYM -z $file
+  flash -t ${FLASH_numthreads:-1} -M $maxoverlap -m $minoverlap -x $mismatchDensity --interleaved-input -o UMI5RACEASYM -z $file
   cd $workingDir || { error "Error: working directory no longer accessible!"; }
 }
 
@@ -326,11 +410,14 @@ function fastxStep (){
     echo "Working with a $libraryMethod $libraryType library with directional adaptoring ..."
     echo "Processing UMI barcodes ..."
     ${zcat:?} $WDIR/$OUT_cutadapt/$DATANAME.trim2.fastq.gz | fastq_to_fasta -Q 33 -v -n -o $DATANAME.trimmed.fasta
-    perl $WDIR/$SCRDIR/fasta_barcode_count.pl $DATANAME.trimmed.fasta $preamble $barcode $post> $DATANAME.trimmed.bc_annot.fasta
-    python3 $WDIR/$SCRDIR/fasta_barcode_consensus.py $DATANAME.trimmed.bc_annot.fasta > $DATANAME.trimmed.bc_annot.consensus.fastq
-    fastq_to_fasta -Q 33 -v -n -i $DATANAME.trimmed.bc_annot.consensus.fastq -o $DATANAME.trimmed.bc_annot.consensus.fasta
-    time_msg "Consensus building collapsed the set to `${grep:?} -c ">" $DATANAME.trimmed.bc_annot.consensus.fasta` sequences."
-    echo "Unrecognized barcodes found in `$grep -c "barcode=unknown" $DATANAME.trimmed.bc_annot.fasta` sequences."
+    # the reads are grouped by barcode in memory and handed straight to the consensus
+    #   step; the grouped set is written as well (accounting, abundance figure). In
+    #   top-up mode, the MIGs without new reads keep their stored consensus
+    pythonJob fasta_barcode_consensus.py --workers ${CONSENSUS_numworkers:-1} --max_mig_reads ${CONSENSUS_maxreads:-0} ${TOPUP_STATE:+--state $TOPUP_STATE} --metrics $DATANAME.consensus.metrics.json $DATANAME.trimmed.fasta \
+      --umi "$preamble" "$barcode" "$post" --umi_distance ${UMIdistance:-0} --grouped $DATANAME.trimmed.bc_annot.fasta -o $DATANAME.trimmed.bc_annot.consensus.fastq.gz
+    ${zcat:?} $DATANAME.trimmed.bc_annot.consensus.fastq.gz | fastq_to_fasta -Q 33 -v -n -o $DATANAME.trimmed.bc_annot.consensus.fasta
+    time_msg "Consensus building collapsed the set to `python3 $WDIR/$SCRDIR/run_metrics.py $DATANAME.consensus.metrics.json migs_out` sequences."
+    echo "Unrecognized barcodes found in `${grep:?} -c "barcode=unknown" $DATANAME.trimmed.bc_annot.fasta` sequences."
     echo "Cleaning up the basecalls ..."
     fastx_clipper -v -a N -i $DATANAME.trimmed.bc_annot.consensus.fasta -o $DATANAME.trimmed.bc_annot.consensus.noN.fasta
     ## clean up the input for igblast while retaining the UMI collapse
@@ -349,11 +436,10 @@ function fastxStep (){
     perl $WDIR/$SCRDIR/fastq_asym_barcode_order.pl $DATANAME.trim1.bc_annot.fastq > $DATANAME.trim1.bc_annot.ordered.fastq
     echo "Trimming reads to quality of 15."
     cutadapt -q 15 -o $DATANAME.trim1.bc_annot.ordered_q15.fastq $DATANAME.trim1.bc_annot.ordered.fastq
-    echo "Calculating consensus sequences for UMI-barcoded read clusters ..."
-    python3 $WDIR/$SCRDIR/fastq_barcode_consensus.py $DATANAME.trim1.bc_annot.ordered_q15.fastq --min_size 2 > $DATANAME.trim1.bc_annot.ordered.cons.fastq
-    time_msg "Consensus building collapsed the set to `${grep:?} -c "^@MIG" $DATANAME.trim1.bc_annot.ordered.cons.fastq` sequences."
-    echo "Unrecognized barcodes found in `$grep -c "barcode=unknown" $DATANAME.trim1.bc_annot.fastq` sequences."
-    perl $WDIR/$SCRDIR/fastq_barcode_consensus_interleaved_filter.pl $DATANAME.trim1.bc_annot.ordered.cons.fastq > $DATANAME.trim1.bc_annot.ordered.cons.interleaved.fastq
+    echo "Calculating consensus sequences for UMI-barcoded read clusters (fwd/rev pairs by barcode) ..."
+    pythonJob fastq_barcode_consensus.py --paired --workers ${CONSENSUS_numworkers:-1} --max_mig_reads ${CONSENSUS_maxreads:-0} --metrics $DATANAME.consensus.metrics.json $DATANAME.trim1.bc_annot.ordered_q15.fastq --min_size 2 > $DATANAME.trim1.bc_annot.ordered.cons.interleaved.fastq
+    time_msg "Consensus building collapsed the set to `python3 $WDIR/$SCRDIR/run_metrics.py $DATANAME.consensus.metrics.json pairs_out` fwd/rev sequence pairs."
+    echo "Unrecognized barcodes found in `${grep:?} -c "barcode=unknown" $DATANAME.trim1.bc_annot.fastq` sequences."
 
     echo "Performing FLASH to rebuild the amplicons from UMI cluster consensus sequences."
     asymmetricSequencingExtension "400" ${FLASH_minoverlap:?} "0.5" "$WDIR/$OUT_fastxtk/$DATANAME.trim1.bc_annot.ordered.cons.interleaved.fastq"
@@ -371,9 +457,9 @@ function fastxStep (){
     $grep -v ";orient_unk" $DATANAME.trimmed.allorient.fasta| $grep -A1 ">" | $grep -v "\-\-" > $DATANAME.trimmed.orient.fasta
     echo "Uknown orientations (primer recognition problems) encountered: `$grep -c ";orient_unk" $DATANAME.trimmed.allorient.fasta` times"
     echo "Ordering reads using UMI barcodes from FLASH-extended data..."
-    perl $WDIR/$SCRDIR/fasta_barcode_count.pl $DATANAME.trimmed.orient.fasta "$preamble" "$barcode" "$post"> $DATANAME.trimmed.orient.bc_annot.fasta
 
     if [[ "$libraryType" =~ ^(variableNano|HINGE|HINGENano)$ ]]; then
+       perl $WDIR/$SCRDIR/fasta_barcode_count.pl $DATANAME.trimmed.orient.fasta "$preamble" "$barcode" "$post"> $DATANAME.trimmed.orient.bc_annot.fasta
        # This sequence is expected to be stitched; remove the forward read (before the stitch)
        echo "Releasing the 3' sequence from the stitched reads..."
        # cutadapt: the '-N' switch turns off the wildcard matching in the adapter sequences
@@ -383,17 +469,19 @@ function fastxStep (){
        cp $DATANAME.trimmed.orient.bc_annot.3prime.fasta $DATANAME.trimmed.orient.bc_annot.ordered.fasta
 
         echo "Determine the consensus sequence..."
-       python3 $WDIR/$SCRDIR/fasta_barcode_consensus.py $DATANAME.trimmed.orient.bc_annot.3prime.fasta > $DATANAME.trimmed.orient.bc_annot.3prime.consensus.fastq
-       fastq_to_fasta -Q 33 -v -n -i $DATANAME.trimmed.orient.bc_annot.3prime.consensus.fastq -o $DATANAME.trimmed.orient.bc_annot.3prime.consensus.fasta
-       time_msg "Consensus building collapsed the set to `$grep -c ">" $DATANAME.trimmed.orient.bc_annot.3prime.consensus.fasta` sequences."
+       pythonJob fasta_barcode_consensus.py --workers ${CONSENSUS_numworkers:-1} --max_mig_reads ${CONSENSUS_maxreads:-0} ${TOPUP_STATE:+--state $TOPUP_STATE} --metrics $DATANAME.consensus.metrics.json $DATANAME.trimmed.orient.bc_annot.3prime.fasta -o $DATANAME.trimmed.orient.bc_annot.3prime.consensus.fastq.gz
+       ${zcat:?} $DATANAME.trimmed.orient.bc_annot.3prime.consensus.fastq.gz | fastq_to_fasta -Q 33 -v -n -o $DATANAME.trimmed.orient.bc_annot.3prime.consensus.fasta
+       time_msg "Consensus building collapsed the set to `python3 $WDIR/$SCRDIR/run_metrics.py $DATANAME.consensus.metrics.json migs_out` sequences."
        echo "Unrecognized barcodes found in `$grep -c "barcode=unknown" $DATANAME.trimmed.orient.bc_annot.3prime.fasta` sequences."
        cp $DATANAME.trimmed.orient.bc_annot.3prime.consensus.fasta $WDIR/$OUT_igblast/input.fasta
     else
        # This sequence should be properly extended.
        echo "Determine the consensus sequence..."
-       python3 $WDIR/$SCRDIR/fasta_barcode_consensus.py $DATANAME.trimmed.orient.bc_annot.fasta > $DATANAME.trimmed.orient.bc_annot.consensus.fastq
-       fastq_to_fasta -Q 33 -v -n -i $DATANAME.trimmed.orient.bc_annot.consensus.fastq -o $DATANAME.trimmed.orient.bc_annot.consensus.fasta
-       time_msg "Consensus building collapsed the set to `$grep -c ">" $DATANAME.trimmed.orient.bc_annot.consensus.fasta` sequences."
+       # grouping by barcode is done in memory by the consensus step
+       pythonJob fasta_barcode_consensus.py --workers ${CONSENSUS_numworkers:-1} --max_mig_reads ${CONSENSUS_maxreads:-0} ${TOPUP_STATE:+--state $TOPUP_STATE} --metrics $DATANAME.consensus.metrics.json $DATANAME.trimmed.orient.fasta \
+         --umi "$preamble" "$barcode" "$post" --umi_distance ${UMIdistance:-0} --grouped $DATANAME.trimmed.orient.bc_annot.fasta -o $DATANAME.trimmed.orient.bc_annot.consensus.fastq.gz
+       ${zcat:?} $DATANAME.trimmed.orient.bc_annot.consensus.fastq.gz | fastq_to_fasta -Q 33 -v -n -o $DATANAME.trimmed.orient.bc_annot.consensus.fasta
+       time_msg "Consensus building collapsed the set to `python3 $WDIR/$SCRDIR/run_metrics.py $DATANAME.consensus.metrics.json migs_out` sequences."
        echo "Unrecognized barcodes found in `$grep -c "barcode=unknown" $DATANAME.trimmed.orient.bc_annot.fasta` sequences."
        # needed for proper MIG accounting
        cp $DATANAME.trimmed.orient.bc_annot.fasta $DATANAME.trimmed.orient.bc_annot.ordered.fasta
@@ -422,10 +510,59 @@ function fastxStep (){
   buildUniqueAccountingSummary fastxStepAcct
 }
 
-# function: the igblast step
-# arguments: species
+# function: split the IgBLAST input into the input_fasta_split.* chunks (with
+#   the chunk size recorded by igblast_scheduler.py, so that the chunks match the
+#   IgBLAST outputs)
+# arguments: none
+function splitIgBLASTinput (){
+  python3 $WDIR/$SCRDIR/igblast_scheduler.py input.fasta --split_only
+}
+
+# function: transfer the IgBLAST annotations to the input sequences and sort out
+#   the productively-rearranged sequences (no stop codons in the CDR3aa; there
+#   may still be stops in the rest of the sequence!!!) and those of the expected
+#   chain type with a recognized CDR3, counting each category; the clonotypes of
+#   the latter set are counted along the way
+# arguments: chain, libraryType, igblast-out_harvester.py arguments (file pairs
+#   or --pairs_from, workers)
+function harvestIgBLASToutput (){
+  chain=$1
+  libraryType=$2
+  shift 2
+
+  if [[ "$libraryType" =~ ^(HINGE|HINGENano|variableNano)$ ]]; then
+    echo "Sorting out the productively-rearranged sequences for a $libraryType dataset (expecting truncations) ..."
+    prod_type=truncated
+  else
+    echo "Sorting out the productively-rearranged sequences..."
+    prod_type=intact
+  fi
+  case $chain in
+    IgM|IgG ) scrub_chain=VH ;;
+    IgK ) scrub_chain=VK ;;
+    IgL ) scrub_chain=VL ;;
+    * ) scrub_chain='' ;;
+  esac
+  echo "Removing the invalid (or unrecognized) sequences..."
+
+  pythonJob igblast-out_harvester.py -o $DATANAME.igblast.fasta \
+    --prod $DATANAME.igblast.prod.fasta --prod_type $prod_type \
+    ${scrub_chain:+--scrub $DATANAME.igblast.prod.scrub.fasta --chain $scrub_chain} \
+    ${scrub_chain:+--clonotype_dict $DATANAME.igblast.prod.scrub.clonotype_dict} \
+    ${scrub_chain:+--clon_fasta $DATANAME.igblast.prod.scrub.clon.fasta} \
+    --counts $DATANAME.igblast.counts.csv --metrics $DATANAME.igblast.metrics.json \
+    --table $DATANAME.igblast.table ${TOPUP_STATE:+--state $TOPUP_STATE} "$@"
+}
+
+# function: the igblast step; igblastn runs concurrently on the chunks of the
+#   input and each chunk is harvested as soon as it and all the chunks before
+#   it are annotated
+# arguments: species, chain, libraryMethod, libraryType
 function IgBLASTstep (){
   species=$1
+  chain=$2
+  libraryMethod=$3
+  libraryType=$4
 
   case $species in
     Hs)
@@ -445,6 +582,7 @@ function IgBLASTstep (){
   esac
 
   cd $WDIR/$OUT_igblast || { error "Error: IgBLAST output directory not accessible!"; }
+  rm -f $DATANAME.igblast.harvested
 
   echo "###############################"
   time_msg "Running igblastn ..."
@@ -465,27 +603,40 @@ function IgBLASTstep (){
   echo "###          -germline_db_J $IGDATA/database/${IGBLAST_species}_gl_J"
   echo "###          -auxiliary_data $IGDATA/optional_file/${IGBLAST_species}_gl.aux"
   echo "###          -show_translation"
-  echo "###          -query input.fasta"
-  echo "###          -num_threads ${IGBLAST_numthreads:?}"
-  echo "###          -out $DATANAME.igblast_out"
-
-  echo "Splitting the input file into 100,000-sequence blocks."
-  split --verbose --lines=200000 input.fasta input_fasta_split.
+  echo "###          -query input_fasta_split.*"
+  echo "###          -num_threads ${IGBLAST_jobthreads:-1}"
+  if [[ -n "$IGBLAST_outfmt" ]]; then
+    echo "###          -outfmt $IGBLAST_outfmt"
+  fi
+  echo "###          -out $DATANAME.*.igblast_out"
 
   igblast_STARTTIME=$(date +%s)
 
-  for f in input_fasta_split.*; do
-    g=${f#*.}
+  # up to IGBLAST_numthreads / IGBLAST_jobthreads igblastn jobs run at a time; a
+  #   resumed run (IGBLAST_resume set by stage_runner.py) keeps the chunks of the
+  #   interrupted run and starts at the first chunk without IgBLAST output. The
+  #   harvester reads the annotated chunks in order, as the scheduler lists them.
+  #   In top-up mode (TOPUP_STATE set by stage_runner.py --topup), only the
+  #   sequences without stored IgBLAST output are sent to igblastn and annotated
+  #   by the harvester, which updates the stored clonotype counts
+  python3 $WDIR/$SCRDIR/igblast_scheduler.py input.fasta --prefix $DATANAME \
+    --cores ${IGBLAST_numthreads:?} --threads ${IGBLAST_jobthreads:-1} ${IGBLAST_resume:+--resume} \
+    ${TOPUP_STATE:+--state $TOPUP_STATE} -- \
     igblastn -organism $IGBLAST_species \
              -germline_db_V $IGDATA/database/${IGBLAST_species}_gl_V \
              -germline_db_D $IGDATA/database/${IGBLAST_species}_gl_D \
              -germline_db_J $IGDATA/database/${IGBLAST_species}_gl_J \
              -auxiliary_data $IGDATA/optional_file/${IGBLAST_species}_gl.aux \
-             -show_translation \
-             -query $f \
-             -num_threads $IGBLAST_numthreads -out $DATANAME.${g}.igblast_out
-    time_msg "Completed IgBLAST annotation of $f"
-  done
+             -show_translation ${IGBLAST_outfmt:+-outfmt $IGBLAST_outfmt} \
+  | harvestIgBLASToutput $chain $libraryType --workers 1 --pairs_from -
+  igblast_STATUS=("${PIPESTATUS[@]}")
+  if [[ ${igblast_STATUS[0]} -ne 0 ]]; then
+    error "igblastn did not complete the annotation of input.fasta"
+  elif [[ ${igblast_STATUS[1]} -ne 0 ]]; then
+    error "The IgBLAST output was not harvested."
+  fi
+  # the harvester outputs are up to date for IgBLASToutputProcessing
+  touch $DATANAME.igblast.harvested
 
   igblast_ENDTIME=$(date +%s)
   echo "The igblastn step took $[$igblast_ENDTIME - $igblast_STARTTIME] seconds to complete."
@@ -512,48 +663,36 @@ function IgBLASToutputProcessing (){
     return 0
   fi
 
-  for f in input_fasta_split.*; do
-    g=${f#*.}
-    if [[ -f $DATANAME.${g}.igblast_out ]]; then
-      python3 $WDIR/$SCRDIR/igblast-out_harvester.py $DATANAME.${g}.igblast_out $f \
-      >> $DATANAME.igblast.fasta
-      time_msg "Completed transferring annotations from $DATANAME.${g}.igblast_out"
-      rm $f # clean up the split-up fasta files
-    else
-      echo "Error!!! The file $DATANAME.${g}.igblast_out is missing. IgBLAST annotation was not completed."
-    fi
-  done
-
-  # remove improperly truncated sequences and those containing stop codons in the CDR3aa (there may still be stops in the rest of the sequence!!!)
-  if [[ "$libraryType" =~ ^(HINGE|HINGENano)$ ]]; then
-      echo "Sorting out the productively-rearranged sequences for a hinge dataset (expecting truncations) ..."
-      $grep -v "CDR3aa:\w*\*\w*" $DATANAME.igblast.fasta| $grep -A 1 "In-frame\tYes\t[\+-]\t[^\t]*\t?Vtruncated" | $grep -v "\-\-" > $DATANAME.igblast.prod.fasta
-  elif [[ "$libraryType" == variableNano ]]; then
-      echo "Sorting out the productively-rearranged sequences for a variableNano dataset (expecting truncations) ..."
-      $grep -v "CDR3aa:\w*\*\w*" $DATANAME.igblast.fasta| $grep -A 1 "In-frame\tYes\t[\+-]\t[^\t]*\t?Vtruncated" | $grep -v "\-\-" > $DATANAME.igblast.prod.fasta
+  if [[ -f $DATANAME.igblast.harvested ]]; then
+    # harvested alongside the igblastn runs
+    rm $DATANAME.igblast.harvested
   else
-      echo "Sorting out the productively-rearranged sequences..."
-      $grep -v "CDR3aa:\w*\*\w*" $DATANAME.igblast.fasta| $grep -A 1 "Yes\t[\+-]\t[^\t]*\t?Vintact" | $grep -v "\-\-" > $DATANAME.igblast.prod.fasta
-  fi
-
-  echo "Removing the invalid (or unrecognized) sequences..."
-  if [[ "$chain" =~ ^(IgM|IgG)$ ]];  then
-    $grep -v "CDR3aa:0null0" $DATANAME.igblast.prod.fasta | $grep -A 1 "\t\VH\t" | $grep -v "\-\-" > $DATANAME.igblast.prod.scrub.fasta
-  elif [[ "$chain" == IgK ]]
-  then
-    $grep -v "CDR3aa:0null0" $DATANAME.igblast.prod.fasta | $grep -A 1 "\t\VK\t" | $grep -v "\-\-" > $DATANAME.igblast.prod.scrub.fasta
-  elif [[ "$chain" == IgL ]]
-  then
-    $grep -v "CDR3aa:0null0" $DATANAME.igblast.prod.fasta | $grep -A 1 "\t\VL\t" | $grep -v "\-\-" > $DATANAME.igblast.prod.scrub.fasta
+    # a rerun (e.g., with another filter setting) harvests all chunks in one run;
+    #   the query blocks are spread over the workers and the annotated sequences
+    #   are written in the original order. The chunks are removed after
+    #   harvesting, so input.fasta is split again into the same chunks
+    splitIgBLASTinput
+    harvest_pairs=()
+    for f in input_fasta_split.*; do
+      g=${f#*.}
+      if [[ -f $DATANAME.${g}.igblast_out ]]; then
+        harvest_pairs+=("$DATANAME.${g}.igblast_out" "$f")
+      elif [[ -f $DATANAME.${g}.igblast_out.gz ]]; then
+        harvest_pairs+=("$DATANAME.${g}.igblast_out.gz" "$f")
+      else
+        echo "Error!!! The file $DATANAME.${g}.igblast_out is missing. IgBLAST annotation was not completed."
+      fi
+    done
+    if [[ ${#harvest_pairs[@]} -gt 0 ]]; then
+      harvestIgBLASToutput $chain $libraryType --workers ${HARVEST_numworkers:-1} "${harvest_pairs[@]}"
+      time_msg "Completed transferring annotations from $((${#harvest_pairs[@]} / 2)) IgBLAST output file(s)"
+    fi
   fi
+  rm -f input_fasta_split.* # clean up the split-up fasta files
 
-  echo "Generating a clonotype dictionary..."
-  perl $WDIR/$SCRDIR/clonotype_count.pl $DATANAME.igblast.prod.scrub.fasta > $DATANAME.igblast.prod.scrub.clonotype_dict
+  echo "Selecting the clonotypes with 5 or more sequences..."
   $grep -v Vambig $DATANAME.igblast.prod.scrub.clonotype_dict |$grep -v "\w{5}\t\w+\t\d+\t[1234]\t" > $DATANAME.igblast.prod.scrub.5up.clonotype_dict
 
-  echo "Annotating the productively-rearranged sequences with predicted clonotype information..."
-  perl $WDIR/$SCRDIR/clonotype_annotate.pl $DATANAME.igblast.prod.scrub.clonotype_dict $DATANAME.igblast.prod.scrub.fasta > $DATANAME.igblast.prod.scrub.clon.fasta
-
   echo "Counting sequences..."
   $grep -c ">" *.fasta
 
@@ -566,7 +705,7 @@ function IgBLASToutputProcessing (){
   head -2 $DATANAME.igblast.prod.scrub.clonotype_dict| sed "s|^# ||"
   echo "Chimera tagged: " "`$grep -c "\-chimera" $DATANAME.igblast.prod.scrub.clon.fasta`"
 
-  echo "Unrecognized CDR3's in the productively-rearranged set: " "`$grep "CDR3aa:0null0" -c $DATANAME.igblast.prod.fasta`"
+  echo "Unrecognized CDR3's in the productively-rearranged set: " "`$grep '^"null_cdr3",' $DATANAME.igblast.counts.csv | cut -d "," -f2 | tr -d ' '`"
 
   ## accounting
   buildReadAccountingSummary IgBLASTstepAcct
@@ -647,6 +786,12 @@ function hingeProcessingStep (){
 
 }
 
+# function: sum of counters in the run metrics of the consensus step
+# arguments: counter names
+function consensusMetrics (){
+  python3 $WDIR/$SCRDIR/run_metrics.py $WDIR/$OUT_fastxtk/$DATANAME.consensus.metrics.json "$@" | awk '{s=0; for (i=1; i<=NF; i++) s+=$i; print s}'
+}
+
 # function: accounting of reads passing through the steps of the pipeline
 # arguments: accounting step
 function buildReadAccountingSummary (){
@@ -670,16 +815,18 @@ function buildReadAccountingSummary (){
       fi
       ;;
     fastxStepAcct )
+      # the consensus counts come from its run metrics; the clean UMI5RACE set is
+      #   counted after the N clipping (which may drop sequences)
       if [[ "$DATASET_libraryMethod" == UMI5RACE ]]; then
-        echo "\"barcoded\"," "`$grep -v "barcode=unknown" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.bc_annot.fasta| $grep -c "^>"`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
+        echo "\"barcoded\"," "`consensusMetrics reads_in`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
         echo "\"clean\"," "`$grep "^>" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.bc_annot.consensus.noN.fasta | cut -d "=" -f4| awk 'BEGIN{s=0}{s+=$1}END{print s}'`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
       elif [[ "$DATASET_libraryMethod" == UMI5RACENEB ]] && [[ "$DATASET_libraryType" =~ ^(variableNano|HINGE|HINGENano)$ ]]; then
         echo "\"barcoded\"," "`$grep -v "barcode=unknown" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.orient.bc_annot.3prime.fasta| $grep -c "^>"`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
-        echo "\"clean\"," "`$grep "^>" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.orient.bc_annot.3prime.consensus.fasta | cut -d "=" -f4| awk 'BEGIN{s=0}{s+=$1}END{print s}'`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
+        echo "\"clean\"," "`consensusMetrics reads_used singlets`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
 
       elif [[ "$DATASET_libraryMethod" == UMI5RACENEB ]] && [[ "$DATASET_libraryType" == variable ]]; then
-        echo "\"barcoded\"," "`$grep -v "barcode=unknown" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.orient.bc_annot.fasta| $grep -c "^>"`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
-        echo "\"clean\"," "`$grep "^>" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.orient.bc_annot.consensus.fasta | cut -d "=" -f4| awk 'BEGIN{s=0}{s+=$1}END{print s}'`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
+        echo "\"barcoded\"," "`consensusMetrics reads_in`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
+        echo "\"clean\"," "`consensusMetrics reads_used singlets`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
 
       elif [[ "$DATASET_libraryMethod" == UMI5RACEASYM ]]; then
         echo "\"barcoded\"," "`$grep -v "^@.+;barcode=unknown$" $WDIR/$OUT_fastxtk/$DATANAME.trim1.bc_annot.fastq| $grep -c "^@.+;barcode="`" >> $WDIR/$OUTDIR/$DATANAME.accounting.csv
@@ -726,14 +873,14 @@ function buildUniqueAccountingSummary (){
       ;;
     fastxStepAcct )
       if [[ "$DATASET_libraryMethod" == UMI5RACE ]]; then
-        echo "\"barcoded\"," "`$grep -v "barcode=unknown" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.bc_annot.fasta| $grep -c "^>"`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
+        echo "\"barcoded\"," "`consensusMetrics reads_in`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
         echo "\"clean\"," "`$grep -c "^>" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.bc_annot.consensus.noN.fasta`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
       elif [[ "$DATASET_libraryMethod" == UMI5RACENEB ]] && [[ "$DATASET_libraryType" =~ ^(HINGE|HINGENano|variableNano)$ ]]; then
         echo "\"barcoded\"," "`$grep -v "barcode=unknown" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.orient.bc_annot.3prime.fasta| $grep -c "^>"`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
-        echo "\"clean\"," "`$grep -c "^>" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.orient.bc_annot.3prime.consensus.fasta`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
+        echo "\"clean\"," "`consensusMetrics migs_out`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
       elif [[ "$DATASET_libraryMethod" == UMI5RACENEB ]] && [[ "$DATASET_libraryType" == variable ]]; then
-        echo "\"barcoded\"," "`$grep -v "barcode=unknown" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.orient.bc_annot.fasta| $grep -c "^>"`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
-        echo "\"clean\"," "`$grep -c "^>" $WDIR/$OUT_fastxtk/$DATANAME.trimmed.orient.bc_annot.consensus.fasta`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
+        echo "\"barcoded\"," "`consensusMetrics reads_in`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
+        echo "\"clean\"," "`consensusMetrics migs_out`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
       elif [[ "$DATASET_libraryMethod" == UMI5RACEASYM ]]; then
         echo "\"barcoded\"," "`$grep -v "^@.+;barcode=unknown$" $WDIR/$OUT_fastxtk/$DATANAME.trim1.bc_annot.fastq| $grep -c "^@.+;barcode="`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
         echo "\"paired MIGs\"," "`$grep -c "^@.+barcode=" $WDIR/$OUT_fastxtk/$DATANAME.trim1.bc_annot.ordered.cons.interleaved.fastq`" >> $WDIR/$OUTDIR/$DATANAME.uniqaccounting.csv
@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+'''
+quality_profile.py
+  Per-cycle quality profiles of the raw FASTQ files of a run (the quality stage),
+  in place of the dada2 plotQualityProfile: each file is streamed once and the
+  quality scores are counted in a fixed-size NumPy histogram (cycle x Phred
+  score), so that the memory use does not depend on the number of reads. The
+  files are profiled in parallel. With --sample, a fraction of the reads is
+  profiled; the reads are chosen by their number in the file (and the seed),
+  so that the same mates are kept in R1 and R2 and the result does not change
+  from run to run. For each file, writes
+    <outdir>/<file>.quality.tsv  per cycle: reads, mean, quartiles and the
+                                 number of reads of that length
+    <outdir>/<file>.quality.pdf  the score frequencies per cycle, mean (green),
+                                 median and quartiles (orange), and the
+                                 fraction of the reads reaching the cycle (red)
+  Usage:
+    python3 quality_profile.py --outdir 00_output [--sample 0.1] R1.fastq.gz R2.fastq.gz
+'''
+
+import sys
+import argparse
+import os
+import zlib
+from multiprocessing import Pool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import mig_pool
+import stream_io
+
+MAX_CYCLES  = 1024      # longest read profiled
+LEVELS      = 94        # Phred+33 scores 0 ('!') to 93 ('~')
+CHUNK_BYTES = 1 << 21   # bytes of FASTQ handled at a time (bounds the memory use)
+
+
+#-------------------------------------------------------------------------------
+def sampled_reads (numbers, fraction, seed):
+    '''
+    returns the mask of the reads kept in a sample: a read is kept if the hash
+      (SplitMix64) of its number and the seed falls below the fraction
+    1st argument--array of read numbers (0-based, in file order)
+    2nd argument--fraction of the reads kept
+    3rd argument--seed (integer)
+    '''
+    mixed = numbers.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)\
+            + np.uint64((seed * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF)
+    mixed ^= mixed >> np.uint64(30)
+    mixed *= np.uint64(0xBF58476D1CE4E5B9)
+    mixed ^= mixed >> np.uint64(27)
+    mixed *= np.uint64(0x94D049BB133111EB)
+    mixed ^= mixed >> np.uint64(31)
+    return mixed < np.uint64(int(fraction * 2.0 ** 64))
+
+
+class QualityProfile:
+    '''
+    Per-cycle histogram of the quality scores of a FASTQ file, and the
+      distribution of the read lengths; FASTQ text is added in blocks of
+      complete lines (add_lines)
+    '''
+
+    def __init__(self, filename, fraction = 1.0, seed = 0):
+        self.filename = filename
+        self.fraction = fraction
+        self.seed     = seed
+        self.counts   = np.zeros((MAX_CYCLES, LEVELS), dtype=np.int64)
+        self.lengths  = np.zeros(MAX_CYCLES + 1, dtype=np.int64)
+        self.lines    = 0 # lines added so far
+        self.profiled = 0 # reads counted in the histogram
+
+    def add_lines(self, block):
+        '''
+        count the quality lines of a block of complete FASTQ lines
+        1st argument--bytes ending with a line end
+        '''
+        data = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(data == 10)
+        starts = np.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        numbers = np.arange(self.lines, self.lines + len(ends))
+        self.lines += len(ends)
+
+        headers = starts[numbers % 4 == 0]
+        if (data[headers] != ord('@')).any():
+            sys.exit('Error: ' + self.filename + ' is not a FASTQ file (expecting a header'\
+                     + ' line starting with "@" every four lines).')
+        quality = numbers % 4 == 3
+        q_start = starts[quality]
+        q_end = ends[quality]
+        if self.fraction < 1:
+            kept = sampled_reads(numbers[quality] // 4, self.fraction, self.seed)
+            q_start = q_start[kept]
+            q_end = q_end[kept]
+        if not len(q_start):
+            return
+        q_end -= (q_end > q_start) & (data[q_end - 1] == ord('\r'))
+        q_length = q_end - q_start
+        if q_length.max() > MAX_CYCLES:
+            sys.exit('Error: ' + self.filename + ' has reads longer than ' + str(MAX_CYCLES)\
+                     + ' cycles.')
+        self.lengths += np.bincount(q_length, minlength=MAX_CYCLES + 1)
+        self.profiled += len(q_length)
+
+        # the reads of each length are gathered as a (reads x cycles) array of scores;
+        #   empty reads have no cycles and are only counted in self.lengths
+        for length in np.flatnonzero(np.bincount(q_length)[1:]) + 1:
+            scores = data[q_start[q_length == length, None] + np.arange(length)]
+            if scores.min() < 33 or scores.max() >= 33 + LEVELS:
+                sys.exit('Error: ' + self.filename + ' has quality characters outside the'\
+                         + ' Phred+33 range.')
+            codes = scores + (np.arange(length, dtype=np.int32) * LEVELS - 33)
+            self.counts[:length] += np.bincount(codes.ravel(),\
+                                                minlength=length * LEVELS).reshape(length, LEVELS)
+
+    def reads(self):
+        return self.lines // 4
+
+    def cycle_stats(self):
+        '''
+        returns the per-cycle arrays, up to the last cycle with reads: reads,
+          mean score, 1st quartile, median, 3rd quartile, reads of that length
+        '''
+        reads = self.counts.sum(axis=1)
+        cycles = int(np.flatnonzero(reads)[-1]) + 1 if reads.any() else 0
+        counts = self.counts[:cycles]
+        reads = reads[:cycles]
+        mean = (counts * np.arange(LEVELS)).sum(axis=1) / reads
+        cumulative = counts.cumsum(axis=1)
+        quartiles = [np.argmax(cumulative >= share * reads[:, None], axis=1)\
+                     for share in (0.25, 0.5, 0.75)]
+        return [reads, mean] + quartiles + [self.lengths[1:cycles + 1]]
+
+
+#-------------------------------------------------------------------------------
+def read_profile (filename, fraction, seed):
+    '''
+    returns the QualityProfile of a (gzip-compressed) FASTQ file
+    1st argument--filename
+    2nd argument--fraction of the reads profiled
+    3rd argument--seed of the sample
+    '''
+    profile = QualityProfile(filename, fraction, seed)
+    remainder = b''
+    with stream_io.open_input(filename) as handle:
+        while True:
+            chunk = handle.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            cut = chunk.rfind(b'\n') + 1
+            if not cut:
+                remainder += chunk
+                continue
+            profile.add_lines(remainder + chunk[:cut])
+            remainder = chunk[cut:]
+    if remainder:
+        profile.add_lines(remainder + b'\n')
+    if profile.lines % 4:
+        sys.exit('Error: ' + filename + ' ends with an incomplete FASTQ record.')
+    return profile
+
+
+#-------------------------------------------------------------------------------
+def write_table (filename, stats):
+    '''
+    write the per-cycle statistics (see QualityProfile.cycle_stats) as a
+      tab-delimited table
+    '''
+    with open(filename, 'w') as output:
+        output.write('cycle\treads\tmean\tq25\tmedian\tq75\treads_of_length\n')
+        for cycle, (reads, mean, q25, median, q75, of_length) in enumerate(zip(*stats), 1):
+            output.write('\t'.join([str(cycle), str(reads), format(mean, '.2f'), str(q25),\
+                                    str(median), str(q75), str(of_length)]) + '\n')
+
+
+#-------------------------------------------------------------------------------
+def pdf_text (x, y, size, text, align = 0, vertical = False):
+    '''
+    returns the PDF operators of a line of text in Helvetica
+    1st and 2nd arguments--position of the text (points)
+    3rd argument--font size
+    4th argument--text
+    5th argument--0 to start the text at the position, 0.5 to center it, 1 to end it
+    6th argument--True to write it upwards
+    '''
+    shift = align * 0.55 * size * len(text) # approximate width of Helvetica text
+    text = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    if vertical:
+        matrix = '0 1 -1 0 ' + format(x, '.1f') + ' ' + format(y - shift, '.1f')
+    else:
+        matrix = '1 0 0 1 ' + format(x - shift, '.1f') + ' ' + format(y, '.1f')
+    return 'BT /F1 ' + str(size) + ' Tf ' + matrix + ' Tm (' + text + ') Tj ET\n'
+
+
+#-------------------------------------------------------------------------------
+def write_plot (filename, profile, stats):
+    '''
+    write the quality profile plot of a file as a one-page PDF
+    1st argument--PDF filename
+    2nd argument--QualityProfile
+    3rd argument--per-cycle statistics (see QualityProfile.cycle_stats)
+    '''
+    left, bottom, width, height = 60.0, 60.0, 390.0, 380.0
+    reads, mean, q25, median, q75 = stats[:5]
+    cycles = max(len(reads), 1)
+    top_score = max(41, int(np.flatnonzero(profile.counts[:len(reads)].any(axis=0))[-1])\
+                    if len(reads) else 0)
+    top_score = (top_score // 10 + 1) * 10
+    x_of = lambda cycle: left + (cycle - 1) / cycles * width
+    y_of = lambda score: bottom + score / top_score * height
+    operators = ['q ' + ' '.join(format(value, '.1f') for value in (left, bottom, width, height))\
+                 + ' re W n\n']
+
+    # score frequencies at each cycle, darker for the more frequent scores
+    tile_width, tile_height = width / cycles, height / top_score
+    for cycle in range(len(reads)):
+        for score in np.flatnonzero(profile.counts[cycle]):
+            shade = 0.96 * (1 - profile.counts[cycle, score] / reads[cycle])
+            operators.append(format(shade, '.3f') + ' g ' + format(x_of(cycle + 0.5), '.2f') + ' '\
+                             + format(y_of(score - 0.5), '.2f') + ' ' + format(tile_width, '.2f')\
+                             + ' ' + format(tile_height, '.2f') + ' re f\n')
+
+    # lines: mean, median and quartiles, fraction of the reads reaching each cycle
+    for values, color, dash in ((mean, '0.40 0.76 0.65', ''), (median, '0.99 0.55 0.38', ''),\
+                                (q25, '0.99 0.55 0.38', '[3 2] 0 d '),\
+                                (q75, '0.99 0.55 0.38', '[3 2] 0 d '),\
+                                (reads / max(profile.profiled, 1) * top_score, '1 0 0', '')):
+        if not len(values):
+            continue
+        points = ['{:.2f} {:.2f}'.format(x_of(cycle + 1), y_of(value))\
+                  for cycle, value in enumerate(values)]
+        operators.append(color + ' RG ' + dash + '1 w ' + points[0] + ' m '\
+                         + ' l '.join(points[1:] + ['']) + 'S [] 0 d\n')
+    operators.append('Q 0 g 0 G 0.5 w ' + ' '.join(format(value, '.1f')\
+                     for value in (left, bottom, width, height)) + ' re S\n')
+
+    # axes: cycles, quality scores (left), percent of the reads (right)
+    step = next(step for step in (1, 2, 5, 10, 25, 50, 100, 250, 500) if cycles / step <= 10)
+    for cycle in range(step, cycles + 1, step):
+        operators.append('{0:.1f} {1:.1f} m {0:.1f} {2:.1f} l S\n'.format(x_of(cycle), bottom,\
+                                                                         bottom - 4))
+        operators.append(pdf_text(x_of(cycle), bottom - 14, 9, str(cycle), 0.5))
+    for score in range(0, top_score + 1, 10):
+        operators.append('{0:.1f} {1:.1f} m {2:.1f} {1:.1f} l S\n'.format(left, y_of(score), left - 4))
+        operators.append(pdf_text(left - 7, y_of(score) - 3, 9, str(score), 1))
+    for percent in range(0, 101, 25):
+        y = y_of(percent / 100 * top_score)
+        operators.append('{0:.1f} {1:.1f} m {2:.1f} {1:.1f} l S\n'.format(left + width, y,\
+                                                                         left + width + 4))
+        operators.append(pdf_text(left + width + 7, y - 3, 9, str(percent)))
+    operators.append(pdf_text(left + width / 2, bottom - 32, 10, 'Cycle', 0.5))
+    operators.append(pdf_text(left - 30, bottom + height / 2, 10, 'Quality score', 0.5, True))
+    operators.append('1 0 0 rg ' + pdf_text(left + width + 36, bottom + height / 2, 10,\
+                                           'Reads reaching the cycle (%)', 0.5, True) + '0 g ')
+    operators.append(pdf_text(left, bottom + height + 30, 11, os.path.basename(profile.filename)))
+    operators.append(pdf_text(left, bottom + height + 14, 9, 'Reads: ' + str(profile.reads())\
+                              + ('' if profile.profiled == profile.reads() else ' (profiled: '\
+                                 + str(profile.profiled) + ')')))
+
+    content = zlib.compress(''.join(operators).encode('latin-1'))
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',\
+               b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',\
+               b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 504 504] /Resources'\
+               + b' << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>',\
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',\
+               b'<< /Length ' + str(len(content)).encode() + b' /Filter /FlateDecode >>\nstream\n'\
+               + content + b'\nendstream']
+    document = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(document))
+        document += str(number).encode() + b' 0 obj\n' + body + b'\nendobj\n'
+    xref = len(document)
+    document += b'xref\n0 ' + str(len(objects) + 1).encode() + b'\n0000000000 65535 f \n'\
+                + b''.join(format(offset, '010d').encode() + b' 00000 n \n' for offset in offsets)\
+                + b'trailer\n<< /Size ' + str(len(objects) + 1).encode() + b' /Root 1 0 R >>\n'\
+                + b'startxref\n' + str(xref).encode() + b'\n%%EOF\n'
+    with open(filename, 'wb') as output:
+        output.write(document)
+
+
+#-------------------------------------------------------------------------------
+def profile_file (filename, outdir, fraction, seed):
+    '''
+    profile a FASTQ file and write its table and plot; returns the summary line
+    '''
+    profile = read_profile(filename, fraction, seed)
+    stats = profile.cycle_stats()
+    prefix = os.path.join(outdir, os.path.basename(filename))
+    write_table(prefix + '.quality.tsv', stats)
+    write_plot(prefix + '.quality.pdf', profile, stats)
+
+    reads, mean = stats[:2]
+    summary = os.path.basename(filename) + ': '
+    if not profile.reads():
+        return summary + 'no reads.'
+    summary += str(profile.reads()) + ' reads (' + str(profile.profiled) + ' profiled)'
+    lengths = np.flatnonzero(profile.lengths)
+    if not len(lengths):
+        return summary + '.'
+    summary += ' of ' + str(lengths[0]) + '-' + str(lengths[-1]) + ' cycles'
+    if not len(reads):
+        return summary + ', no quality scores.'
+    return summary + ', mean quality ' + format((mean * reads).sum() / reads.sum(), '.1f') + '.'
+
+
+#-------------------------------------------------------------------------------
+#### main section
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the per-cycle quality profiles'\
+        + ' (table and plot) of FASTQ files.')
+    parser.add_argument('fastq', nargs='+', type=str, help='FASTQ files (may be gzipped)')
+    parser.add_argument('--outdir', nargs='?', type=str, default='.', \
+        help='Output directory (default is the current directory)')
+    parser.add_argument('--sample', nargs='?', type=float, default=1.0, \
+        help='Fraction of the reads profiled (default is 1, every read)')
+    parser.add_argument('--seed', nargs='?', type=int, default=0, \
+        help='Seed of the sample (the same reads are chosen for the same seed)')
+    parser.add_argument('--workers', nargs='?', type=int, default=0, \
+        help='Files profiled in parallel (default is one process per file)')
+    args = parser.parse_args()
+
+    if np is None:
+        sys.exit('Error: quality_profile.py requires NumPy.')
+    if not 0 < args.sample <= 1:
+        sys.exit('Error: the sample fraction must be within (0, 1].')
+    for filename in args.fastq:
+        if not os.path.exists(filename):
+            sys.exit('File ' + filename + ' was not found!')
+
+    workers = min(args.workers or len(args.fastq), len(args.fastq))
+    jobs = [(profile_file, filename, args.outdir, args.sample, args.seed) for filename in args.fastq]
+    try:
+        if workers > 1:
+            with Pool(workers) as pool:
+                summaries = pool.starmap(mig_pool.run_batch, jobs)
+        else:
+            summaries = [mig_pool.run_batch(*job) for job in jobs]
+    except mig_pool.BatchExit as error:
+        sys.exit(error.args[0])
+    for summary in summaries:
+        print(summary)
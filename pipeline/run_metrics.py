@@ -0,0 +1,148 @@
+'''
+run_metrics.py
+  Structured run metrics for the Python pipeline stages (--metrics FILE):
+  wall-clock and CPU time per phase, domain counters (MIGs, reads, queries),
+  records per second and peak RSS, written as one JSON object per run. Work
+  done in worker processes is timed there and merged into the main record, so
+  the phase times are sums over the processes. Run as a script, it prints
+  counters of a metrics file for the shell stages, e.g.:
+    python3 run_metrics.py sample.consensus.metrics.json migs_out
+'''
+
+import sys
+import json
+import resource
+import time
+
+
+class RunMetrics:
+    '''
+    phase times ([wall, cpu] seconds per phase) and counters of a run or of a
+      worker batch
+    '''
+
+    def __init__(self):
+        self.phases   = {}
+        self.counters = {}
+        self.start    = self.clock()
+
+    @staticmethod
+    def clock():
+        '''
+        returns the (wall, cpu) time pair for add_time
+        '''
+        return time.perf_counter(), time.process_time()
+
+    def add_time(self, phase, since):
+        '''
+        add the time passed since a clock() reading to a phase; returns the
+          current clock() reading, so that consecutive phases can be chained
+        1st argument--phase name
+        2nd argument--clock() reading at the start of the phase
+        '''
+        now = self.clock()
+        totals = self.phases.setdefault(phase, [0.0, 0.0])
+        totals[0] += now[0] - since[0]
+        totals[1] += now[1] - since[1]
+        return now
+
+    def timed(self, phase, iterable):
+        '''
+        yields the items of an iterable, adding the time spent producing them
+          to a phase (e.g., reading and parsing the input)
+        '''
+        iterator = iter(iterable)
+        while True:
+            clock = self.clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, clock)
+                return
+            self.add_time(phase, clock)
+            yield item
+
+    def count(self, counter, value=1):
+        '''
+        add to a counter
+        '''
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def state(self):
+        '''
+        returns the phases and counters (e.g., to be sent back from a worker)
+        '''
+        return {'phases' : self.phases, 'counters' : self.counters}
+
+    def merge(self, state):
+        '''
+        add the phases and counters of another RunMetrics state
+        '''
+        for phase, (wall, cpu) in state['phases'].items():
+            totals = self.phases.setdefault(phase, [0.0, 0.0])
+            totals[0] += wall
+            totals[1] += cpu
+        for counter, value in state['counters'].items():
+            self.count(counter, value)
+
+    def write(self, filename, script, inputs, records):
+        '''
+        write the metrics of the run as JSON
+        1st argument--output filename
+        2nd argument--name of the pipeline script
+        3rd argument--array of input filenames
+        4th argument--name of the counter of processed records (for the rate)
+        '''
+        wall = time.perf_counter() - self.start[0]
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        report = {
+            'script'                : script,
+            'inputs'                : inputs,
+            'wall_seconds'          : round(wall, 3),
+            'cpu_seconds'           : round(self_usage.ru_utime + self_usage.ru_stime\
+                                            + child_usage.ru_utime + child_usage.ru_stime, 3),
+            'phases'                : {phase : {'wall_seconds' : round(wall_time, 3),\
+                                                'cpu_seconds' : round(cpu_time, 3)}\
+                                       for phase, (wall_time, cpu_time) in self.phases.items()},
+            'records'               : self.counters.get(records, 0),
+            'records_per_second'    : round(self.counters.get(records, 0) / wall, 1)\
+                                          if wall > 0 else None,
+            'peak_rss_kib'          : self_usage.ru_maxrss,
+            'peak_rss_children_kib' : child_usage.ru_maxrss,
+            'counters'              : self.counters,
+        }
+        with open(filename, 'w') as output:
+            json.dump(report, output, indent=2)
+            output.write('\n')
+
+
+class MetricsOutput:
+    '''
+    output handle for the results of batch functions that report metrics:
+      writes the text of each (text, RunMetrics state) pair and merges the
+      state into the metrics of the run
+    '''
+
+    def __init__(self, output, metrics):
+        self.output  = output
+        self.metrics = metrics
+
+    def write(self, batch_result):
+        text, state = batch_result
+        clock = self.metrics.clock()
+        self.output.write(text)
+        self.metrics.add_time('output', clock)
+        self.metrics.merge(state)
+
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit('Usage: run_metrics.py metrics.json counter [counter ...]')
+    try:
+        with open(sys.argv[1]) as handle:
+            counters = json.load(handle)['counters']
+    except (OSError, ValueError, KeyError):
+        sys.exit('Error: cannot read the metrics in ' + sys.argv[1] + '.')
+    print(' '.join(str(counters.get(counter, 0)) for counter in sys.argv[2:]))
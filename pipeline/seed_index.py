@@ -0,0 +1,88 @@
+'''
+seed_index.py
+  Packed 2-bit seed index for best-seed selection in consensus_generator.
+  A read is packed once into an integer (base i occupies bits 2i and 2i+1;
+  A=0, C=1, G=2, T=3) together with a mask that marks the N positions (N is
+  stored as 0 in the base bits and 3 in the mask lane). All seeds of the read
+  are then cut out of the packed value with shifts, and the mismatches between
+  two seeds are counted with XOR/popcount instead of character comparisons.
+  A packed seed is the (bits, nmask, length) tuple; equal tuples mean equal
+  seed strings, so they can be used directly as dictionary keys.
+'''
+
+PACK_BITS  = str.maketrans('ACGTN', '01230')
+PACK_NMASK = str.maketrans('ACGTN', '00003')
+
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else: # Python < 3.10
+    def popcount (value):
+        '''
+        returns the number of set bits in a non-negative integer
+        '''
+        return bin(value).count('1')
+
+_lane_masks = {}
+
+#-------------------------------------------------------------------------------
+def lane_mask (length):
+    '''
+    returns an integer with the low bit of each of the first `length` 2-bit lanes set
+    1st argument--number of lanes (bases)
+    '''
+    if length not in _lane_masks:
+        _lane_masks[length] = int('01' * length, 2) if length else 0
+    return _lane_masks[length]
+
+
+#-------------------------------------------------------------------------------
+def pack_seq (seq):
+    '''
+    returns the (bits, nmask) pair for the 2-bit packed sequence
+    1st argument--nucleotide sequence (ACGTN)
+    '''
+    if not seq:
+        return 0, 0
+    reverse_seq = seq[::-1] # the first base ends up in the lowest bits
+    return int(reverse_seq.translate(PACK_BITS), 4),\
+        int(reverse_seq.translate(PACK_NMASK), 4)
+
+
+#-------------------------------------------------------------------------------
+def packed_seeds (seq, seed_bounds):
+    '''
+    returns array of packed seeds for one read, computed from a single packing
+    1st argument--nucleotide sequence
+    2nd argument--array of (start, end) seed coordinates; these follow the
+      slicing rules of seq[start:end], including negative starts
+    '''
+    seq_len = len(seq)
+    windows = []
+    for start, end in seed_bounds:
+        if start < 0 or end > seq_len:
+            start, end, _ = slice(start, end).indices(seq_len)
+        windows.append((start, end if end > start else start))
+
+    # only the stretch of the read covered by the seeds is packed
+    region_start = min(window[0] for window in windows)
+    bits, nmask = pack_seq(seq[region_start:max(window[1] for window in windows)])
+
+    seeds = []
+    for start, end in windows:
+        shift = 2 * (start - region_start)
+        window_mask = (1 << (2 * (end - start))) - 1
+        seeds.append(((bits >> shift) & window_mask, (nmask >> shift) & window_mask,\
+                      end - start))
+    return seeds
+
+
+#-------------------------------------------------------------------------------
+def seed_mismatches (seed, ref_seed):
+    '''
+    returns the number of mismatching positions between two packed seeds;
+      as with a zip-based comparison, only the length of the shorter seed is compared
+    1st argument--packed seed
+    2nd argument--packed reference seed
+    '''
+    diff = (seed[0] ^ ref_seed[0]) | (seed[1] ^ ref_seed[1])
+    return popcount((diff | (diff >> 1)) & lane_mask(min(seed[2], ref_seed[2])))
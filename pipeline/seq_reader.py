@@ -0,0 +1,285 @@
+'''
+seq_reader.py
+  Shared FASTA/FASTQ record reader for the Python pipeline stages.
+  Input is read in large binary chunks, decoded once per chunk and split into
+  records without running regular expressions on every line. The header fields
+  written by the barcode scripts (size=, element=, barcode=) are only parsed
+  when they are asked for, and read_migs() turns a record stream into whole-MIG
+  groups for consensus_generator (or, above a size cap, into MIG streams for
+  consensus_stream.py).
+'''
+
+import re
+import sys
+
+import stream_io
+
+CHUNK_SIZE = 1 << 22 # 4 MiB of input per read() call
+
+ELEMENT_FIELD = re.compile(r'[:;]element=\d+')
+
+
+class SeqRecord:
+    '''
+    FASTA/FASTQ record; header excludes the leading '>' or '@' and qual is None
+      for FASTA input
+    '''
+    __slots__ = ('header', 'seq', 'qual', '_size_element')
+
+    def __init__(self, header, seq, qual=None):
+        self.header = header
+        self.seq = seq
+        self.qual = qual
+        self._size_element = None
+
+    def _parse_size_element(self):
+        # equivalent to re.search(r'size=(\d+)[:;]element=(\d+)', header)
+        header = self.header
+        pos = header.find('size=')
+        while pos >= 0:
+            start = end = pos + 5
+            while end < len(header) and header[end].isdigit():
+                end += 1
+            if end > start and header.startswith('element=', end + 1)\
+                    and header[end] in ':;':
+                elem_start = elem_end = end + 9
+                while elem_end < len(header) and header[elem_end].isdigit():
+                    elem_end += 1
+                if elem_end > elem_start:
+                    return int(header[start:end]), int(header[elem_start:elem_end])
+            pos = header.find('size=', pos + 1)
+        return None, None
+
+    @property
+    def size(self):
+        '''
+        MIG size from the "size=" field (None if the field is missing)
+        '''
+        if self._size_element is None:
+            self._size_element = self._parse_size_element()
+        return self._size_element[0]
+
+    @property
+    def element(self):
+        '''
+        element number within the MIG from the "element=" field (None if missing)
+        '''
+        if self._size_element is None:
+            self._size_element = self._parse_size_element()
+        return self._size_element[1]
+
+    @property
+    def barcode(self):
+        '''
+        UMI barcode from the "barcode=" field (None if missing)
+        '''
+        pos = self.header.find('barcode=')
+        if pos < 0:
+            return None
+        end = self.header.find(';', pos)
+        return self.header[pos + 8:] if end < 0 else self.header[pos + 8:end]
+
+    @property
+    def valid(self):
+        '''
+        True if the record is labeled as valid (fastq_asym_barcode_order.pl)
+        '''
+        return ';valid;' in self.header
+
+    def cluster_id(self, prefix=''):
+        '''
+        returns the MIG identifier: the header without the element field
+        1st argument--leading string to drop from the header (e.g., 'MIG')
+        '''
+        header = self.header
+        if prefix and header.startswith(prefix):
+            header = header[len(prefix):]
+        return ELEMENT_FIELD.sub('', header)
+
+
+class StreamedMig:
+    '''
+    MIG too large to be held as an array of sequences: len() gives the MIG size,
+      and iterating over it yields the sequences as they are read
+    '''
+    __slots__ = ('size', 'seqs')
+
+    def __init__(self, size, seqs):
+        self.size = size
+        self.seqs = seqs  # function returning an iterator over the sequences
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return self.seqs()
+
+
+#-------------------------------------------------------------------------------
+def read_line_chunks (handle, chunk_size = CHUNK_SIZE):
+    '''
+    yields arrays of complete lines (without the line ends) read from a binary handle
+    1st argument--binary file handle
+    2nd argument--number of bytes per read() call
+    '''
+    remainder = b''
+    while True:
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            break
+        cut = chunk.rfind(b'\n') + 1
+        if not cut:
+            remainder += chunk
+            continue
+        lines = (remainder + chunk[:cut]).decode('utf8').split('\n')
+        lines.pop() # the empty string after the last line end
+        remainder = chunk[cut:]
+        yield lines
+    if remainder:
+        yield [remainder.decode('utf8')]
+
+
+#-------------------------------------------------------------------------------
+def parse_fasta (line_chunks, filename):
+    '''
+    yields SeqRecord objects from FASTA lines (sequences may span several lines)
+    1st argument--iterable of line arrays (see read_line_chunks)
+    2nd argument--filename for error messages
+    '''
+    header = None
+    seq_lines = []
+    for lines in line_chunks:
+        for line in lines:
+            if line[:1] == '>':
+                if header is not None:
+                    yield SeqRecord(header, ''.join(seq_lines))
+                header = line[1:].rstrip()
+                seq_lines = []
+            elif header is not None:
+                line = line.rstrip()
+                if line:
+                    seq_lines.append(line)
+            elif line.strip():
+                sys.exit('Error: invalid FASTA format in ' + filename + ' at:\n' + line)
+    if header is not None:
+        yield SeqRecord(header, ''.join(seq_lines))
+
+
+#-------------------------------------------------------------------------------
+def parse_fastq (line_chunks, filename):
+    '''
+    yields SeqRecord objects from 4-line FASTQ records
+    1st argument--iterable of line arrays (see read_line_chunks)
+    2nd argument--filename for error messages
+    '''
+    pending = []
+    for lines in line_chunks:
+        if pending:
+            lines = pending + lines
+        complete = len(lines) - len(lines) % 4
+        for ind in range(0, complete, 4):
+            header = lines[ind].rstrip()
+            seq = lines[ind + 1].rstrip()
+            qual = lines[ind + 3].rstrip()
+            if not lines[ind + 2].startswith('+'):
+                sys.exit('Error: invalid FASTQ format in ' + filename + ' at:\n' + header)
+            # sanity check: each base should have a quality call
+            if len(seq) != len(qual):
+                sys.exit('!!!Error: invalid FASTQ format at \n' + header)
+            yield SeqRecord(header[1:], seq, qual)
+        pending = lines[complete:]
+
+    if any(line.strip() for line in pending):
+        sys.exit('Error: incomplete FASTQ record at the end of ' + filename + ':\n'\
+                 + pending[0].rstrip())
+
+
+#-------------------------------------------------------------------------------
+def read_records (filename, chunk_size = CHUNK_SIZE):
+    '''
+    yields SeqRecord objects from a FASTA or FASTQ file, plain or gzipped; the
+      format is determined from the first character of the data ('>' or '@'),
+      so FASTQ input is accepted wherever FASTA is expected
+    1st argument--filename
+    2nd argument--number of bytes per read() call
+    '''
+    with stream_io.open_input(filename) as handle:
+        line_chunks = read_line_chunks(handle, chunk_size)
+        first_lines = next(line_chunks, [])
+        first_char = next((line.lstrip()[:1] for line in first_lines if line.strip()), '')
+
+        def all_chunks():
+            yield first_lines
+            yield from line_chunks
+
+        if first_char == '@':
+            yield from parse_fastq(all_chunks(), filename)
+        elif first_char in ('>', ''):
+            yield from parse_fasta(all_chunks(), filename)
+        else:
+            sys.exit('Error: ' + filename + ' is neither in FASTA nor in FASTQ format.')
+
+
+#-------------------------------------------------------------------------------
+def read_migs (records, keep = None, id_prefix = '', max_seqs = 0):
+    '''
+    yields (cluster ID, array of sequences) for each MIG in the record stream;
+      MIGs are delimited by the size=/element= fields (the first record of a
+      MIG has element equal to size), and singlets are yielded as one-sequence MIGs
+    1st argument--iterable of SeqRecord objects (e.g., from read_records)
+    2nd argument--function selecting the records to use (default: all)
+    3rd argument--leading string to drop from the cluster ID (e.g., 'MIG')
+    4th argument--MIGs of more sequences are yielded as StreamedMig, to be
+      iterated over once before the next MIG is asked for (default: 0, no limit)
+    '''
+    cluster_seqs = []
+    cluster_id = None
+    counter = 0
+    records = iter(records)
+
+    for record in records:
+        if keep is not None and not keep(record):
+            continue
+        cluster_size = record.size
+        if cluster_size is None:
+            continue
+
+        # start of a new cluster; initialize
+        if cluster_size == record.element:
+            counter = cluster_size
+            cluster_id = record.cluster_id(id_prefix)
+            if max_seqs and cluster_size > max_seqs:
+                stream = _stream_cluster(record.seq, records, keep, cluster_size)
+                yield cluster_id, StreamedMig(cluster_size, lambda stream=stream: stream)
+                for _ in stream: # skip whatever was not used
+                    pass
+                counter = 0
+                continue
+
+        if cluster_size >= 2:
+            cluster_seqs.append(record.seq)
+            counter -= 1
+        else: # singlets are handed over as they are
+            yield cluster_id, [record.seq]
+
+        # at the end of cluster: hand over the collected sequences
+        if counter == 0:
+            yield cluster_id, cluster_seqs
+            cluster_seqs = [] # clear the collection when done
+
+
+#-------------------------------------------------------------------------------
+def _stream_cluster (first_seq, records, keep, cluster_size):
+    '''
+    yields the sequences of a MIG from its first sequence on (see read_migs)
+    '''
+    yield first_seq
+    counter = cluster_size - 1
+    while counter > 0:
+        record = next(records, None)
+        if record is None:
+            return
+        if (keep is not None and not keep(record)) or record.size is None:
+            continue
+        counter -= 1
+        yield record.seq
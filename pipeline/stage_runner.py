@@ -0,0 +1,330 @@
+'''
+stage_runner.py
+  Pipeline runner with a content-addressed stage cache. Each stage of
+  ngs-ig_process.sh is fingerprinted by the content of the raw input FASTQ
+  files, the dataset and environment values it depends on, the source of its
+  shell functions and scripts, and the fingerprints of the stages it follows;
+  a stage whose fingerprint matches the one recorded at its last completion,
+  with the recorded outputs still in place, is skipped. An igblastn loop that
+  was interrupted is resumed at the first input_fasta_split.* chunk without
+  IgBLAST output. The stages themselves are run by
+    bash scripts/ngs-ig_process.sh stage <name>
+  and the stage records are kept in 00_output/stage_cache. With --topup (a
+  library topped up with more reads), the consensus, igblastn and harvesting
+  steps reuse the results of the previous run kept in TOPUP_STATE (see
+  topup_state.py).
+'''
+
+import sys
+import argparse
+import collections
+import glob
+import hashlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+
+SCRDIR     = os.path.dirname(os.path.abspath(__file__))
+WDIR       = os.path.dirname(SCRDIR)
+CACHE_DIR  = os.path.join(WDIR, '00_output', 'stage_cache')
+RAW_INPUTS = ('input/*.fastq.gz',)
+TOPUP_STATE = os.path.join(WDIR, '00_output', 'topup_state.sqlite')
+TOPUP_STAGES = ('fastx', 'igblast') # stages given TOPUP_STATE
+
+ACCOUNTING = ('buildReadAccountingSummary', 'buildUniqueAccountingSummary', 'consensusMetrics')
+
+# name -- stage name (see runStage in ngs-ig_process_functions.sh)
+# after -- stages whose outputs are read
+# params -- dataset and environment values (see runStage params)
+# functions -- shell functions of ngs-ig_process_functions.sh run by the stage
+# scripts -- scripts run by the stage (glob patterns in the scripts directory)
+# inputs -- raw input files (glob patterns in the working directory)
+# outputs -- output files (glob patterns in the working directory, with {NAME} params)
+# applies -- function of the params that is False for the stages not run on the dataset
+Stage = collections.namedtuple('Stage', 'name after params functions scripts inputs outputs applies',\
+                               defaults=(None,))
+
+STAGES = (
+    Stage('adapters', (),\
+          ('DATASET_species', 'DATASET_chain', 'DATASET_libraryMethod', 'DATASET_primer',\
+           'DATASET_libraryType'),\
+          ('selectAdaptors',), ('LabSpecific.sh', 'adapters/*.conf', 'adapters/primers/*'), (),\
+          ('scripts/adapter5.conf', 'scripts/adapter3.conf')),
+    Stage('quality', (), ('DATA1', 'DATA2', 'QUALITY_sample'),\
+          ('plotRunQuality',) + ACCOUNTING,\
+          ('quality_profile.py', 'mig_pool.py', 'seq_reader.py', 'stream_io.py'), RAW_INPUTS,\
+          ('00_output/{DATA1}.quality.pdf', '00_output/{DATA2}.quality.pdf',\
+           '00_output/{DATA1}.quality.tsv', '00_output/{DATA2}.quality.tsv')),
+    Stage('flash', (),\
+          ('DATA1', 'DATA2', 'DATASET_libraryMethod', 'DATASET_libraryType', 'FLASH_minoverlap',\
+           'FLASH_maxoverlap', 'FLASH_mismatch_density', 'READ_stitch'),\
+          ('FLASHstep',) + ACCOUNTING, ('fastq_stitch.pl',), RAW_INPUTS,\
+          ('01_flash_out/out.extendedFrags.fastq.gz',)),
+    Stage('cutadapt', ('adapters', 'flash'),\
+          ('DATA1', 'DATA2', 'DATANAME', 'DATASET_libraryMethod', 'DATASET_libraryType',\
+           'MINLENGTH', 'MAXLENGTH'),\
+          ('cutadaptStep',) + ACCOUNTING, (), RAW_INPUTS,\
+          ('02_cutadapt_out/{DATANAME}.trim1.fastq.gz', '02_cutadapt_out/{DATANAME}.trim2.fastq.gz')),
+    Stage('fastx', ('cutadapt',),\
+          ('DATANAME', 'DATASET_libraryMethod', 'DATASET_primer', 'DATASET_libraryType',\
+           'FLASH_minoverlap', 'FLASH_maxoverlap', 'FLASH_mismatch_density', 'UMIbarcode',\
+           'UMIdistance', 'CONSENSUS_maxreads'),\
+          ('fastxStep', 'asymmetricSequencingExtension', 'pythonJob') + ACCOUNTING,\
+          ('fasta_barcode_consensus.py', 'fastq_barcode_consensus.py', 'consensus_pfm.py',\
+           'consensus_stream.py', 'mig_pool.py', 'run_metrics.py', 'seed_index.py',\
+           'seq_reader.py', 'stream_io.py', 'topup_state.py', 'umi_grouper.py',\
+           'fasta_barcode_count.pl', 'fastq_asym_barcode_order.pl',\
+           'fastq_asym_barcode_transfer.pl', 'fastx_asym_orientation_fix.pl'),\
+          (), ('04_igblast_out/input.fasta',)),
+    Stage('igblast', ('fastx',),\
+          ('DATANAME', 'DATASET_species', 'DATASET_libraryMethod', 'DATASET_libraryType',\
+           'IGDATA', 'IGBLAST_outfmt'),\
+          ('IgBLASTstep', 'splitIgBLASTinput'),\
+          ('igblast_scheduler.py', 'seq_reader.py', 'topup_state.py'), (),\
+          ('04_igblast_out/{DATANAME}.*.igblast_out',)),
+    Stage('harvest', ('fastx', 'igblast'),\
+          ('DATANAME', 'DATASET_chain', 'DATASET_primer', 'DATASET_libraryMethod',\
+           'DATASET_libraryType'),\
+          ('IgBLASToutputProcessing', 'harvestIgBLASToutput', 'splitIgBLASTinput', 'pythonJob')\
+          + ACCOUNTING,\
+          ('igblast-out_harvester.py', 'igblast_scheduler.py', 'annotation_table.py',\
+           'clonotypes.py', 'mig_pool.py', 'run_metrics.py', 'seq_reader.py', 'stream_io.py',\
+           'topup_state.py', 'translator.py'), (),\
+          ('04_igblast_out/{DATANAME}.igblast.prod.scrub.clon.fasta',)),
+    Stage('hinge', ('harvest',), ('DATANAME', 'DATASET_species', 'BLAST_DATA'),\
+          ('hingeProcessingStep',), ('hinge_blast_out_harvester.pl', 'subclass_subset.pl'), (),\
+          ('04_igblast_out/{DATANAME}.igblast.prod.scrub.clon.subclass.subset.CDR3aa_dict.fasta',),\
+          lambda params: params['DATASET_libraryType'] in ('HINGE', 'HINGENano')),
+    Stage('postprocess', ('harvest', 'hinge'), ('DATANAME', 'DATASET_libraryMethod',\
+          'DATASET_libraryType'), (), ('postprocess/*',), (), ()),
+)
+STAGE_NAMES = [stage.name for stage in STAGES]
+
+
+#-------------------------------------------------------------------------------
+def file_digest (filename, digests):
+    '''
+    returns the SHA-256 digest of the content of a file; the digests are kept
+      by file size and modification time, so that unchanged files are hashed once
+    1st argument--filename
+    2nd argument--dictionary of the known digests (filename: [size, mtime, digest])
+    '''
+    info = os.stat(filename)
+    known = digests.get(filename)
+    if known is not None and known[:2] == [info.st_size, info.st_mtime_ns]:
+        return known[2]
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(block)
+    digests[filename] = [info.st_size, info.st_mtime_ns, digest.hexdigest()]
+    return digests[filename][2]
+
+
+#-------------------------------------------------------------------------------
+def function_source (text, name):
+    '''
+    returns the source of a shell function (the function is part of the
+      version of the stage that runs it)
+    1st argument--text of ngs-ig_process_functions.sh
+    2nd argument--function name
+    '''
+    match = re.search(r'^function ' + name + r' \(\s*\)\s*\{.*?^\}', text, re.M | re.S)
+    if match is None:
+        sys.exit('Error: function ' + name + ' was not found in ngs-ig_process_functions.sh.')
+    return match.group(0)
+
+
+#-------------------------------------------------------------------------------
+def stage_key (stage, params, keys, digests, functions_text):
+    '''
+    returns the fingerprint of a stage
+    1st argument--Stage
+    2nd argument--dictionary of the dataset and environment values
+    3rd argument--dictionary of the fingerprints of the stages run before
+    4th argument--dictionary of the known file digests (see file_digest)
+    5th argument--text of ngs-ig_process_functions.sh
+    '''
+    def digests_of (directory, patterns):
+        return {os.path.relpath(filename, directory) : file_digest(filename, digests)\
+                for pattern in patterns\
+                for filename in sorted(glob.glob(os.path.join(directory, pattern)))\
+                if os.path.isfile(filename)}
+
+    fingerprint = {
+        'stage'     : stage.name,
+        'after'     : {name : keys.get(name) for name in stage.after},
+        'params'    : {name : params.get(name, '') for name in stage.params},
+        'functions' : {name : function_source(functions_text, name) for name in stage.functions},
+        'scripts'   : digests_of(SCRDIR, stage.scripts),
+        'inputs'    : digests_of(WDIR, stage.inputs),
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf8')).hexdigest()
+
+
+#-------------------------------------------------------------------------------
+def stage_outputs (stage, params):
+    '''
+    returns the array of output files of a stage (relative to the working
+      directory; the files compressed by compressIntermediates are listed
+      without the ".gz"), or None if one of the outputs is missing
+    1st argument--Stage
+    2nd argument--dictionary of the dataset and environment values
+    '''
+    outputs = []
+    for pattern in stage.outputs:
+        pattern = os.path.join(WDIR, pattern.format(**params))
+        found = set(glob.glob(pattern)) | {filename[:-3] for filename in glob.glob(pattern + '.gz')}
+        if not found:
+            return None
+        outputs.extend(os.path.relpath(filename, WDIR) for filename in sorted(found))
+    return outputs
+
+
+#-------------------------------------------------------------------------------
+def outputs_present (outputs):
+    '''
+    returns True if the recorded outputs of a stage (or their compressed
+      versions) are all in place
+    '''
+    return all(os.path.exists(os.path.join(WDIR, filename))\
+               or os.path.exists(os.path.join(WDIR, filename + '.gz')) for filename in outputs)
+
+
+#-------------------------------------------------------------------------------
+def read_json (filename, default):
+    '''
+    returns the content of a JSON file, or the default value if it is missing
+    '''
+    try:
+        with open(filename) as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        return default
+    except ValueError:
+        sys.exit('Error: cannot read ' + filename + ' (remove it to rerun the stages).')
+
+
+#-------------------------------------------------------------------------------
+def write_json (filename, data):
+    '''
+    write a JSON file in place of the previous one
+    '''
+    with open(filename + '.tmp', 'w') as output:
+        json.dump(data, output, indent=2, sort_keys=True)
+        output.write('\n')
+    os.replace(filename + '.tmp', filename)
+
+
+#-------------------------------------------------------------------------------
+def run_stage (name, *args, env=None):
+    '''
+    run a stage of ngs-ig_process.sh; returns its exit status
+    1st argument--stage name
+    other arguments--stage arguments
+    '''
+    sys.stdout.flush()
+    return subprocess.call(['bash', os.path.join(SCRDIR, 'ngs-ig_process.sh'), 'stage', name]\
+                           + list(args), env=env)
+
+
+#-------------------------------------------------------------------------------
+def read_params ():
+    '''
+    returns the dictionary of the dataset and environment values of the run
+      (DATANAME, DATASET_*, pipeline variables), as set up by ngs-ig_process.sh
+    '''
+    with tempfile.NamedTemporaryFile('r', suffix='.params') as params_file:
+        if run_stage('params', params_file.name) != 0:
+            sys.exit('Error: cannot set up the dataset parameters (see the output above).')
+        params = dict(line.rstrip('\n').split('=', 1) for line in params_file if '=' in line)
+    if not params.get('DATANAME'):
+        sys.exit('Error: cannot determine the dataset name.')
+    return params
+
+
+#-------------------------------------------------------------------------------
+#### main section
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline stages whose inputs,'\
+        + ' parameters or scripts changed since their last completion.')
+    parser.add_argument('--from', nargs='?', type=str, dest='from_stage', choices=STAGE_NAMES, \
+        help='Rerun this stage and all the following ones regardless of the cache')
+    parser.add_argument('--stages', nargs='+', type=str, choices=STAGE_NAMES, \
+        help='Run only these stages (if needed), without compressing the intermediates'\
+            + ' and finishing the run (see batch_runner.py)')
+    parser.add_argument('--dry_run', action='store_true', \
+        help='List the stages that would be run or skipped, without running them')
+    parser.add_argument('--topup', action='store_true', \
+        help='Collapse again only the MIGs with new reads and annotate only the new'\
+            + ' consensus sequences, with the results of the previous run kept in '\
+            + os.path.relpath(TOPUP_STATE, WDIR) + ' (e.g., after adding reads to the input)')
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(WDIR, 'input')):
+        sys.exit('Error: the input directory ' + os.path.join(WDIR, 'input') + ' was not found!')
+    if not args.dry_run:
+        if not os.path.isdir(os.path.join(WDIR, '00_output')):
+            if run_stage('initialize') != 0:
+                sys.exit('Error: cannot set up the output directories.')
+        elif not os.path.exists(os.path.join(WDIR, 'running')):
+            with open(os.path.join(WDIR, 'running'), 'w') as running:
+                running.write('run start:\n' + time.strftime('%a %b %d %H:%M:%S %Z %Y') + '\n')
+
+    params = read_params()
+    with open(os.path.join(SCRDIR, 'ngs-ig_process_functions.sh')) as functions_file:
+        functions_text = functions_file.read()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    digests_filename = os.path.join(CACHE_DIR, 'file_digests.json')
+    digests = read_json(digests_filename, {})
+
+    keys = {}
+    forced = False
+    for stage in STAGES:
+        if stage.applies is not None and not stage.applies(params):
+            continue
+        forced = forced or stage.name == args.from_stage
+        key = stage_key(stage, params, keys, digests, functions_text)
+        write_json(digests_filename, digests)
+        keys[stage.name] = key
+        if args.stages and stage.name not in args.stages:
+            continue
+        record_filename = os.path.join(CACHE_DIR, stage.name + '.json')
+        record = read_json(record_filename, {})
+
+        if not forced and record.get('key') == key and record.get('status') == 'complete'\
+                and outputs_present(record['outputs']):
+            print('Skipping stage ' + stage.name + ' ... inputs, parameters and scripts'\
+                  + ' unchanged since ' + record['completed'] + '.')
+            continue
+        if args.dry_run:
+            print('Stage ' + stage.name + ' would be run.')
+            continue
+
+        # an interrupted igblastn loop with the same fingerprint is resumed
+        env = dict(os.environ)
+        if stage.name == 'igblast' and not forced and record.get('key') == key:
+            env['IGBLAST_resume'] = '1'
+        if args.topup and stage.name in TOPUP_STAGES:
+            env['TOPUP_STATE'] = TOPUP_STATE
+        print('[' + time.strftime('%H:%M:%S%Z') + ']...Running stage ' + stage.name\
+              + ' (fingerprint ' + key[:12] + ').')
+        started = time.strftime('%Y-%m-%d %H:%M:%S')
+        write_json(record_filename, {'key' : key, 'status' : 'running', 'started' : started})
+        status = run_stage(stage.name, env=env)
+        outputs = stage_outputs(stage, params)
+        if status != 0 or outputs is None:
+            write_json(record_filename, {'key' : key, 'status' : 'failed',\
+                                         'started' : started})
+            sys.exit('Error: stage ' + stage.name + ' did not complete'\
+                     + (' (exit status ' + str(status) + ').' if status else\
+                        ' (missing outputs).'))
+        write_json(record_filename, {'key' : key, 'status' : 'complete', 'outputs' : outputs,\
+                                     'completed' : time.strftime('%Y-%m-%d %H:%M:%S')})
+
+    if not args.dry_run and not args.stages:
+        run_stage('compress')
+        run_stage('finish')
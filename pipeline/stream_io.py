@@ -0,0 +1,192 @@
+'''
+stream_io.py
+  Input/output streams for the Python pipeline stages. Gzip-compressed input
+  is recognized by its magic bytes and decompressed on a background thread;
+  output files ending in ".gz" are compressed on a background thread. zlib
+  releases the GIL while it works, so (de)compression overlaps with the actual
+  processing and no uncompressed intermediate has to be written to disk.
+'''
+
+import contextlib
+import gzip
+import io
+import queue
+import sys
+import threading
+import zlib
+
+GZIP_MAGIC = b'\x1f\x8b'
+BLOCK_SIZE = 1 << 22    # bytes per (de)compression block
+QUEUE_BLOCKS = 4        # blocks buffered between the threads
+COMPRESS_LEVEL = 6      # same as the gzip command-line default
+
+
+class ThreadedGzipReader(io.RawIOBase):
+    '''
+    Binary read-only stream over a gzip file; blocks are decompressed ahead of
+      time on a background thread
+    '''
+
+    def __init__(self, filename, block_size=BLOCK_SIZE):
+        super().__init__()
+        self.name       = filename
+        self.block_size = block_size
+        self.blocks     = queue.Queue(QUEUE_BLOCKS)
+        self.stop       = threading.Event()
+        self.block      = b''
+        self.block_pos  = 0
+        self.eof        = False
+        self.gz_handle  = gzip.open(filename, 'rb')
+        self.thread     = threading.Thread(target=self._decompress, daemon=True)
+        self.thread.start()
+
+    def _decompress(self):
+        try:
+            while not self.stop.is_set():
+                block = self.gz_handle.read(self.block_size)
+                self._put(block)
+                if not block:
+                    break
+        except (OSError, EOFError, zlib.error) as error: # handed over to the reading thread
+            self._put(SystemExit('Error: corrupt gzip input in ' + self.name + ' (' +\
+                                 str(error) + ')'))
+        except Exception as error:
+            self._put(error)
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.block_pos >= len(self.block):
+            if self.eof:
+                return 0
+            block = self.blocks.get()
+            if isinstance(block, BaseException):
+                self.eof = True
+                raise block
+            if not block:
+                self.eof = True
+                return 0
+            self.block = memoryview(block)
+            self.block_pos = 0
+
+        size = min(len(buffer), len(self.block) - self.block_pos)
+        buffer[:size] = self.block[self.block_pos:self.block_pos + size]
+        self.block_pos += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stop.set()
+            self.thread.join()
+            self.gz_handle.close()
+        super().close()
+
+
+class ThreadedGzipWriter(io.TextIOBase):
+    '''
+    Text write-only stream into a gzip file; the text is encoded in blocks
+      that are compressed and written on a background thread
+    '''
+
+    def __init__(self, filename, block_size=BLOCK_SIZE, compresslevel=COMPRESS_LEVEL):
+        super().__init__()
+        self.name          = filename
+        self.block_size    = block_size
+        self.blocks        = queue.Queue(QUEUE_BLOCKS)
+        self.pending       = []
+        self.pending_size  = 0
+        self.error         = None
+        self.gz_handle     = gzip.open(filename, 'wb', compresslevel=compresslevel)
+        self.thread        = threading.Thread(target=self._compress, daemon=True)
+        self.thread.start()
+
+    def _compress(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            if self.error is None:
+                try:
+                    self.gz_handle.write(block)
+                except Exception as error: # reported by the writing thread
+                    self.error = error
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self._check()
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= self.block_size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            self.blocks.put(''.join(self.pending).encode('utf8'))
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+            finally:
+                self.blocks.put(None)
+                self.thread.join()
+                self.gz_handle.close()
+            self._check()
+        super().close()
+
+
+#-------------------------------------------------------------------------------
+def is_gzipped (filename):
+    '''
+    returns True if the file starts with the gzip magic bytes
+    1st argument--filename
+    '''
+    with open(filename, 'rb') as handle:
+        return handle.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+#-------------------------------------------------------------------------------
+def open_input (filename, text = False):
+    '''
+    returns a binary (or text) handle for reading a plain or gzip-compressed file
+    1st argument--filename
+    2nd argument--True for a text handle (UTF-8)
+    '''
+    if not is_gzipped(filename):
+        return open(filename, 'r', encoding='utf8') if text else open(filename, 'rb')
+
+    handle = io.BufferedReader(ThreadedGzipReader(filename), BLOCK_SIZE)
+    return io.TextIOWrapper(handle, encoding='utf8') if text else handle
+
+
+#-------------------------------------------------------------------------------
+def open_output (filename = None):
+    '''
+    returns a text handle for writing, to be used in a "with" statement;
+      "-" or None stands for the standard output (left open on exit) and
+      filenames ending in ".gz" are gzip-compressed
+    1st argument--filename
+    '''
+    if filename is None or filename == '-':
+        return contextlib.nullcontext(sys.stdout)
+    if filename.endswith('.gz'):
+        return ThreadedGzipWriter(filename)
+    return open(filename, 'w', encoding='utf8')
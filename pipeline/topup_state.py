@@ -0,0 +1,243 @@
+'''
+topup_state.py
+  Per-sample state store of the incremental (top-up) mode, in an SQLite file
+  (00_output/topup_state.sqlite, see stage_runner.py --topup). It keeps the
+  MIGs of the last run (barcode, membership size and digest, consensus) for
+  fasta_barcode_consensus.py, and the IgBLAST output of each consensus
+  sequence (by sequence digest) for igblast_scheduler.py, with its harvest
+  result and the clonotype counts of the last run for igblast-out_harvester.py.
+  When a library is topped up with the reads of another run, only the MIGs
+  that gained reads are collapsed again, only the new or changed consensus
+  sequences are sent to igblastn and annotated by the harvester, and the
+  clonotype counts are updated with the records that changed; everything else
+  comes from the store, so that the outputs are those of a full run over all
+  the reads. Each store is tied to the settings it was built with (consensus
+  options, igblastn command line, harvester filter) and is emptied when they
+  change.
+'''
+
+import collections
+import hashlib
+import sqlite3
+
+BATCH_ROWS = 10000 # rows written at a time
+# columns of the MIG tables (the reads tossed and the seed ties of the consensus are
+#   kept for its counters)
+MIG_COLUMNS = '(barcode TEXT PRIMARY KEY, size INTEGER, members BLOB, retained INTEGER,'\
+              + ' seq TEXT, qual TEXT, tossed_length INTEGER, tossed_mismatches INTEGER,'\
+              + ' seed_ties INTEGER)'
+# records of the scrub set per clonotype and read count (weight), and their totals
+CLONE_WEIGHT_COLUMNS = '(vj TEXT, rearr TEXT, weight INTEGER, records INTEGER,'\
+                       + ' PRIMARY KEY (vj, rearr, weight))'
+CLONOTYPE_COLUMNS = '(vj TEXT, rearr TEXT, records INTEGER, reads INTEGER,'\
+                    + ' PRIMARY KEY (vj, rearr))'
+
+
+#-------------------------------------------------------------------------------
+def seq_digest (seq):
+    '''
+    returns the digest of a sequence (key of its stored IgBLAST output)
+    '''
+    return hashlib.sha1(seq.encode('ascii')).digest()
+
+
+#-------------------------------------------------------------------------------
+def members_digest (seqs):
+    '''
+    returns the digest of the reads of a MIG, in order (the consensus depends
+      on the reads and their order only)
+    '''
+    digest = hashlib.sha1()
+    for seq in seqs:
+        digest.update(seq.encode('ascii') + b'\n')
+    return digest.digest()
+
+
+#-------------------------------------------------------------------------------
+def settings_key (values, filenames):
+    '''
+    returns the settings string of a store: the values of the options and the
+      digest of the code the stored results depend on
+    1st argument--array of option values
+    2nd argument--array of source filenames
+    '''
+    digest = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, 'rb') as handle:
+            digest.update(handle.read())
+    return ' '.join(map(str, values)) + ' ' + digest.hexdigest()
+
+
+class StateStore:
+    '''
+    SQLite state store; the MIGs of a run are written to a new table that
+      replaces those of the previous run when the run completes (commit_migs)
+    '''
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(migs)')]
+        if columns and 'seed_ties' not in columns:
+            # MIGs stored without their consensus counters: they are collapsed again
+            self.connection.execute('DROP TABLE migs')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS migs ''' + MIG_COLUMNS + ''';
+            CREATE TABLE IF NOT EXISTS annotations (digest BLOB PRIMARY KEY, block TEXT);
+            CREATE TABLE IF NOT EXISTS harvests (digest BLOB PRIMARY KEY, result TEXT);
+            CREATE TABLE IF NOT EXISTS clone_weights ''' + CLONE_WEIGHT_COLUMNS + ''';
+            CREATE TABLE IF NOT EXISTS clonotypes ''' + CLONOTYPE_COLUMNS + ''';
+            DROP TABLE IF EXISTS migs_next;
+            CREATE TABLE migs_next ''' + MIG_COLUMNS + ''';
+        ''')
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.execute('DROP TABLE IF EXISTS migs_next')
+        self.connection.commit()
+        self.connection.close()
+
+    def setting(self, name):
+        row = self.connection.execute('SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_setting(self, name, value):
+        self.connection.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (name, value))
+        self.connection.commit()
+
+    def check_settings(self, name, value, *tables):
+        '''
+        empty the tables built with other settings; returns True if they were kept
+        1st argument--settings name (e.g., 'consensus')
+        2nd argument--settings of this run (string)
+        other arguments--tables depending on the settings (e.g., 'migs')
+        '''
+        if self.setting(name) == value:
+            return True
+        for table in tables:
+            self.connection.execute('DELETE FROM ' + table)
+        self.set_setting(name, value)
+        return False
+
+    #---------------------------------------------------------------------------
+    def stored_consensus(self, barcode, size, members):
+        '''
+        returns the stored (retained, consensus, quality, reads tossed for their
+          length, reads tossed for seed mismatches, seed ties) of a MIG with the
+          same reads (retained 0 and no consensus if it was dropped), or None
+        1st argument--barcode
+        2nd argument--number of reads
+        3rd argument--digest of the reads (see members_digest)
+        '''
+        row = self.connection.execute('SELECT retained, seq, qual, tossed_length,'\
+                                      + ' tossed_mismatches, seed_ties FROM migs WHERE barcode = ?'\
+                                      + ' AND size = ? AND members = ?',\
+                                      (barcode, size, members)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def keep_mig(self, barcode, size, members, consensus):
+        '''
+        record a MIG of this run
+        4th argument--(retained, consensus, quality, reads tossed for their length,
+          reads tossed for seed mismatches, seed ties), as returned by stored_consensus
+        '''
+        self.rows.append((barcode, size, members) + tuple(consensus))
+        if len(self.rows) >= BATCH_ROWS:
+            self._flush_migs()
+
+    def _flush_migs(self):
+        self.connection.executemany('INSERT OR REPLACE INTO migs_next VALUES'\
+                                    + ' (?, ?, ?, ?, ?, ?, ?, ?, ?)',\
+                                    self.rows)
+        self.rows = []
+
+    def commit_migs(self):
+        '''
+        replace the MIGs of the previous run with those of this run
+        '''
+        self._flush_migs()
+        self.connection.executescript('''
+            BEGIN;
+            DROP TABLE migs;
+            ALTER TABLE migs_next RENAME TO migs;
+            CREATE TABLE migs_next ''' + MIG_COLUMNS + ''';
+            COMMIT;
+        ''')
+
+    #---------------------------------------------------------------------------
+    def stored_blocks(self, digests):
+        '''
+        returns the dictionary of the stored IgBLAST output blocks (without the
+          query ID) of the sequence digests found in the store
+        '''
+        blocks = {}
+        digests = list(digests)
+        for start in range(0, len(digests), 500): # within the SQLite variable limit
+            batch = digests[start:start + 500]
+            blocks.update(self.connection.execute('SELECT digest, block FROM annotations'\
+                + ' WHERE digest IN (' + ','.join('?' * len(batch)) + ')', batch))
+        return blocks
+
+    def store_blocks(self, blocks):
+        '''
+        store IgBLAST output blocks
+        1st argument--iterable of (sequence digest, block without the query ID)
+        '''
+        self.connection.executemany('INSERT OR REPLACE INTO annotations VALUES (?, ?)', blocks)
+        self.connection.commit()
+
+    #---------------------------------------------------------------------------
+    def stored_harvests(self, digests):
+        '''
+        returns the dictionary of the stored harvest results (text, see
+          igblast-out_harvester.py) of the sequence digests found in the store
+        '''
+        results = {}
+        digests = list(digests)
+        for start in range(0, len(digests), 500): # within the SQLite variable limit
+            batch = digests[start:start + 500]
+            results.update(self.connection.execute('SELECT digest, result FROM harvests'\
+                + ' WHERE digest IN (' + ','.join('?' * len(batch)) + ')', batch))
+        return results
+
+    def store_harvests(self, results):
+        '''
+        store harvest results
+        1st argument--iterable of (sequence digest, result text)
+        '''
+        self.connection.executemany('INSERT OR REPLACE INTO harvests VALUES (?, ?)', results)
+        self.connection.commit()
+
+    def update_clonotypes(self, weights):
+        '''
+        update the stored clonotype counts in place with the records of this run
+          that differ from those of the previous run; returns the dictionary of
+          the counts ((VJ assignment, rearrangement): (records, reads))
+        1st argument--collections.Counter of the scrub records of this run by
+          (VJ assignment, rearrangement, weight)
+        '''
+        previous = collections.Counter({(vj, rearr, weight) : records for vj, rearr, weight, records\
+                                        in self.connection.execute('SELECT * FROM clone_weights')})
+        delta = collections.defaultdict(lambda: [0, 0])
+        for sign, changes in ((1, weights - previous), (-1, previous - weights)):
+            for (vj, rearr, weight), records in changes.items():
+                delta[vj, rearr][0] += sign * records
+                delta[vj, rearr][1] += sign * records * weight
+        self.connection.executemany('INSERT INTO clonotypes VALUES (?, ?, ?, ?)'\
+                                    + ' ON CONFLICT (vj, rearr) DO UPDATE SET'\
+                                    + ' records = records + excluded.records,'\
+                                    + ' reads = reads + excluded.reads',\
+                                    [key + tuple(counts) for key, counts in delta.items()])
+        self.connection.execute('DELETE FROM clonotypes WHERE records = 0')
+        self.connection.execute('DELETE FROM clone_weights')
+        self.connection.executemany('INSERT INTO clone_weights VALUES (?, ?, ?, ?)',\
+                                    [key + (records,) for key, records in weights.items()])
+        self.connection.commit()
+        return {(vj, rearr) : (records, reads) for vj, rearr, records, reads\
+                in self.connection.execute('SELECT * FROM clonotypes')}
@@ -0,0 +1,108 @@
+'''
+translator.py
+  Table-driven translation engine for the IgBLAST harvester. The genetic code
+  is a module-level codon table, and all three forward reading frames of a
+  sequence are translated in one pass: with NumPy, every position is turned
+  into an overlapping codon index and mapped through a byte lookup table, so
+  that frame f is simply every third residue starting at f. Codons containing
+  anything other than ACGTN are translated as 'X' (see invalid_bases).
+'''
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# adapted from http://www.techcuriosity.com/resources/bioinformatics/dna2protein.php
+CODON_TABLE = {'TCA':'S','TCC':'S','TCG':'S','TCT':'S','AGC':'S','AGT':'S',
+               'TTC':'F','TTT':'F',
+               'TTA':'L','TTG':'L','CTA':'L','CTC':'L','CTG':'L','CTT':'L',
+               'TAC':'Y','TAT':'Y',
+               'TAA':'*','TAG':'*','TGA':'*',
+               'TGC':'C','TGT':'C',
+               'TGG':'W',
+               'CCA':'P','CCC':'P','CCG':'P','CCT':'P',
+               'CAC':'H','CAT':'H',
+               'CAA':'Q','CAG':'Q',
+               'CGA':'R','CGC':'R','CGG':'R','CGT':'R','AGA':'R','AGG':'R',
+               'ATA':'I','ATC':'I','ATT':'I',
+               'ATG':'M',
+               'ACA':'T','ACC':'T','ACG':'T','ACT':'T',
+               'AAC':'N','AAT':'N',
+               'AAA':'K','AAG':'K',
+               'GTA':'V','GTC':'V','GTG':'V','GTT':'V',
+               'GCA':'A','GCC':'A','GCG':'A','GCT':'A',
+               'GAC':'D','GAT':'D',
+               'GAA':'E','GAG':'E',
+               'GGA':'G','GGC':'G','GGG':'G','GGT':'G'}
+
+NTS = 'ACGTN'
+UNKNOWN_AA = 'X'
+
+# codons with an N are ambiguous
+for _first in NTS:
+    for _second in NTS:
+        for _third in NTS:
+            CODON_TABLE.setdefault(_first + _second + _third, UNKNOWN_AA)
+
+# characters outside of ACGTN, found by deleting the expected ones
+VALID_BASES = str.maketrans('', '', NTS)
+
+if np is not None:
+    # byte -> base code (A, C, G, T, N = 0..4; anything else is 5)
+    BASE_CODES = bytes(NTS.index(chr(byte)) if chr(byte) in NTS else len(NTS)\
+                       for byte in range(256))
+    CODE_BASE = len(NTS) + 1
+    # codon index (first*36 + second*6 + third) -> amino acid byte
+    AA_LOOKUP = np.full(CODE_BASE ** 3, ord(UNKNOWN_AA), dtype=np.uint8)
+    for _codon, _aa in CODON_TABLE.items():
+        AA_LOOKUP[(NTS.index(_codon[0]) * CODE_BASE + NTS.index(_codon[1])) * CODE_BASE\
+                  + NTS.index(_codon[2])] = ord(_aa)
+
+
+#-------------------------------------------------------------------------------
+def invalid_bases (seq):
+    '''
+    returns the characters of the sequence other than ACGTN (empty if none)
+    1st argument--nucleotide sequence
+    '''
+    return seq.translate(VALID_BASES)
+
+
+#-------------------------------------------------------------------------------
+def translate (seq):
+    '''
+    returns the translation of the sequence in the first forward frame
+    1st argument--nucleotide sequence
+    '''
+    return ''.join([CODON_TABLE.get(seq[ind:ind + 3], UNKNOWN_AA)\
+                    for ind in range(0, len(seq) - 2, 3)])
+
+
+#-------------------------------------------------------------------------------
+def translate_frames_python (seq):
+    '''
+    returns the translations of the three forward frames (seq, seq[1:], seq[2:])
+    1st argument--nucleotide sequence
+    '''
+    return translate(seq), translate(seq[1:]), translate(seq[2:])
+
+
+#-------------------------------------------------------------------------------
+def translate_frames_numpy (seq):
+    '''
+    NumPy version of translate_frames_python (same argument and return value)
+    '''
+    if len(seq) < 3:
+        return '', '', ''
+
+    codes = np.frombuffer(seq.encode('ascii', 'replace').translate(BASE_CODES),\
+                          dtype=np.uint8).astype(np.intp)
+    # amino acid of the codon starting at each position
+    residues = AA_LOOKUP[(codes[:-2] * CODE_BASE + codes[1:-1]) * CODE_BASE + codes[2:]]\
+        .tobytes()
+    return residues[0::3].decode('ascii'), residues[1::3].decode('ascii'),\
+        residues[2::3].decode('ascii')
+
+
+translate_frames = translate_frames_numpy if np is not None else translate_frames_python
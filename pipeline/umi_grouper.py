@@ -0,0 +1,200 @@
+'''
+umi_grouper.py
+  In-memory UMI grouping for fasta_barcode_consensus (in place of the
+  fasta_barcode_count.pl pass and its grouped FASTA). The UMI is extracted with
+  the same preamble/barcode/post pattern, and the reads are kept in one byte
+  buffer with an array of read offsets and, per barcode, an array of read
+  numbers, so that no per-read Python objects are held while the input is
+  read. The MIGs are then handed out in the order and with the identifiers of
+  the grouped FASTA (largest barcode first, ties in order of appearance; MIG
+  element numbers count down from the last read of the barcode).
+  Optionally, barcodes that differ from a more abundant one by a few
+  substitutions (sequencing errors) are merged into its MIG by directional
+  adjacency clustering (as in UMI-tools): barcode b joins a if they are within
+  the Hamming distance and count(a) >= 2 * count(b) - 1. The neighbours are
+  found with a segment index (HammingIndex) instead of comparing all pairs.
+'''
+
+import re
+from array import array
+
+import seed_index
+import seq_reader
+
+UNKNOWN = 'unknown' # the barcode pattern does not match after the preamble
+GARBAGE = 'garbage' # the preamble pattern does not match
+PACKED_BASES = 'ACGTN'
+
+
+class HammingIndex:
+    '''
+    index of barcodes for finding those within a Hamming distance: with the
+      barcodes cut into max_distance + 2 segments, two barcodes of the same
+      length within the distance agree exactly on at least two segments, so
+      they share a bucket keyed on a pair of segments; only the barcodes in
+      the same buckets are compared (2-bit packed, see seed_index.py)
+    '''
+
+    def __init__(self, barcodes, max_distance):
+        self.max_distance = max_distance
+        self.packed       = {}  # barcode -> (bits | nmask << 1, lane mask, keys)
+        self.buckets      = {}  # segment pair key -> array of barcodes
+        for barcode in barcodes:
+            if not barcode or barcode.strip(PACKED_BASES): # not packable; never merged
+                continue
+            bits, nmask = seed_index.pack_seq(barcode)
+            keys = self._segment_keys(barcode)
+            self.packed[barcode] = (bits, nmask, keys)
+            for key in keys:
+                self.buckets.setdefault(key, []).append(barcode)
+
+    def _segment_keys(self, barcode):
+        length = len(barcode)
+        segments = self.max_distance + 2
+        bounds = [length * segment // segments for segment in range(segments + 1)]
+        return [(length, first, second, barcode[bounds[first]:bounds[first + 1]] +\
+                 barcode[bounds[second]:bounds[second + 1]])\
+                for first in range(segments) for second in range(first + 1, segments)]
+
+    def neighbours(self, barcode):
+        '''
+        returns the other indexed barcodes within the Hamming distance, in the
+          order of indexing
+        1st argument--barcode
+        '''
+        if barcode not in self.packed:
+            return []
+        bits, nmask, keys = self.packed[barcode]
+        lanes = seed_index.lane_mask(len(barcode))
+        popcount = seed_index.popcount
+        found = {barcode: False}
+        for key in keys:
+            for candidate in self.buckets[key]:
+                if candidate not in found:
+                    cand_bits, cand_nmask, _ = self.packed[candidate]
+                    diff = (bits ^ cand_bits) | (nmask ^ cand_nmask)
+                    found[candidate] = popcount((diff | (diff >> 1)) & lanes)\
+                        <= self.max_distance
+        return [candidate for candidate, near in found.items() if near]
+
+
+class UmiGroups:
+    '''
+    reads grouped by UMI barcode
+    '''
+
+    def __init__(self, preamble, barcode, post):
+        self.preamble = re.compile(preamble)
+        self.umi      = re.compile(preamble + '(' + barcode + ')' + post)
+        self.bases    = bytearray()
+        self.ends     = array('q')
+        self.barcodes = {}  # barcode -> array of read numbers
+        self.unknowns = {}  # UNKNOWN/GARBAGE -> array of read numbers
+
+    def add(self, seq):
+        '''
+        extract the barcode from the start of a read and store the read (without
+          the UMI part, unless the barcode is not recognized)
+        1st argument--read sequence
+        '''
+        match = self.umi.match(seq)
+        if match:
+            group = self.barcodes.setdefault(match.group(1), array('l'))
+            seq = seq[match.end():]
+        else:
+            group = self.unknowns.setdefault(GARBAGE if not self.preamble.match(seq)\
+                                             else UNKNOWN, array('l'))
+        group.append(len(self.ends))
+        self.bases += seq.encode('ascii')
+        self.ends.append(len(self.bases))
+
+    def read(self, read_number):
+        '''
+        returns the stored sequence of a read
+        '''
+        start = self.ends[read_number - 1] if read_number else 0
+        return self.bases[start:self.ends[read_number]].decode('ascii')
+
+    def __len__(self):
+        return len(self.ends)
+
+    def cluster(self, max_distance):
+        '''
+        merge the barcodes into more abundant ones within the Hamming distance
+          (directional adjacency); returns the number of barcodes merged away
+        1st argument--maximum number of substitutions (e.g., 1 or 2)
+        '''
+        if max_distance <= 0 or len(self.barcodes) < 2:
+            return 0
+
+        index = HammingIndex(self.barcodes, max_distance)
+        counts = {barcode: len(reads) for barcode, reads in self.barcodes.items()}
+        parents = {}
+        members = {}
+        for barcode in sorted(self.barcodes, key=lambda barcode: -counts[barcode]):
+            if barcode in parents:
+                continue
+            parents[barcode] = barcode
+            members[barcode] = queue = [barcode]
+            for node in queue: # breadth-first; the queue grows while iterating
+                for neighbour in index.neighbours(node):
+                    if neighbour not in parents and counts[node] >= 2 * counts[neighbour] - 1:
+                        parents[neighbour] = barcode
+                        queue.append(neighbour)
+
+        merged = 0
+        for barcode, cluster in members.items():
+            if len(cluster) > 1:
+                self.barcodes[barcode] = array('l', sorted(read_number for member in cluster\
+                                                           for read_number in self.barcodes[member]))
+                for member in cluster[1:]:
+                    del self.barcodes[member]
+                merged += len(cluster) - 1
+        return merged
+
+    def migs(self, max_seqs=0):
+        '''
+        yields (MIG number, barcode, array of sequences) for the recognized
+          barcodes (by decreasing size) and then for the unrecognized ones; the
+          sequences are ordered by decreasing element number (last read first)
+        1st argument--MIGs of more sequences are yielded as seq_reader.StreamedMig,
+          with the sequences decoded as they are used (default: 0, no limit)
+        '''
+        mig_id = 0
+        ordered = sorted(self.barcodes.items(), key=lambda item: -len(item[1]))
+        for barcode, reads in ordered + list(self.unknowns.items()):
+            mig_id += 1
+            if max_seqs and len(reads) > max_seqs:
+                yield mig_id, barcode, seq_reader.StreamedMig(len(reads),\
+                    lambda reads=reads: map(self.read, reversed(reads)))
+            else:
+                yield mig_id, barcode, [self.read(read_number) for read_number in reversed(reads)]
+
+
+#-------------------------------------------------------------------------------
+def group_reads (records, preamble, barcode, post):
+    '''
+    returns UmiGroups for the reads of a record stream
+    1st argument--iterable of SeqRecord objects (see seq_reader.read_records)
+    2nd argument--regular expression for the sequence before the barcode
+    3rd argument--regular expression for the barcode
+    4th argument--regular expression for the sequence after the barcode
+    '''
+    groups = UmiGroups(preamble, barcode, post)
+    for record in records:
+        groups.add(record.seq)
+    return groups
+
+
+#-------------------------------------------------------------------------------
+def grouped_fasta (mig_id, barcode, seqs):
+    '''
+    yields the records of the MIG in the FASTA format of fasta_barcode_count.pl
+    1st argument--MIG number
+    2nd argument--barcode (or UNKNOWN/GARBAGE)
+    3rd argument--array of sequences (by decreasing element number)
+    '''
+    prefix = '>MIG' + str(mig_id) + ';barcode=' + barcode + ';size=' + str(len(seqs)) +\
+        ';element='
+    for ind, seq in enumerate(seqs):
+        yield prefix + str(len(seqs) - ind) + '\n' + seq + '\n'
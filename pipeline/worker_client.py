@@ -0,0 +1,76 @@
+'''
+worker_client.py
+  Thin client of worker_service.py: runs a consensus or harvester script with
+  the command line it would have under python3, through the service named by
+  WORKER_SOCKET. The job gets the standard streams, working directory and
+  environment of the client, and the client exits with the status of the job.
+  Without a running service (or if the service refuses the job, e.g., for a
+  different version of the scripts), the script is run by python3 as usual.
+  Usage:
+    python3 scripts/worker_client.py fastq_barcode_consensus.py [script options]
+'''
+
+import sys
+import json
+import os
+import socket
+
+SCRDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+#-------------------------------------------------------------------------------
+def run_locally (script, argv, reason = None):
+    '''
+    run the script in this process's place with python3; does not return
+    '''
+    if reason is not None:
+        sys.stderr.write('Worker service not used (' + reason + '); running ' \
+                         + os.path.basename(script) + ' with python3.\n')
+        sys.stderr.flush()
+    os.execv(sys.executable, [sys.executable, script] + argv)
+
+
+#-------------------------------------------------------------------------------
+def run_job (path, script, argv):
+    '''
+    returns the exit status of the script run by the service
+    1st argument--socket filename
+    2nd argument--script filename
+    3rd argument--array of script arguments
+    '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError as err:
+        run_locally(script, argv, 'cannot connect to ' + path + ': ' + err.strerror)
+
+    request = json.dumps({'script' : script, 'argv' : argv, 'cwd' : os.getcwd(),\
+                          'env' : dict(os.environ)}).encode() + b'\n'
+    socket.send_fds(client, [request], [0, 1, 2])
+    reply = b''
+    while not reply.endswith(b'\n'):
+        block = client.recv(4096)
+        if not block:
+            sys.exit('Error: the worker service stopped before ' + os.path.basename(script)\
+                     + ' completed.')
+        reply += block
+    reply = json.loads(reply)
+    if 'refused' in reply:
+        client.close()
+        run_locally(script, argv, reply['refused'])
+    status = reply['status']
+    return status if status >= 0 else 128 - status # terminated by a signal
+
+
+#-------------------------------------------------------------------------------
+#### main section
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('Usage: python3 worker_client.py script.py [script options]')
+    script = os.path.join(SCRDIR, sys.argv[1])
+    if not os.path.exists(script):
+        sys.exit('File ' + script + ' was not found!')
+
+    if not os.environ.get('WORKER_SOCKET'):
+        run_locally(script, sys.argv[2:])
+    sys.exit(run_job(os.environ['WORKER_SOCKET'], script, sys.argv[2:]))
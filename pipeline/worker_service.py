@@ -0,0 +1,295 @@
+'''
+worker_service.py
+  Long-lived service for the Python stages run many times on a node (MIG
+  consensus, IgBLAST output harvesting), e.g., by the batch runner over many
+  small datasets. The interpreter, NumPy, the modules of the pipeline (with
+  their compiled parsers and codon tables) and the compiled scripts are loaded
+  once; each job sent by worker_client.py over the Unix socket is run in a
+  process forked from the service (its worker pools are forked from it in
+  turn), in the directory, environment and standard streams of the client,
+  so that the output is streamed as from "python3 script.py". Jobs run
+  concurrently; a job whose client goes away is terminated. Only the scripts
+  of SERVED_SCRIPTS are run, and only for a scripts directory with the same
+  Python modules as the service (otherwise the client runs python3 itself).
+  Usage:
+    python3 scripts/worker_service.py --socket /tmp/ngs-ig.sock &
+    export WORKER_SOCKET=/tmp/ngs-ig.sock   # picked up by pythonJob
+'''
+
+import sys
+import argparse
+import glob
+import hashlib
+import json
+import os
+import select
+import signal
+import socket
+import time
+import traceback
+import types
+
+SCRDIR          = os.path.dirname(os.path.abspath(__file__))
+SERVED_SCRIPTS  = ('fasta_barcode_consensus.py', 'fastq_barcode_consensus.py',\
+                   'igblast-out_harvester.py')
+POLL_SECONDS    = 0.5
+REQUEST_SECONDS = 10     # time allowed for a client to send its request
+MAX_REQUEST     = 1 << 16
+
+
+#-------------------------------------------------------------------------------
+def modules_digest (directory):
+    '''
+    returns the SHA-256 digest of the Python modules of a scripts directory
+      (names and content), to tell whether its scripts match the loaded ones
+    '''
+    digest = hashlib.sha256()
+    for filename in sorted(glob.glob(os.path.join(glob.escape(directory), '*.py'))):
+        digest.update(os.path.basename(filename).encode() + b'\0')
+        with open(filename, 'rb') as handle:
+            digest.update(handle.read())
+    return digest.hexdigest()
+
+
+#-------------------------------------------------------------------------------
+def load_scripts ():
+    '''
+    returns the dictionary of the compiled SERVED_SCRIPTS; each is run once
+      (not as __main__) so that the modules it imports are loaded
+    '''
+    if SCRDIR not in sys.path:
+        sys.path.insert(0, SCRDIR)
+    scripts = {}
+    for name in SERVED_SCRIPTS:
+        filename = os.path.join(SCRDIR, name)
+        with open(filename) as handle:
+            scripts[name] = compile(handle.read(), filename, 'exec')
+        exec(scripts[name], {'__name__' : '__worker_service__', '__file__' : filename})
+    return scripts
+
+
+#-------------------------------------------------------------------------------
+def read_request (connection):
+    '''
+    returns the job request of a client (dictionary: script, argv, cwd, env)
+      and the client's stdin, stdout and stderr descriptors
+    '''
+    connection.settimeout(REQUEST_SECONDS)
+    data, fds, _, _ = socket.recv_fds(connection, MAX_REQUEST, 3)
+    try:
+        while not data.endswith(b'\n'):
+            block = connection.recv(MAX_REQUEST)
+            if not block:
+                raise ValueError('incomplete request')
+            data += block
+        if len(fds) != 3:
+            raise ValueError('expecting the stdin, stdout and stderr of the client')
+        request = json.loads(data)
+        if not all(key in request for key in ('script', 'argv', 'cwd', 'env')):
+            raise ValueError('expecting the script, argv, cwd and env of the job')
+    except (ValueError, OSError):
+        for fd in fds:
+            os.close(fd)
+        raise
+    connection.settimeout(None)
+    return request, fds
+
+
+#-------------------------------------------------------------------------------
+def exit_status (code):
+    '''
+    returns the exit status for a SystemExit code (as the interpreter does,
+      a message is printed on stderr)
+    '''
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+#-------------------------------------------------------------------------------
+def run_job (code, request, fds):
+    '''
+    run a script as __main__ in a forked process, with the streams, working
+      directory, environment and arguments of the client; does not return
+    1st argument--compiled script
+    2nd argument--job request
+    3rd argument--stdin, stdout and stderr descriptors of the client
+    '''
+    status = 1
+    try:
+        os.setpgid(0, 0) # the job and its worker pool are terminated together
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        os.closerange(3, os.sysconf('SC_OPEN_MAX')) # the socket and the other clients
+        sys.stdin  = open(0, closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False, errors='backslashreplace')
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.argv = [code.co_filename] + request['argv']
+
+        main = types.ModuleType('__main__')
+        main.__file__ = code.co_filename
+        sys.modules['__main__'] = main # functions handed to worker pools are pickled by module
+        try:
+            exec(code, main.__dict__)
+            status = 0
+        except SystemExit as exit:
+            status = exit_status(exit.code)
+        except BaseException:
+            traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        os._exit(status)
+
+
+#-------------------------------------------------------------------------------
+def start_job (connection, scripts, digest):
+    '''
+    read the request of a client and start its job; returns the process ID of
+      the job, or None if the request is refused (the reply tells the client)
+    '''
+    try:
+        request, fds = read_request(connection)
+    except (ValueError, OSError) as err:
+        sys.stderr.write('Rejected a request: ' + str(err) + '\n')
+        return None
+
+    name = os.path.basename(request['script'])
+    directory = os.path.dirname(os.path.realpath(request['script']))
+    refusal = None
+    if name not in scripts:
+        refusal = name + ' is not served (' + ', '.join(SERVED_SCRIPTS) + ')'
+    elif directory != SCRDIR and modules_digest(directory) != digest:
+        refusal = 'the scripts in ' + directory + ' differ from those of the service'
+    if refusal is not None:
+        for fd in fds:
+            os.close(fd)
+        connection.sendall(json.dumps({'refused' : refusal}).encode() + b'\n')
+        return None
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        run_job(scripts[name], request, fds)
+    try:
+        os.setpgid(pid, pid)
+    except OSError: # already set by the job (or gone)
+        pass
+    for fd in fds:
+        os.close(fd)
+    print('[' + time.strftime('%H:%M:%S%Z') + ']...Started ' + name + ' (' + str(pid) + ') in '\
+          + request['cwd'], flush=True)
+    return pid
+
+
+#-------------------------------------------------------------------------------
+def serve (path):
+    '''
+    accept jobs on a Unix socket until terminated
+    1st argument--socket filename
+    '''
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            sys.exit('Error: a worker service is already listening on ' + path + '.')
+        except OSError:
+            os.remove(path) # left over by a service that did not stop cleanly
+        finally:
+            probe.close()
+
+    scripts = load_scripts()
+    digest = modules_digest(SCRDIR)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_mask = os.umask(0o077) # the socket is private to the user
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_mask)
+    listener.listen(16)
+    print('Worker service listening on ' + path + ' (' + ', '.join(SERVED_SCRIPTS) + ').',\
+          flush=True)
+
+    def stop (signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    # a completed job wakes up the loop (through the pipe)
+    wakeup, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    jobs = {} # client connection: job process ID
+    try:
+        while True:
+            readable = select.select([listener, wakeup] + list(jobs), [], [], POLL_SECONDS)[0]
+            for connection in readable:
+                if connection == wakeup:
+                    os.read(wakeup, 4096)
+                elif connection is listener:
+                    client = listener.accept()[0]
+                    pid = start_job(client, scripts, digest)
+                    if pid is None:
+                        client.close()
+                    else:
+                        jobs[client] = pid
+                else: # the client went away
+                    try:
+                        os.killpg(jobs[connection], signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+
+            # report the jobs that completed
+            for connection, pid in list(jobs.items()):
+                done, wait_status = os.waitpid(pid, os.WNOHANG)
+                if done == 0:
+                    continue
+                del jobs[connection]
+                print('[' + time.strftime('%H:%M:%S%Z') + ']...Job ' + str(pid) + ' exited with status '\
+                      + str(os.waitstatus_to_exitcode(wait_status)), flush=True)
+                try:
+                    connection.sendall(json.dumps({'status' :\
+                        os.waitstatus_to_exitcode(wait_status)}).encode() + b'\n')
+                except OSError:
+                    pass
+                connection.close()
+    finally:
+        for connection, pid in jobs.items():
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for connection, pid in jobs.items():
+            os.waitpid(pid, 0)
+            connection.close()
+        listener.close()
+        os.remove(path)
+
+
+#-------------------------------------------------------------------------------
+#### main section
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the consensus and harvester jobs of'\
+        + ' worker_client.py from one long-lived process.')
+    parser.add_argument('--socket', nargs='?', type=str, default=os.environ.get('WORKER_SOCKET'),\
+        help='Unix socket filename (default is $WORKER_SOCKET)')
+    args = parser.parse_args()
+
+    if not args.socket:
+        sys.exit('Error: expecting the socket filename (--socket or WORKER_SOCKET).')
+    try:
+        serve(args.socket)
+    except KeyboardInterrupt:
+        pass